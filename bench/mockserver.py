@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+'''Local stand-in for an Anselus server, used for measuring client throughput and latency
+without a live server. It speaks the Anselus JSON message protocol for the requests made by the
+preregister, register, and setuser_id commands: a greeting object when a client connects, request
+objects containing Action and Data fields, and response objects containing Code, Status, Info,
+and Data fields. Messages are sent with nothing between them and each response is written in a
+single send, as the server does, so both serversession.ServerSession and the client library can
+talk to it. Requests are decoded as JSON values from the data read, so they may arrive split
+across reads or several at once, with or without line endings. Requests missing fields the
+server requires are answered with 400.
+
+Responses can be delayed by a fixed latency plus random jitter, replaced with 300 errors at a
+configurable rate, and given specific status codes per action, e.g. --status REGISTER=101:0.5
+answers half of all registrations with 101 (awaiting approval). The time taken to handle each
+request is recorded and summarized when the server exits.
+
+Example:
+python bench/mockserver.py --port 2001 --latency 2 --jitter 1 --error-rate 0.01'''
+
+import argparse
+import asyncio
+import json
+import random
+import secrets
+import signal
+import sys
+import threading
+import time
+import uuid
+
+STATUS_TEXT = {
+	101: 'PENDING',
+	200: 'OK',
+	201: 'REGISTERED',
+	300: 'INTERNAL SERVER ERROR',
+	304: 'REGISTRATION CLOSED',
+	400: 'BAD REQUEST',
+	406: 'PAYMENT REQUIRED',
+	408: 'RESOURCE EXISTS',
+}
+
+# Fields a request must have in its Data, by action
+REQUIRED_FIELDS = {
+	'REGISTER': [ 'Workspace-ID', 'Password-Hash' ],
+	'SETADDR': [ 'Workspace-ID', 'User-ID' ],
+}
+
+# Domain reported for workspaces the mock server creates
+DOMAIN = 'example.com'
+
+DEFAULT_CODES = {
+	'PREREG': 200,
+	'REGISTER': 201,
+	'SETADDR': 200,
+	'SETUSERID': 200,
+}
+
+class MockConfig:
+	'''Behavior of the mock server. latency and jitter are in seconds. statuses maps an action
+name to a list of (code, probability) pairs which override the default response code.'''
+	def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+				statuses=None, seed=None):
+		self.latency = latency
+		self.jitter = jitter
+		self.error_rate = error_rate
+		self.statuses = statuses if statuses else dict()
+		self.random = random.Random(seed)
+
+	def pick_code(self, action: str) -> int:
+		'''Chooses the response code for a request'''
+		if self.error_rate and self.random.random() < self.error_rate:
+			return 300
+
+		roll = self.random.random()
+		for code, probability in self.statuses.get(action, list()):
+			if roll < probability:
+				return code
+			roll -= probability
+		return DEFAULT_CODES.get(action, 400)
+
+	def pick_delay(self) -> float:
+		'''Chooses how long to wait before responding'''
+		if self.jitter:
+			return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+		return self.latency
+
+
+def parse_status_option(value: str) -> tuple:
+	'''Parses an ACTION=code[:probability][,code[:probability]...] option'''
+	action, _, codes = value.partition('=')
+	out = list()
+	for item in codes.split(','):
+		code, _, probability = item.partition(':')
+		out.append((int(code), float(probability) if probability else 1.0))
+	return action.upper(), out
+
+
+class MockServer:
+	'''asyncio server which answers Anselus requests as configured and records timings'''
+	def __init__(self, config: MockConfig):
+		self.config = config
+		# (action, response code, seconds from receipt to response)
+		self.timings = list()
+		self.connections = 0
+		self.started = time.time()
+
+	def respond(self, request: dict) -> dict:
+		'''Builds the response to a request'''
+		action = str(request.get('Action', '')).upper()
+		data = request.get('Data', dict())
+		if not isinstance(data, dict):
+			data = dict()
+
+		missing = [ f for f in REQUIRED_FIELDS.get(action, list()) if not data.get(f) ]
+		code = 400 if missing else self.config.pick_code(action)
+		response = { 'Code':code, 'Status':STATUS_TEXT.get(code, 'ERROR'), 'Info':'',
+					'Data':dict() }
+		if missing:
+			response['Info'] = 'Missing field %s' % missing[0]
+		if code not in (200, 201):
+			return response
+
+		if action == 'PREREG':
+			response['Data'] = {
+				'Workspace-ID': str(uuid.uuid4()),
+				'User-ID': data.get('User-ID', ''),
+				'Reg-Code': secrets.token_urlsafe(12),
+				'Domain': DOMAIN,
+			}
+		elif action == 'REGISTER':
+			response['Data'] = { 'Workspace-ID': data['Workspace-ID'], 'Domain': DOMAIN }
+		elif action in ('SETADDR', 'SETUSERID'):
+			response['Data'] = { 'User-ID': data.get('User-ID', '') }
+		return response
+
+	async def handle(self, reader, writer):
+		'''Serves one client connection until it disconnects or sends QUIT'''
+		self.connections += 1
+		decoder = json.JSONDecoder()
+		buffer = ''
+		greeting = { 'Name':'Anselus', 'Version':'0.1', 'Code':200, 'Status':'OK',
+					'Date':time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) }
+		try:
+			writer.write(json.dumps(greeting).encode())
+			await writer.drain()
+			while True:
+				chunk = await reader.read(65536)
+				if not chunk:
+					break
+				buffer += chunk.decode('utf-8', errors='replace')
+
+				# Requests may arrive several to a read or split across reads
+				while True:
+					buffer = buffer.lstrip()
+					if not buffer:
+						break
+					try:
+						request, end = decoder.raw_decode(buffer)
+					except ValueError:
+						break
+					buffer = buffer[end:]
+
+					if not isinstance(request, dict):
+						request = dict()
+					if str(request.get('Action', '')).upper() == 'QUIT':
+						return
+
+					received = time.perf_counter()
+					delay = self.config.pick_delay()
+					if delay:
+						await asyncio.sleep(delay)
+					response = self.respond(request)
+					writer.write(json.dumps(response).encode())
+					await writer.drain()
+					self.timings.append((request.get('Action', ''), response['Code'],
+										time.perf_counter() - received))
+		except ConnectionError:
+			pass
+		finally:
+			writer.close()
+
+	async def start(self, host: str, port: int):
+		'''Starts listening and returns the asyncio server'''
+		self.started = time.time()
+		return await asyncio.start_server(self.handle, host, port)
+
+	def get_stats(self) -> dict:
+		'''Returns the number of requests per action and code along with request rate and
+service time percentiles in milliseconds'''
+		elapsed = max(time.time() - self.started, 1e-9)
+		counts = dict()
+		for action, code, _ in self.timings:
+			key = '%s %s' % (action, code)
+			counts[key] = counts.get(key, 0) + 1
+
+		times = sorted(t for _, _, t in self.timings)
+		def pct(value):
+			if not times:
+				return 0.0
+			return times[min(len(times) - 1, int(len(times) * value))] * 1000
+
+		return { 'requests':len(times), 'connections':self.connections,
+				'rate':len(times) / elapsed, 'p50':pct(0.5), 'p99':pct(0.99), 'counts':counts }
+
+
+def start_in_thread(config: MockConfig, host: str = '127.0.0.1', port: int = 0):
+	'''Runs a mock server on its own event loop in a daemon thread. Returns the MockServer and
+the port it is listening on. Passing port 0 picks a free port.'''
+	server = MockServer(config)
+	ready = threading.Event()
+	result = dict()
+
+	def run():
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		listener = loop.run_until_complete(server.start(host, port))
+		result['port'] = listener.sockets[0].getsockname()[1]
+		ready.set()
+		loop.run_forever()
+
+	threading.Thread(target=run, name='smilodon-mockserver', daemon=True).start()
+	ready.wait()
+	return server, result['port']
+
+
+def main() -> int:
+	'''Parses arguments and runs the server until interrupted'''
+	parser = argparse.ArgumentParser(description='Mock Anselus server for load testing')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=2001)
+	parser.add_argument('--latency', type=float, default=0.0,
+		help='milliseconds to wait before each response')
+	parser.add_argument('--jitter', type=float, default=0.0,
+		help='random variation in milliseconds added to or subtracted from the latency')
+	parser.add_argument('--error-rate', type=float, default=0.0,
+		help='fraction of requests answered with 300 (internal server error)')
+	parser.add_argument('--status', action='append', default=list(),
+		metavar='ACTION=CODE[:P][,CODE[:P]...]',
+		help='answer a fraction P of requests for ACTION with CODE. May be repeated.')
+	parser.add_argument('--seed', type=int, help='random seed for repeatable runs')
+	parser.add_argument('--record', metavar='FILE',
+		help='write per-request timings to FILE as JSON on exit')
+	args = parser.parse_args()
+
+	statuses = dict()
+	try:
+		for option in args.status:
+			action, codes = parse_status_option(option)
+			statuses[action] = codes
+	except ValueError:
+		parser.error('bad --status option: %s' % option)
+
+	config = MockConfig(args.latency / 1000.0, args.jitter / 1000.0, args.error_rate, statuses,
+						args.seed)
+	server = MockServer(config)
+
+	async def serve():
+		listener = await server.start(args.host, args.port)
+		print('Mock server listening on %s:%s' % (args.host, args.port), file=sys.stderr)
+		async with listener:
+			await listener.serve_forever()
+
+	def terminate(signum, frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM, terminate)
+
+	try:
+		asyncio.run(serve())
+	except KeyboardInterrupt:
+		pass
+
+	stats = server.get_stats()
+	print('%s requests on %s connections, %.0f/s, p50 %.2fms, p99 %.2fms' % (stats['requests'],
+		stats['connections'], stats['rate'], stats['p50'], stats['p99']), file=sys.stderr)
+	for key in sorted(stats['counts']):
+		print('  %-20s %s' % (key, stats['counts'][key]), file=sys.stderr)
+
+	if args.record:
+		with open(args.record, 'w', encoding='utf-8') as handle:
+			json.dump({ 'stats':stats, 'requests':[ { 'action':a, 'code':c, 'seconds':t }
+						for a, c, t in server.timings ] }, handle)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
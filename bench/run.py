@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+'''Runs the Smilodon benchmark suite, saves the results as JSON, and optionally compares them
+against a saved baseline, exiting with status 1 if any metric regressed by more than the
+allowed threshold.
+
+Examples:
+python bench/run.py --output results.json
+python bench/run.py --suite completion --sizes 10,10000,100000
+python bench/run.py --baseline baseline.json --threshold 0.2'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SUITES = [ 'lexing', 'dispatch', 'completion', 'server', 'keycards' ]
+
+def run_suites(args) -> dict:
+	'''Runs the requested suites and returns their combined results'''
+	# Imported here so that argument errors are reported without loading the whole shell
+	import suites
+	from smilodon import Shell
+
+	shell = Shell()
+	results = dict()
+	for name in args.suite.split(','):
+		print('Running %s...' % name, file=sys.stderr)
+		if name == 'lexing':
+			results.update(suites.bench_lexing(shell, args.scale))
+		elif name == 'dispatch':
+			results.update(suites.bench_dispatch(shell, args.scale))
+		elif name == 'completion':
+			sizes = [ int(x) for x in args.sizes.split(',') ]
+			results.update(suites.bench_completion(shell, sizes))
+		elif name == 'server':
+			results.update(suites.bench_server(shell, args.scale, args.latency / 1000.0, args.jobs))
+		elif name == 'keycards':
+			results.update(suites.bench_keycards(args.scale, args.keycard_jobs))
+	return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+	'''Returns a list of (name, baseline value, current value, change) tuples for metrics which
+are worse than the baseline by more than the threshold, a fraction of the baseline value'''
+	regressions = list()
+	for name, base in baseline.items():
+		if name not in results or not base['value']:
+			continue
+		current = results[name]['value']
+		change = (current - base['value']) / base['value']
+		worse = -change if base['better'] == 'higher' else change
+		if worse > threshold:
+			regressions.append((name, base['value'], current, change))
+	return regressions
+
+
+def main() -> int:
+	'''Parses arguments, runs the benchmarks, and reports the results'''
+	parser = argparse.ArgumentParser(description='Smilodon benchmark runner',
+		epilog="The server suite runs commands against a mock server. Registration goes through "
+			"a stub client, so it measures the shell's overhead but not AnselusClient.")
+	parser.add_argument('--suite', default=','.join(SUITES),
+		help='comma-separated list of suites to run. Default: %s' % ','.join(SUITES))
+	parser.add_argument('--sizes', default='10,10000,100000',
+		help='comma-separated directory sizes for the completion suite')
+	parser.add_argument('--scale', type=float, default=1.0,
+		help='multiplier for the number of iterations and requests')
+	parser.add_argument('--latency', type=float, default=1.0,
+		help='mock server response delay in milliseconds for the server suite')
+	parser.add_argument('--jobs', type=int, default=8,
+		help='requests in flight for the server suite')
+	parser.add_argument('--keycard-jobs', type=int, default=0,
+		help='worker processes for the keycards suite. Default: one per CPU')
+	parser.add_argument('--output', help='file to write the JSON results to')
+	parser.add_argument('--baseline', help='JSON results file to compare against')
+	parser.add_argument('--threshold', type=float, default=0.15,
+		help='fraction by which a metric may be worse than the baseline. Default: 0.15')
+	args = parser.parse_args()
+
+	unknown = set(args.suite.split(',')) - set(SUITES)
+	if unknown:
+		parser.error('unknown suite: %s' % ', '.join(sorted(unknown)))
+
+	results = run_suites(args)
+	for name in sorted(results):
+		print('%-40s %14.3f %s' % (name, results[name]['value'], results[name]['unit']))
+
+	if args.output:
+		report = {
+			'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'results': results,
+		}
+		with open(args.output, 'w', encoding='utf-8') as handle:
+			json.dump(report, handle, indent=2, sort_keys=True)
+
+	if not args.baseline:
+		return 0
+
+	with open(args.baseline, encoding='utf-8') as handle:
+		baseline = json.load(handle)['results']
+
+	regressions = compare(results, baseline, args.threshold)
+	for name, before, after, change in regressions:
+		print('REGRESSION %s: %.3f -> %.3f (%+.1f%%)' % (name, before, after, change * 100))
+	if regressions:
+		return 1
+
+	print('No regressions beyond %.0f%% of the baseline' % (args.threshold * 100))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,34 @@
+'''Stand-in for AnselusClient used by the server throughput benchmarks. It answers the register
+command's call to the client library by sending a REGISTER request to a mock server over a single
+persistent serversession.ServerSession, so the benchmarks include real socket round trips. The
+password is sent as given instead of being hashed, and no device keys are made, so the time
+AnselusClient itself takes is not measured.'''
+
+import uuid
+
+from serversession import ServerSession, SessionStatus
+
+class StubClient:
+	'''Minimal client for the mock server in mockserver.py'''
+	def __init__(self, host: str, port: int):
+		self.session = ServerSession()
+		self.session.connect(host, port)
+
+	def register_account(self, server, password):
+		'''Registers a new workspace'''
+		response = self.session.request('REGISTER', { 'Workspace-ID':str(uuid.uuid4()),
+							'Password-Hash':password, 'Device-ID':str(uuid.uuid4()),
+							'Device-Key':'' })
+		status = SessionStatus(status=response['Code'], info=response['Status'])
+		if response['Code'] not in (101, 201):
+			status['error'] = '%s %s' % (response['Code'], response['Status'])
+		return status
+
+	def is_connected(self) -> bool:
+		'''Returns True if the connection is open'''
+		return self.session.is_connected()
+
+	def disconnect(self):
+		'''Closes the connection'''
+		self.session.disconnect()
+		return SessionStatus()
@@ -0,0 +1,256 @@
+'''Benchmarks for the hot paths of the shell. Each suite function returns a dictionary mapping a
+metric name to a dictionary with the keys value, unit, and better, which is either 'higher' or
+'lower'.'''
+
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from prompt_toolkit.completion import CompleteEvent
+from prompt_toolkit.document import Document
+
+from commandaccess import gCommandAccess
+from fscache import gDirCache
+from shellbase import BaseCommand
+import shellcommands
+from smilodon import Shell, ShellCompleter
+from tokenizer import IncrementalTokenizer, tokenize
+
+import mockserver
+from stubclient import StubClient
+
+SAMPLE_LINES = [
+	'ls',
+	'ls -l /usr/share/doc',
+	'profile create "Work Account"',
+	'preregister 2001 CatLover',
+	'preregister --from "New Users/october.csv" --out codes.csv --jobs 16 --resume',
+	'shell find . -name "*.py" -exec grep -l "import re" {} ;',
+	'help preregister profile register',
+]
+
+SCRIPT_LINES = [ 'help exit', 'jobs', 'connections', 'bogus', 'wait', 'help ls' ]
+
+
+def metric(value: float, unit: str, better: str) -> dict:
+	'''Creates a result entry'''
+	return { 'value':value, 'unit':unit, 'better':better }
+
+
+def percentile(values: list, pct: float) -> float:
+	'''Returns the specified percentile of a list of numbers using the nearest-rank method'''
+	ordered = sorted(values)
+	index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+	return ordered[index]
+
+
+def ops_per_second(func, iterations: int) -> float:
+	'''Calls func the specified number of times and returns the rate in calls per second'''
+	start = time.perf_counter()
+	for _ in range(iterations):
+		func()
+	return iterations / (time.perf_counter() - start)
+
+
+def bench_lexing(shell: Shell, scale: float) -> dict:
+	'''Throughput of tokenizing whole lines, of retokenizing a line after each keystroke, and
+of BaseCommand.parse_input'''
+	iterations = max(1, int(20000 * scale))
+	command = BaseCommand()
+
+	def full():
+		for line in SAMPLE_LINES:
+			tokenize(line)
+
+	def parse_input():
+		for line in SAMPLE_LINES:
+			command.parse_input(line)
+
+	# Typing the longest sample line one character at a time
+	typed = max(SAMPLE_LINES, key=len)
+	keystrokes = [ typed[:i] for i in range(1, len(typed) + 1) ]
+	incremental = IncrementalTokenizer()
+	def retokenize():
+		for line in keystrokes:
+			incremental.tokenize(line)
+
+	count = len(SAMPLE_LINES)
+	return {
+		'lex.tokenize': metric(ops_per_second(full, iterations) * count, 'lines/s', 'higher'),
+		'lex.keystroke': metric(ops_per_second(retokenize, max(1, iterations // 20)) * \
+								len(keystrokes), 'keystrokes/s', 'higher'),
+		'lex.parse_input': metric(ops_per_second(parse_input, iterations) * count, 'lines/s',
+								'higher'),
+	}
+
+
+def bench_dispatch(shell: Shell, scale: float) -> dict:
+	'''Throughput of command lookup and of running a scripted stream of commands'''
+	iterations = max(1, int(20000 * scale))
+	names = list(gCommandAccess.get_command_names()) + [ 'prer', 'prof', 'nosuchcommand' ]
+
+	def lookup():
+		for name in names:
+			gCommandAccess.get_command(name)
+
+	lookups = ops_per_second(lookup, iterations) * len(names)
+
+	script_iterations = max(1, int(2000 * scale))
+	with contextlib.redirect_stdout(io.StringIO()):
+		def run_script():
+			for line in SCRIPT_LINES:
+				shell.execute_line(line)
+		lines = ops_per_second(run_script, script_iterations) * len(SCRIPT_LINES)
+
+	return {
+		'dispatch.get_command': metric(lookups, 'lookups/s', 'higher'),
+		'dispatch.script': metric(lines, 'commands/s', 'higher'),
+	}
+
+
+def _make_tree(root: str, size: int) -> str:
+	'''Creates a directory containing the specified number of empty files and a few
+subdirectories, and returns its path'''
+	path = os.path.join(root, 'tree%s' % size)
+	os.mkdir(path)
+	for index in range(10):
+		os.mkdir(os.path.join(path, 'dir%02d' % index))
+	for index in range(max(0, size - 10)):
+		with open(os.path.join(path, 'file%07d' % index), 'w'):
+			pass
+
+	# Back-date the directory so the listing cache treats it as settled
+	settled = time.time() - 3600
+	os.utime(path, (settled, settled))
+	return path
+
+
+def bench_completion(shell: Shell, sizes: list) -> dict:
+	'''Per-keystroke completion latency while typing a path into trees of different sizes'''
+	completer = ShellCompleter(shell.state)
+	event = CompleteEvent(completion_requested=False)
+	results = dict()
+	root = tempfile.mkdtemp(prefix='smilodon-bench-')
+	try:
+		for size in sizes:
+			tree = _make_tree(root, size)
+			gDirCache.clear()
+			# Typing toward a directory, and typing a prefix shared by most of the entries
+			for label, target in [ ('dir', 'dir0'), ('file', 'file00001') ]:
+				line = 'ls %s/' % tree
+				latencies = list()
+				for char in target:
+					line += char
+					start = time.perf_counter()
+					for _ in completer.get_completions(Document(line), event):
+						pass
+					latencies.append((time.perf_counter() - start) * 1000)
+
+				results['complete.%s.%s.first' % (label, size)] = metric(latencies[0], 'ms',
+																			'lower')
+				results['complete.%s.%s.p50' % (label, size)] = metric(
+					percentile(latencies, 50), 'ms', 'lower')
+				results['complete.%s.%s.p99' % (label, size)] = metric(
+					percentile(latencies, 99), 'ms', 'lower')
+			shutil.rmtree(tree)
+	finally:
+		shutil.rmtree(root, ignore_errors=True)
+		gDirCache.clear()
+	return results
+
+
+def bench_server(shell: Shell, scale: float, latency: float, jobs: int) -> dict:
+	'''Throughput of the preregister command in bulk mode and of the register command against a
+local mock server, along with the server-side service time. Both run through Shell.execute_line,
+so argument parsing, dispatch, the connection pool, and rate control are included. register is
+given StubClient in place of AnselusClient and a fixed passphrase in place of the prompt, so this
+measures the shell's overhead and not the client library's.'''
+	rows = max(1, int(2000 * scale))
+	server, port = mockserver.start_in_thread(mockserver.MockConfig(latency))
+	workdir = tempfile.mkdtemp(prefix='smilodon-bench-')
+	try:
+		inpath = os.path.join(workdir, 'users.csv')
+		with open(inpath, 'w', encoding='utf-8') as handle:
+			handle.write('user_id\n')
+			for index in range(rows):
+				handle.write('user%s\n' % index)
+
+		line = 'preregister %s --from "%s" --out "%s" --jobs %s' % (port, inpath,
+			os.path.join(workdir, 'codes.csv'), jobs)
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			error = shell.execute_line(line)
+			prereg_rate = rows / (time.perf_counter() - start)
+		if error:
+			raise RuntimeError(error)
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+		shell.state.connections.close_all()
+
+	client = shell.state.client
+	original_getpass = shellcommands.getpass
+	shell.state.client = StubClient('127.0.0.1', port)
+	shellcommands.getpass = lambda prompt='Password: ': 'Correct-Horse-Battery-Staple-42'
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			for _ in range(rows):
+				error = shell.execute_line('register localhost')
+				if error:
+					raise RuntimeError(error)
+			register_rate = rows / (time.perf_counter() - start)
+	finally:
+		shell.state.client.disconnect()
+		shell.state.client = client
+		shellcommands.getpass = original_getpass
+
+	stats = server.get_stats()
+	return {
+		'server.preregister': metric(prereg_rate, 'requests/s', 'higher'),
+		'server.register': metric(register_rate, 'requests/s', 'higher'),
+		'server.service.p50': metric(stats['p50'], 'ms', 'lower'),
+		'server.service.p99': metric(stats['p99'], 'ms', 'lower'),
+	}
+
+
+def bench_keycards(scale: float, jobs: int) -> dict:
+	'''Throughput of batch signing test keycards and of verifying them, both the first time and
+again once the verifier has remembered them'''
+	# Loading keycards loads PyNaCl, which the other suites don't need
+	import keycards
+
+	count = max(1, int(1000 * scale))
+	length = 3
+	signatures = count * (length * 2 - 1)
+	folder = tempfile.mkdtemp(prefix='smilodon-bench-')
+	try:
+		elapsed = keycards.generate_keycards(folder, count, length, jobs)
+		chains, errors = keycards.read_keycards(keycards.find_keycards(folder))
+		if errors:
+			raise RuntimeError('%s: %s' % errors[0])
+
+		verifier = keycards.KeycardVerifier()
+		start = time.perf_counter()
+		results = verifier.verify_chains(chains, jobs)
+		verify_time = time.perf_counter() - start
+		failed = [ r for r in results if r.error ]
+		if failed:
+			raise RuntimeError('%s: %s' % (failed[0].name, failed[0].error))
+
+		start = time.perf_counter()
+		verifier.verify_chains(chains, jobs)
+		cached_time = time.perf_counter() - start
+	finally:
+		shutil.rmtree(folder, ignore_errors=True)
+		keycards.shutdown_pool()
+
+	return {
+		'keycards.sign': metric(signatures / max(elapsed, 1e-9), 'signatures/s', 'higher'),
+		'keycards.verify': metric(signatures / max(verify_time, 1e-9), 'signatures/s',
+								'higher'),
+		'keycards.verify_cached': metric(count / max(cached_time, 1e-9), 'keycards/s',
+										'higher'),
+	}
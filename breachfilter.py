@@ -0,0 +1,230 @@
+'''Offline checking of passphrases against lists of breached passwords.
+
+A list of SHA-1 password hashes, such as the one published by Have I Been Pwned, is compiled into
+a Bloom filter file. The filter is memory-mapped when it is checked, so only the handful of pages
+a lookup touches are ever read from disk and the list does not need to fit in memory. A Bloom
+filter can report a password which is not in the list -- at the rate chosen when it is built --
+but never misses one which is.
+
+Building a filter:
+	python breachfilter.py build pwned-passwords-sha1.txt breached.bloom --fp-rate 0.001
+
+Each line of the hash list starts with a hex SHA-1 hash. Anything after the hash, such as the
+':count' suffix in the HIBP lists, is ignored. Shell commands find the filter using the
+SMILODON_BREACH_FILTER environment variable or, if it is not set, DEFAULT_FILTER_PATH.'''
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+FILTER_MAGIC = b'SMBLOOM1'
+
+# Magic, size of the filter in bits, number of hash functions, number of entries added
+HEADER_FORMAT = '<8sQQQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+DEFAULT_FILTER_PATH = os.path.join(os.path.expanduser('~'), '.config', 'smilodon',
+									'breached.bloom')
+
+def get_filter_size(entries: int, fp_rate: float) -> tuple:
+	'''Returns the number of bits and hash functions for a filter holding the specified number of
+entries with the specified false positive rate'''
+	entries = max(entries, 1)
+	bits = math.ceil(-entries * math.log(fp_rate) / (math.log(2) ** 2))
+	bits = max(((bits + 7) // 8) * 8, 64)
+	hashes = max(1, round(bits / entries * math.log(2)))
+	return bits, hashes
+
+
+def _get_bit_indexes(digest: bytes, bits: int, hashes: int):
+	'''Yields the bit positions for a SHA-1 digest. The digest is already uniformly distributed,
+so two halves of it are combined by double hashing instead of hashing again.'''
+	h1 = int.from_bytes(digest[0:8], 'little')
+	h2 = int.from_bytes(digest[8:16], 'little') | 1
+	for i in range(hashes):
+		yield (h1 + i * h2) % bits
+
+
+def _read_digests(path: str):
+	'''Yields the SHA-1 digests in a hash list, skipping lines which don't start with one'''
+	with open(path, 'rb') as handle:
+		for line in handle:
+			try:
+				digest = bytes.fromhex(line[:40].decode('ascii'))
+			except ValueError:
+				continue
+			if len(digest) == 20:
+				yield digest
+
+
+def _count_lines(path: str) -> int:
+	count = 0
+	with open(path, 'rb') as handle:
+		for block in iter(lambda: handle.read(1 << 20), b''):
+			count += block.count(b'\n')
+	return count
+
+
+def build_filter(inpath: str, outpath: str, fp_rate: float = 0.001, entries: int = 0,
+				progress=None) -> int:
+	'''Compiles a hash list into a filter file. The number of entries is counted from the list
+unless given. The filter is written through a memory map, so building one larger than available
+memory works, if slowly. progress, if given, is called with the number of hashes added every
+million hashes. Returns the number of hashes added.'''
+	if not entries:
+		entries = _count_lines(inpath)
+	bits, hashes = get_filter_size(entries, fp_rate)
+
+	temppath = outpath + '.tmp'
+	with open(temppath, 'w+b') as handle:
+		handle.write(struct.pack(HEADER_FORMAT, FILTER_MAGIC, bits, hashes, 0))
+		handle.truncate(HEADER_SIZE + bits // 8)
+		handle.flush()
+
+		with mmap.mmap(handle.fileno(), 0) as mapped:
+			added = 0
+			for digest in _read_digests(inpath):
+				for index in _get_bit_indexes(digest, bits, hashes):
+					mapped[HEADER_SIZE + (index >> 3)] |= 1 << (index & 7)
+				added += 1
+				if progress and added % 1000000 == 0:
+					progress(added)
+
+			mapped[0:HEADER_SIZE] = struct.pack(HEADER_FORMAT, FILTER_MAGIC, bits, hashes, added)
+			mapped.flush()
+
+	os.replace(temppath, outpath)
+	return added
+
+
+class BreachFilter:
+	'''A memory-mapped Bloom filter of breached password hashes. Lookups are safe to make from
+multiple threads.'''
+	def __init__(self, path: str):
+		self.path = path
+		with open(path, 'rb') as handle:
+			self.mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if len(self.mapped) < HEADER_SIZE:
+			self.mapped.close()
+			raise ValueError('%s is not a breached password filter' % path)
+
+		magic, self.bits, self.hashes, self.entries = struct.unpack(HEADER_FORMAT,
+			self.mapped[0:HEADER_SIZE])
+		if magic != FILTER_MAGIC or len(self.mapped) < HEADER_SIZE + self.bits // 8:
+			self.mapped.close()
+			raise ValueError('%s is not a breached password filter' % path)
+
+	def close(self):
+		'''Unmaps the filter file'''
+		self.mapped.close()
+
+	def contains_digest(self, digest: bytes) -> bool:
+		'''Returns True if the SHA-1 digest is probably in the list and False if it definitely
+is not'''
+		mapped = self.mapped
+		for index in _get_bit_indexes(digest, self.bits, self.hashes):
+			if not mapped[HEADER_SIZE + (index >> 3)] & (1 << (index & 7)):
+				return False
+		return True
+
+	def contains_password(self, password: str) -> bool:
+		'''Returns True if the password is probably in the list and False if it definitely is not'''
+		return self.contains_digest(hashlib.sha1(password.encode('utf-8')).digest())
+
+
+_gFilterLock = threading.Lock()
+_gFilter = None
+_gFilterPath = ''
+
+def get_breach_filter():
+	'''Returns the BreachFilter configured for this user or None if there isn't one. The filter
+is opened once and shared.'''
+	global _gFilter, _gFilterPath
+	path = os.getenv('SMILODON_BREACH_FILTER', DEFAULT_FILTER_PATH)
+	with _gFilterLock:
+		if _gFilter is not None and _gFilterPath == path:
+			return _gFilter
+		if not os.path.isfile(path):
+			return None
+
+		if _gFilter is not None:
+			_gFilter.close()
+		_gFilter = BreachFilter(path)
+		_gFilterPath = path
+		return _gFilter
+
+
+def is_password_breached(password: str) -> bool:
+	'''Returns True if the password appears in the breached password filter. If no filter has
+been installed, no password is considered breached.'''
+	breachFilter = get_breach_filter()
+	if breachFilter is None:
+		return False
+	return breachFilter.contains_password(password)
+
+
+def main():
+	'''Command-line interface for building and testing filters'''
+	parser = argparse.ArgumentParser(description='Breached password filter tool')
+	subparsers = parser.add_subparsers(dest='action')
+	subparsers.required = True
+
+	build = subparsers.add_parser('build', help='compile a SHA-1 hash list into a filter')
+	build.add_argument('hashlist', help='file with one hex SHA-1 hash per line')
+	build.add_argument('filter', help='filter file to create')
+	build.add_argument('--fp-rate', type=float, default=0.001,
+						help='false positive rate for the filter (default 0.001)')
+	build.add_argument('--entries', type=int, default=0,
+						help='expected number of hashes, if known, to skip counting the list')
+
+	check = subparsers.add_parser('check', help='check passwords against a filter')
+	check.add_argument('filter', help='filter file to check against')
+	check.add_argument('passwords', nargs='*',
+						help='passwords to check. Read from standard input if none are given.')
+
+	args = parser.parse_args()
+
+	if args.action == 'build':
+		if not 0.0 < args.fp_rate < 1.0:
+			print('The false positive rate must be between 0 and 1', file=sys.stderr)
+			return 1
+
+		start = time.perf_counter()
+		added = build_filter(args.hashlist, args.filter, args.fp_rate, args.entries,
+							lambda count: print('%s hashes added' % count, file=sys.stderr))
+		breachFilter = BreachFilter(args.filter)
+		print('%s hashes added in %.1fs. Filter size: %s bytes, %s hash functions.' % \
+			(added, time.perf_counter() - start, breachFilter.bits // 8, breachFilter.hashes))
+		breachFilter.close()
+		return 0
+
+	try:
+		breachFilter = BreachFilter(args.filter)
+	except (OSError, ValueError) as e:
+		print(e, file=sys.stderr)
+		return 1
+
+	passwords = args.passwords
+	if not passwords:
+		passwords = [ line.rstrip('\r\n') for line in sys.stdin ]
+
+	found = 0
+	for password in passwords:
+		if breachFilter.contains_password(password):
+			print('%s: breached' % password)
+			found += 1
+		else:
+			print('%s: not found' % password)
+	breachFilter.close()
+	return 1 if found else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
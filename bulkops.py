@@ -0,0 +1,150 @@
+'''Implements bulk operations which issue large numbers of server requests, such as
+provisioning workspaces for an entire organization from a CSV file'''
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import csv
+import os
+
+import ratecontrol
+
+def run_windowed(items, func, max_in_flight: int):
+	'''Calls func on each item from an iterable, keeping up to max_in_flight calls outstanding
+at once. Items are pulled from the iterable only as room opens up in the window, so input of any
+size is consumed with bounded memory. Yields (item, result, exception) tuples in the order calls
+finish. If the caller closes the generator, no new calls are issued and outstanding ones are
+allowed to finish.'''
+	max_in_flight = max(1, max_in_flight)
+	source = iter(items)
+	with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+		pending = dict()
+		exhausted = False
+		try:
+			while True:
+				while not exhausted and len(pending) < max_in_flight:
+					try:
+						item = next(source)
+					except StopIteration:
+						exhausted = True
+						break
+					pending[pool.submit(func, item)] = item
+
+				if not pending:
+					return
+
+				done, _ = wait(pending, return_when=FIRST_COMPLETED)
+				for future in done:
+					item = pending.pop(future)
+					exc = future.exception()
+					if exc:
+						yield item, None, exc
+					else:
+						yield item, future.result(), None
+		finally:
+			wait(pending)
+
+
+def _read_user_rows(inpath: str, start_row: int, skip_rows: set):
+	'''Generator which yields (row_number, user_id) pairs from a CSV file. The user ID is taken
+from the first column. A header row whose first cell is "user_id" and rows which are empty or
+hold only whitespace are skipped and do not count as rows. Rows are numbered from 1.'''
+	with open(inpath, newline='', encoding='utf-8') as handle:
+		row_number = 0
+		for fields in csv.reader(handle):
+			if not any([ f.strip() for f in fields ]):
+				continue
+			if row_number == 0 and fields[0].strip().casefold() == 'user_id':
+				continue
+			row_number += 1
+			if row_number < start_row or row_number in skip_rows:
+				continue
+
+			yield row_number, fields[0].strip()
+
+
+def _read_completed_rows(outpath: str) -> set:
+	'''Returns the row numbers from an existing output file which were successfully
+preregistered'''
+	completed = set()
+	if not os.path.exists(outpath):
+		return completed
+
+	with open(outpath, newline='', encoding='utf-8') as handle:
+		for record in csv.DictReader(handle):
+			if record.get('workspace_id') and record.get('row', '').isdigit():
+				completed.add(int(record['row']))
+	return completed
+
+
+OUTPUT_FIELDS = [ 'row', 'user_id', 'workspace_id', 'regcode', 'error' ]
+
+def preregister_from_csv(pool, port: int, inpath: str, outpath: str, jobs: int = 8,
+						start_row: int = 1, resume: bool = False,
+						stop_on_error: bool = False, limiter=None) -> dict:
+	'''Preregisters a workspace for each row of a CSV file, writing the resulting workspace IDs
+and registration codes to another CSV file as they arrive. Up to the number of requests
+specified by jobs are kept in flight at once, each sent over a serversession.ServerSession for
+localhost and the port, borrowed from the connpool.ConnectionPool given. If a
+ratecontrol.ServerLimiter is given, it adjusts the number in flight below that to what the server
+can sustain.
+
+Failed rows are written to the output file with the reason in the error column. When resume is
+True, rows which already have a workspace ID in the output file are skipped and new results are
+appended, so rerunning the same command retries only the rows which failed or were never sent.
+
+Returns a dictionary containing the counts 'sent', 'succeeded', and 'failed' and a sorted list
+of failed row numbers in 'failed_rows'.'''
+	completed = _read_completed_rows(outpath) if resume else set()
+	address = 'localhost:%s' % port
+
+	def send(row):
+		with pool.borrow(address) as session:
+			if limiter is None:
+				return session.preregister(row[1])
+			return limiter.call(lambda: session.preregister(row[1]),
+				ratecontrol.is_overload_status)
+
+	# Setting this stops new rows from being sent. Requests already in flight are still
+	# collected so that no issued registration code is lost.
+	stopping = list()
+	def rows():
+		for row in _read_user_rows(inpath, start_row, completed):
+			if stopping:
+				return
+			yield row
+
+	summary = { 'sent':0, 'succeeded':0, 'failed':0, 'failed_rows':list() }
+	append = resume and os.path.exists(outpath)
+	# Each request in flight holds a session, so the pool must allow that many
+	with pool.reserve(jobs), \
+			open(outpath, 'a' if append else 'w', newline='', encoding='utf-8') as handle:
+		writer = csv.DictWriter(handle, fieldnames=OUTPUT_FIELDS)
+		if not append:
+			writer.writeheader()
+
+		for row, status, exc in run_windowed(rows(), send, jobs):
+			summary['sent'] += 1
+			record = { 'row':row[0], 'user_id':row[1], 'workspace_id':'', 'regcode':'',
+						'error':'' }
+			if exc:
+				record['error'] = str(exc)
+			elif status['status'] != 200:
+				record['error'] = '%s: %s' % (status['status'], status.info())
+			else:
+				record['workspace_id'] = status['wid']
+				record['regcode'] = status['regcode']
+				if status['uid']:
+					record['user_id'] = status['uid']
+
+			writer.writerow(record)
+			handle.flush()
+
+			if record['error']:
+				summary['failed'] += 1
+				summary['failed_rows'].append(row[0])
+				if stop_on_error:
+					stopping.append(row[0])
+			else:
+				summary['succeeded'] += 1
+
+	summary['failed_rows'].sort()
+	return summary
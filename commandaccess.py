@@ -1,52 +1,191 @@
+from bisect import bisect_left, insort
+import importlib
 import sys
 
-import shellcommands 
+from shellbase import gShellCommands
+
+class CommandEntry:
+	'''Lightweight record describing a command. The module containing the command class is not
+imported and the command object is not created until it is dispatched or its help is requested.'''
+	def __init__(self, name: str, class_name: str, description: str, aliases=None,
+				module_name='shellcommands', instance=None):
+		self.name = name
+		self.class_name = class_name
+		self.description = description
+		self.aliases = aliases if aliases else dict()
+		self.module_name = module_name
+		self.instance = instance
+
+	def get_aliases(self):
+		'''Returns a dictionary of alternative names for the command'''
+		return self.aliases
+
+	def get_description(self):
+		'''Returns a description of the command'''
+		return self.description
+
+	def get_help(self):
+		'''Returns help information for the command'''
+		return self.get_instance().get_help()
+
+	def get_name(self):
+		'''Returns the command's name'''
+		return self.name
+
+	def get_instance(self):
+		'''Returns the command object, importing and instantiating it on first use. If the object
+disagrees with the entry, the difference is reported on stderr.'''
+		if self.instance is None:
+			self.instance = self.load()
+			mismatch = self.find_mismatch()
+			if mismatch:
+				print(mismatch, file=sys.stderr)
+		return self.instance
+
+	def load(self):
+		'''Imports the command's module and returns a new command object'''
+		module = importlib.import_module(self.module_name)
+		return getattr(module, self.class_name)()
+
+	def find_mismatch(self) -> str:
+		'''Returns a description of the first way in which the command object's name, aliases, or
+description differ from the entry's, or an empty string if they agree. The object must have been
+created.'''
+		for field, expected, actual in [ ('name', self.name, self.instance.get_name()),
+				('aliases', self.aliases, self.instance.get_aliases()),
+				('description', self.description, self.instance.get_description()) ]:
+			if expected != actual:
+				return 'Mismatched %s for %s: %r in gBuiltinCommands but %r in %s' % (field,
+					self.name, expected, actual, self.class_name)
+		return ''
+
+
+# Metadata for the built-in commands. The name, aliases, and description must match those set
+# by the command class itself. Each entry is compared with its command object when the object is
+# created, and CommandAccess.check_entries() compares all of them.
+gBuiltinCommands = [
+	CommandEntry('chdir', 'CommandChDir', 'change directory/location', { "cd":"chdir" }),
+	CommandEntry('ls', 'CommandListDir', 'list directory contents', { "dir":"ls" }),
+	CommandEntry('count', 'CommandCount', 'Count lines from a pipe'),
+	CommandEntry('filter', 'CommandFilter', 'Keep lines from a pipe which match',
+		{ "grep":"filter" }),
+	CommandEntry('head', 'CommandHead', 'Keep the first lines from a pipe'),
+	CommandEntry('sort', 'CommandSort', 'Sort lines from a pipe'),
+	CommandEntry('exit', 'CommandExit', 'Exits the shell', { "x":"exit", "q":"exit" }),
+	CommandEntry('group', 'CommandGroup', 'Manage named groups of servers'),
+	CommandEntry('help', 'CommandHelp', 'Show help on a command', { "?":"help" }),
+	CommandEntry('shell', 'CommandShell', 'Run a shell command', { "sh":"shell", "`":"shell" }),
+	CommandEntry('history', 'CommandHistory', 'Show previously entered commands'),
+	CommandEntry('jobs', 'CommandJobs', 'List commands running in the background'),
+	CommandEntry('wait', 'CommandWait', 'Wait for background commands to finish', { "fg":"wait" }),
+
+	CommandEntry('on', 'CommandOn', 'Run a command against several servers'),
+	CommandEntry('cache', 'CommandCache', 'Show or clear cached lookups'),
+	CommandEntry('connections', 'CommandConnections', 'Show open server sessions'),
+	CommandEntry('preregister', 'CommandPreregister', 'Preregister a new account for someone.'),
+	CommandEntry('profile', 'CommandProfile', 'Manage profiles.'),
+	CommandEntry('ratelimit', 'CommandRateLimit', 'Show or cap request rates to servers'),
+	CommandEntry('register', 'CommandRegister', 'Register a new account on the connected server.'),
+	CommandEntry('timing', 'CommandTiming', 'Measure where command time goes'),
+	CommandEntry('setuser_id', 'CommandSetUserID', 'Set user id for workspace'),
+]
 
 class CommandAccess:
 	'''The CommandAccess houses all available command objects'''
 	def __init__(self):
 		self.aliases = dict()
+
+		# Sorted list of all command names and aliases. Prefix lookups are a binary search for
+		# the first name not less than the prefix followed by a scan over the matches.
 		self.all_names = list()
 
-		self.add_command(shellcommands.CommandListDir())
-		self.add_command(shellcommands.CommandExit())
-		self.add_command(shellcommands.CommandHelp())
-		self.add_command(shellcommands.CommandShell())
+		for entry in gBuiltinCommands:
+			error = self.add_command(entry)
+			if error:
+				print(error)
 
-		self.add_command(shellcommands.CommandPreregister())
-		self.add_command(shellcommands.CommandProfile())
-		self.add_command(shellcommands.CommandRegister())
-		self.add_command(shellcommands.CommandSetUserID())
+	def add_command(self, pCommand) -> str:
+		'''Add a CommandEntry or a Command instance to the list. An error string is returned if 
+its name or one of its aliases is already in use, in which case nothing is added.'''
+		if not isinstance(pCommand, CommandEntry):
+			pCommand = CommandEntry(pCommand.get_name(), type(pCommand).__name__,
+						pCommand.get_description(), pCommand.get_aliases(),
+						type(pCommand).__module__, pCommand)
 
-		self.all_names.sort()
+		name = pCommand.get_name()
+		if name in gShellCommands or name in self.aliases:
+			return "Error duplicate command %s" % name
+		
+		for k in pCommand.get_aliases():
+			if k in self.aliases:
+				return "Error duplicate alias %s. Already exists for %s" % (k, self.aliases[k])
+			if k in gShellCommands:
+				return "Error alias %s is already the name of a command" % k
 
-	def add_command(self, pCommand):
-		'''Add a Command instance to the list'''
-		shellcommands.gShellCommands[pCommand.get_name()] = pCommand
-		self.all_names.append(pCommand.get_name())
+		gShellCommands[name] = pCommand
+		insort(self.all_names, name)
 		for k,v in pCommand.get_aliases().items():
-			if k in self.aliases:
-				print("Error duplicate alias %s. Already exists for %s" %
-						(k, self.aliases[k]) )
-				sys.exit(0)
 			self.aliases[k] = v
-			self.all_names.append(k)
+			insort(self.all_names, k)
+		return ''
+
+	def check_entries(self) -> list:
+		'''Creates every command object and returns a list of the ways in which they disagree with
+their entries. This imports all of the command modules, so it is only worth doing in a process
+which will run many commands, such as the daemon.'''
+		errors = list()
+		for entry in gShellCommands.values():
+			if isinstance(entry, CommandEntry):
+				if entry.instance is None:
+					entry.instance = entry.load()
+				mismatch = entry.find_mismatch()
+				if mismatch:
+					errors.append(mismatch)
+		return errors
+
+	def resolve_name(self, pName) -> str:
+		'''Returns the name of the command referred to by a name, an alias, or a prefix of either 
+which matches only one command. An empty string is returned if there is no such command.'''
+		if pName in self.aliases:
+			return self.aliases[pName]
+
+		if pName in gShellCommands:
+			return pName
+
+		matches = set()
+		for name in self.get_command_names(pName):
+			matches.add(self.aliases.get(name, name))
+			if len(matches) > 1:
+				return ''
+		
+		if matches:
+			return matches.pop()
+		return ''
 
 	def get_command(self, pName):
-		'''Retrives a Command instance for the specified name, including alias resolution.'''
+		'''Retrives a Command instance for the specified name, including alias and unique prefix 
+resolution. Command objects hold no per-call state, so the same instance is returned to all 
+callers.'''
 		if len(pName) < 1:
-			return shellcommands.CommandEmpty()
+			return importlib.import_module('shellcommands').CommandEmpty()
 
-		if pName in self.aliases:
-			pName = self.aliases[pName]
+		pName = self.resolve_name(pName)
+		if pName:
+			return gShellCommands[pName].get_instance()
 
-		if pName in shellcommands.gShellCommands:
-			return shellcommands.gShellCommands[pName]
+		return importlib.import_module('shellcommands').CommandUnrecognized()
 
-		return shellcommands.CommandUnrecognized()
+	def get_command_names(self, prefix=''):
+		'''Get the names of all available commands, or of those starting with the prefix 
+given'''
+		if not prefix:
+			return self.all_names
 
-	def get_command_names(self):
-		'''Get the names of all available commands'''
-		return self.all_names
+		out = list()
+		index = bisect_left(self.all_names, prefix)
+		while index < len(self.all_names) and self.all_names[index].startswith(prefix):
+			out.append(self.all_names[index])
+			index += 1
+		return out
 
 gCommandAccess = CommandAccess()
@@ -0,0 +1,158 @@
+'''Schedules completion work so that typing never waits behind completions which are out of date.
+
+prompt_toolkit asks for completions on every keystroke. Each request is given a generation number
+and a time budget. When a newer request arrives, older ones which haven't started are dropped
+and those which are running stop at the next candidate they produce. A request which runs past
+its budget stops the same way and shows the candidates found so far. Commands whose
+autocomplete methods are generators therefore have their candidates shown as they are found and
+can be cut short; those which return a list are all-or-nothing.'''
+
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from prompt_toolkit.completion import Completer
+
+# Seconds allowed for completions shown while typing and for those the user asked for with Tab
+TYPING_BUDGET = 0.1
+REQUESTED_BUDGET = 1.0
+
+# Completions are passed from the worker thread to the prompt in groups of up to this many
+BATCH_SIZE = 64
+
+class CompletionStats:
+	'''Counters for what happened to completion requests. requested counts every request.
+Requests which finish are counted as completed. dropped counts those which were out of date
+before they started, cancelled those which became out of date while running, and over_budget
+those which ran out of time.'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.requested = 0
+		self.completed = 0
+		self.dropped = 0
+		self.cancelled = 0
+		self.over_budget = 0
+
+	def add(self, counter: str):
+		'''Increments one of the counters'''
+		with self.lock:
+			setattr(self, counter, getattr(self, counter) + 1)
+
+	def get_counts(self) -> dict:
+		'''Returns the counters as a dictionary'''
+		with self.lock:
+			return {
+				'requested':self.requested,
+				'completed':self.completed,
+				'dropped':self.dropped,
+				'cancelled':self.cancelled,
+				'over_budget':self.over_budget,
+			}
+
+
+class CompletionRequest:
+	'''One request for completions'''
+	def __init__(self, scheduler, generation: int, budget: float):
+		self.scheduler = scheduler
+		self.generation = generation
+		self.deadline = time.monotonic() + budget
+		self.abandoned = False
+
+	def is_superseded(self) -> bool:
+		'''Returns True if a newer request has been made or nobody is waiting for this one'''
+		return self.abandoned or self.generation != self.scheduler.generation
+
+	def is_over_budget(self) -> bool:
+		'''Returns True if the request has used up its time'''
+		return time.monotonic() > self.deadline
+
+
+class CompletionScheduler(Completer):
+	'''Runs another Completer on worker threads under the rules described for this module. It
+takes the place of prompt_toolkit's ThreadedCompleter.'''
+	def __init__(self, completer: Completer, stats: CompletionStats = None,
+				typing_budget: float = TYPING_BUDGET, requested_budget: float = REQUESTED_BUDGET):
+		self.completer = completer
+		self.stats = stats if stats else CompletionStats()
+		self.typing_budget = typing_budget
+		self.requested_budget = requested_budget
+		self.generation = 0
+		self.lock = threading.Lock()
+
+		# Two workers so that a request stuck in a slow filesystem call doesn't hold up the next
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2,
+			thread_name_prefix='completion')
+
+	def new_request(self, complete_event) -> CompletionRequest:
+		'''Starts a new generation and returns a request for it'''
+		with self.lock:
+			self.generation += 1
+			generation = self.generation
+		self.stats.add('requested')
+
+		if complete_event.completion_requested:
+			budget = self.requested_budget
+		else:
+			budget = self.typing_budget
+		return CompletionRequest(self, generation, budget)
+
+	def run(self, request: CompletionRequest, document, complete_event, deliver):
+		'''Gets completions for a request, passing them to deliver in lists. deliver is called
+with None when there are no more.'''
+		if request.is_superseded():
+			self.stats.add('dropped')
+			deliver(None)
+			return
+
+		batch = list()
+		outcome = 'completed'
+		try:
+			for completion in self.completer.get_completions(document, complete_event):
+				if request.is_superseded():
+					outcome = 'cancelled'
+					break
+				batch.append(completion)
+				if len(batch) >= BATCH_SIZE:
+					deliver(batch)
+					batch = list()
+				if request.is_over_budget():
+					outcome = 'over_budget'
+					break
+		finally:
+			self.stats.add(outcome)
+			if batch and outcome != 'cancelled':
+				deliver(batch)
+			deliver(None)
+
+	def get_completions(self, document, complete_event):
+		request = self.new_request(complete_event)
+		completions = list()
+		self.run(request, document, complete_event,
+			lambda batch: completions.extend(batch) if batch else None)
+		return completions
+
+	async def get_completions_async(self, document, complete_event):
+		request = self.new_request(complete_event)
+		loop = asyncio.get_running_loop()
+		queue = asyncio.Queue()
+
+		def deliver(batch):
+			try:
+				loop.call_soon_threadsafe(queue.put_nowait, batch)
+			except RuntimeError:
+				# The event loop has closed
+				pass
+
+		loop.run_in_executor(self.executor, self.run, request, document, complete_event,
+							deliver)
+		try:
+			while True:
+				batch = await queue.get()
+				if batch is None:
+					break
+				for completion in batch:
+					yield completion
+		finally:
+			# prompt_toolkit stops reading when the text changes, so there is nobody to deliver to
+			request.abandoned = True
@@ -0,0 +1,191 @@
+'''Implements a pool of server sessions so that commands talking to the same server can reuse a
+session instead of paying for a new connection each time'''
+
+import contextlib
+import threading
+import time
+
+class PooledConnection:
+	'''A client session held by the pool along with its usage information'''
+	def __init__(self, address: str, client):
+		self.address = address
+		self.client = client
+		self.created = time.time()
+		self.last_used = self.created
+		self.last_checked = self.created
+		self.requests = 0
+		self.in_use = False
+
+	def get_age(self) -> float:
+		'''Returns the number of seconds since the session was created'''
+		return time.time() - self.created
+
+	def get_idle_time(self) -> float:
+		'''Returns the number of seconds since the session was last returned to the pool'''
+		if self.in_use:
+			return 0.0
+		return time.time() - self.last_used
+
+
+def _is_healthy(client) -> bool:
+	return client.is_connected()
+
+
+def _close(client):
+	client.disconnect()
+
+
+class ConnectionPool:
+	'''Thread-safe pool of client sessions keyed by server address.
+
+Sessions are created by calling factory with the server address. Idle sessions are closed
+after idle_timeout seconds and no more than max_connections sessions are open at once. A
+session which has been idle for more than check_interval seconds is checked with health_check
+before being handed out and replaced if the check fails. If a tracing.Tracer is given, the time
+each session is lent out is recorded as a network span.'''
+	def __init__(self, factory, max_connections: int = 16, idle_timeout: float = 300.0,
+				check_interval: float = 30.0, health_check=_is_healthy, close=_close,
+				tracer=None):
+		self.factory = factory
+		self.max_connections = max_connections
+		self.idle_timeout = idle_timeout
+		self.check_interval = check_interval
+		self.health_check = health_check
+		self.close = close
+		self.tracer = tracer
+		self.connections = list()
+		self.condition = threading.Condition()
+
+		# Session counts callers have reserved with reserve(). The pool allows as many sessions
+		# as the largest of these, if that is more than max_connections.
+		self.reservations = list()
+
+	def get_limit(self) -> int:
+		'''Returns the number of sessions which may be open at once'''
+		with self.condition:
+			return max([ self.max_connections ] + self.reservations)
+
+	@contextlib.contextmanager
+	def reserve(self, count: int):
+		'''Context manager which lets the pool open at least count sessions while it is in
+effect, for callers which borrow that many at once, such as bulk operations'''
+		with self.condition:
+			self.reservations.append(count)
+		try:
+			yield
+		finally:
+			with self.condition:
+				self.reservations.remove(count)
+
+	@contextlib.contextmanager
+	def borrow(self, address: str):
+		'''Context manager which lends a session for the specified server to the caller. If all
+sessions are in use and the pool is full, this waits for one to be returned.'''
+		if self.tracer:
+			span = self.tracer.span('network', address)
+		else:
+			span = contextlib.nullcontext()
+
+		with span:
+			conn = self._acquire(address)
+			try:
+				yield conn.client
+			except BaseException:
+				# The session may be left partway through a request, so it isn't lent out again
+				with self.condition:
+					conn.in_use = False
+					self._discard(conn)
+				raise
+			self._release(conn)
+
+	def _acquire(self, address: str) -> PooledConnection:
+		with self.condition:
+			while True:
+				self._evict_idle()
+				for conn in self.connections:
+					if conn.address == address and not conn.in_use:
+						conn.in_use = True
+						break
+				else:
+					conn = None
+
+				if conn:
+					if self._check(conn):
+						conn.requests += 1
+						return conn
+					self._discard(conn)
+					continue
+
+				if len(self.connections) >= max([ self.max_connections ] + self.reservations):
+					# Make room by closing the least recently used idle session, if there is one
+					idle = [ c for c in self.connections if not c.in_use ]
+					if not idle:
+						self.condition.wait()
+						continue
+					self._discard(min(idle, key=lambda c: c.last_used))
+
+				conn = PooledConnection(address, None)
+				conn.in_use = True
+				conn.requests = 1
+				self.connections.append(conn)
+				break
+
+		# Connecting can be slow, so it is done without holding the lock
+		try:
+			conn.client = self.factory(address)
+		except Exception:
+			with self.condition:
+				self.connections.remove(conn)
+				self.condition.notify()
+			raise
+		return conn
+
+	def _release(self, conn: PooledConnection):
+		with self.condition:
+			conn.in_use = False
+			conn.last_used = time.time()
+			self.condition.notify()
+
+	def _check(self, conn: PooledConnection) -> bool:
+		'''Runs the health check on a session which has been idle for a while'''
+		now = time.time()
+		if now - conn.last_used < self.check_interval:
+			return True
+		conn.last_checked = now
+		try:
+			return self.health_check(conn.client)
+		except Exception:
+			return False
+
+	def _discard(self, conn: PooledConnection):
+		'''Closes a session and removes it from the pool. The lock must be held.'''
+		self.connections.remove(conn)
+		try:
+			self.close(conn.client)
+		except Exception:
+			pass
+		self.condition.notify()
+
+	def _evict_idle(self):
+		'''Closes sessions which have been idle too long. The lock must be held.'''
+		for conn in [ c for c in self.connections if not c.in_use ]:
+			if conn.get_idle_time() > self.idle_timeout:
+				self._discard(conn)
+
+	def close_all(self, address: str = '') -> int:
+		'''Closes idle sessions, either all of them or only those for the specified address.
+Returns the number of sessions closed.'''
+		count = 0
+		with self.condition:
+			for conn in [ c for c in self.connections if not c.in_use ]:
+				if not address or conn.address == address:
+					self._discard(conn)
+					count += 1
+		return count
+
+	def get_connections(self) -> list:
+		'''Returns a list of the sessions in the pool after closing those which have been idle
+too long'''
+		with self.condition:
+			self._evict_idle()
+			return list(self.connections)
@@ -0,0 +1,265 @@
+'''Implements a long-lived shell process for running shell commands.
+
+Starting a shell for every command is slow and forgets everything the command did, such as
+changing directory or setting environment variables. ShellCoprocess keeps one shell running and
+feeds it commands on its standard input. After each command the shell prints a marker line
+containing a token unique to the coprocess, the command's exit code, and its working directory,
+which is how the end of the command's output is found. Output is passed to callbacks as it
+arrives instead of being collected until the command finishes.
+
+Commands read standard input from /dev/null, because the shell's own standard input is the
+channel commands arrive on. The shell runs in a session of its own with no controlling terminal
+and its output going to pipes, so programs which need a terminal, such as editors, pagers, and
+password prompts, are run with run_interactive() instead, in a new shell attached to Smilodon's
+terminal and given the coprocess's environment. If a command exits the shell, it is started again for the next
+command. On Windows, where there is no POSIX shell to talk to, each command is run in a new
+process instead.'''
+
+import codecs
+import os
+import selectors
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+class ShellResult:
+	'''The outcome of a command: its exit code, the shell's working directory afterward, and
+whether it was stopped for running too long. exit_code is None if the command timed out.'''
+	def __init__(self, exit_code, cwd: str = '', timed_out: bool = False):
+		self.exit_code = exit_code
+		self.cwd = cwd
+		self.timed_out = timed_out
+
+
+class _StreamReader:
+	'''Decodes output from one of the shell's pipes and finds the end-of-command marker in it'''
+	def __init__(self, marker: bytes, callback):
+		self.marker = marker
+		self.callback = callback
+		self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+		self.buffer = b''
+		self.trailer = None
+
+	def feed(self, data: bytes) -> bool:
+		'''Processes data read from the pipe. Returns True once the marker line has been read.'''
+		self.buffer += data
+		if self.trailer is None:
+			index = self.buffer.find(self.marker)
+			if index < 0:
+				# Hold back enough to catch a marker split across reads
+				keep = len(self.marker) - 1
+				self._emit(self.buffer[:-keep])
+				self.buffer = self.buffer[-keep:]
+				return False
+
+			self._emit(self.buffer[:index])
+			self._emit(b'', True)
+			self.trailer = b''
+			self.buffer = self.buffer[index + len(self.marker):]
+
+		end = self.buffer.find(b'\n')
+		if end < 0:
+			return False
+		self.trailer = self.buffer[:end].decode('utf-8', 'replace').strip()
+		return True
+
+	def finish(self):
+		'''Passes on anything remaining after the pipe has closed'''
+		if self.trailer is None:
+			self._emit(self.buffer, True)
+			self.buffer = b''
+
+	def _emit(self, data: bytes, final: bool = False):
+		text = self.decoder.decode(data, final)
+		if text and self.callback:
+			self.callback(text)
+
+
+def _find_shell() -> str:
+	# bash is preferred because a syntax error in an eval'd command doesn't make it exit the way
+	# many other shells do, which would throw away the session's state
+	return shutil.which('bash') or '/bin/sh'
+
+
+class ShellCoprocess:
+	'''A shell which runs commands one at a time for as long as the ShellCoprocess exists. run()
+is safe to call from multiple threads; commands are queued behind the one running. busy() can be
+used to decide whether to use a separate ShellCoprocess instead of waiting.'''
+	def __init__(self, shell: str = ''):
+		self.shell = shell or _find_shell()
+		self.process = None
+		self.cwd = ''
+		self.lock = threading.Lock()
+
+	def busy(self) -> bool:
+		'''Returns True if a command is running'''
+		return self.lock.locked()
+
+	def is_running(self) -> bool:
+		'''Returns True if the shell process has been started and hasn't exited'''
+		return self.process is not None and self.process.poll() is None
+
+	def _start(self):
+		self.process = subprocess.Popen([ self.shell ], stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, start_new_session=True)
+		self.cwd = ''
+
+	def close(self):
+		'''Stops the shell process'''
+		if self.process is None:
+			return
+		try:
+			self.process.stdin.close()
+		except OSError:
+			pass
+		try:
+			self.process.wait(timeout=1)
+		except subprocess.TimeoutExpired:
+			self._kill()
+		self._reap()
+
+	def _kill(self):
+		try:
+			os.killpg(self.process.pid, signal.SIGKILL)
+		except (OSError, AttributeError):
+			self.process.kill()
+
+	def _reap(self):
+		'''Waits for the shell process to exit and releases its pipes'''
+		process = self.process
+		self.process = None
+		if process is None:
+			return None
+		for pipe in (process.stdin, process.stdout, process.stderr):
+			try:
+				pipe.close()
+			except OSError:
+				pass
+		return process.wait()
+
+	def run(self, command: str, cwd: str = '', timeout: float = 0, on_stdout=None,
+			on_stderr=None) -> ShellResult:
+		'''Runs a command in the shell, first changing to cwd if it is given and differs from the
+shell's current directory. Output is passed to on_stdout and on_stderr as text as it arrives.
+If timeout is greater than zero and the command runs longer than that many seconds, the shell
+and everything it started is killed.'''
+		if sys.platform == 'win32':
+			return _run_once(command, cwd, timeout, on_stdout, on_stderr)
+
+		with self.lock:
+			if not self.is_running():
+				self._reap()
+				self._start()
+			return self._run(command, cwd, timeout, on_stdout, on_stderr)
+
+	def get_environment(self) -> dict:
+		'''Returns the environment variables exported in the shell, which include those set by
+earlier commands'''
+		if sys.platform == 'win32':
+			return dict(os.environ)
+
+		chunks = list()
+		result = self.run('env -0', on_stdout=chunks.append)
+		if result.exit_code:
+			return dict(os.environ)
+
+		environment = dict()
+		for item in ''.join(chunks).split('\0'):
+			name, sep, value = item.partition('=')
+			if sep and name:
+				environment[name] = value
+		return environment
+
+	def _run(self, command, cwd, timeout, on_stdout, on_stderr) -> ShellResult:
+		token = uuid.uuid4().hex
+		marker = ('__smilodon_done_%s__' % token).encode('ascii')
+
+		script = list()
+		if cwd and cwd != self.cwd:
+			script.append('cd -- %s' % shlex.quote(cwd))
+		script.append('eval %s </dev/null' % shlex.quote(command))
+		script.append("printf '%%s %%d %%s\\n' %s \"$?\" \"$PWD\"" % marker.decode('ascii'))
+		script.append("printf '%%s\\n' %s >&2" % marker.decode('ascii'))
+
+		readers = {
+			self.process.stdout: _StreamReader(marker, on_stdout),
+			self.process.stderr: _StreamReader(marker, on_stderr),
+		}
+
+		try:
+			self.process.stdin.write(('\n'.join(script) + '\n').encode('utf-8'))
+			self.process.stdin.flush()
+		except OSError:
+			# The shell exited on its own since the last command
+			self._reap()
+			self._start()
+			return self._run(command, cwd, timeout, on_stdout, on_stderr)
+
+		deadline = time.monotonic() + timeout if timeout > 0 else None
+		with selectors.DefaultSelector() as selector:
+			for pipe in readers:
+				selector.register(pipe, selectors.EVENT_READ)
+
+			pending = len(readers)
+			while pending:
+				wait = None
+				if deadline is not None:
+					wait = deadline - time.monotonic()
+					if wait <= 0:
+						self._kill()
+						self._reap()
+						return ShellResult(None, self.cwd, True)
+
+				for key, _ in selector.select(wait):
+					data = os.read(key.fileobj.fileno(), 65536)
+					reader = readers[key.fileobj]
+					if not data:
+						reader.finish()
+						selector.unregister(key.fileobj)
+						pending -= 1
+					elif reader.feed(data):
+						selector.unregister(key.fileobj)
+						pending -= 1
+
+		trailer = readers[self.process.stdout].trailer
+		if trailer is None:
+			# The command exited the shell
+			return ShellResult(self._reap(), self.cwd)
+
+		status, _, self.cwd = trailer.partition(' ')
+		try:
+			exit_code = int(status)
+		except ValueError:
+			exit_code = None
+		return ShellResult(exit_code, self.cwd)
+
+
+def run_interactive(command: str, cwd: str = '', env=None) -> ShellResult:
+	'''Runs a command in a new shell process which shares Smilodon's terminal, so that it can
+read from the keyboard and control the screen. env, if given, is the environment the command gets.
+Changes the command makes to the shell's directory or environment are not kept.'''
+	if sys.platform == 'win32':
+		result = subprocess.run(command, shell=True, cwd=cwd or None, env=env)
+	else:
+		result = subprocess.run([ _find_shell(), '-c', command ], cwd=cwd or None, env=env)
+	return ShellResult(result.returncode, cwd)
+
+
+def _run_once(command, cwd, timeout, on_stdout, on_stderr) -> ShellResult:
+	'''Runs a command in a new shell process. Used where there is no POSIX shell.'''
+	try:
+		result = subprocess.run(command, shell=True, cwd=cwd or None, capture_output=True,
+								timeout=timeout if timeout > 0 else None)
+	except subprocess.TimeoutExpired:
+		return ShellResult(None, cwd, True)
+
+	if result.stdout and on_stdout:
+		on_stdout(result.stdout.decode('utf-8', 'replace'))
+	if result.stderr and on_stderr:
+		on_stderr(result.stderr.decode('utf-8', 'replace'))
+	return ShellResult(result.returncode, cwd)
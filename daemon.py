@@ -0,0 +1,389 @@
+'''Keeps one warm Smilodon process running commands for thin clients.
+
+smilodon.py --daemon imports everything, loads profiles, and then waits for connections on a Unix
+domain socket. Each client runs commands in a session of its own: an anonymous one which lasts as
+long as the connection, or a named one which is kept between connections until it has been idle
+for the idle timeout. Sessions have their own working directory, aliases, jobs, server groups,
+and shell process. The client, profiles, server connections, timing, and history belong to the
+daemon and are shared, which is most of what makes a warm process worth having.
+
+The working directory belongs to the whole process, so commands run one at a time. Output is
+streamed back to the client as the command prints it. Commands which ask for input, such as
+register, are refused, because they would read from the daemon's terminal rather than the
+client's and hold up every other client while they waited. The daemon stops when it has had no
+clients for the idle timeout or when a client asks it to. See daemonclient for the protocol.'''
+
+import collections
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from commandaccess import gCommandAccess
+from daemonclient import get_socket_path
+from outputcapture import redirect_output
+import pipeline
+from shellbase import Invocation
+from tokenizer import tokenize
+
+# Seconds without any clients before the daemon shuts itself down
+IDLE_TIMEOUT = 1800.0
+
+# Number of recent requests used for the latency percentiles
+LATENCY_WINDOW = 1000
+
+class LatencyStats:
+	'''Keeps track of how long requests take'''
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.count = 0
+		self.total = 0.0
+		self.recent = collections.deque(maxlen=LATENCY_WINDOW)
+
+	def add(self, seconds: float):
+		'''Records one request'''
+		with self.lock:
+			self.count += 1
+			self.total += seconds
+			self.recent.append(seconds)
+
+	def get_summary(self) -> dict:
+		'''Returns the number of requests and the mean, median, and 99th percentile times in
+milliseconds. The percentiles cover only the most recent requests.'''
+		with self.lock:
+			if not self.count:
+				return { 'count':0, 'mean':0.0, 'p50':0.0, 'p99':0.0 }
+			ordered = sorted(self.recent)
+			return {
+				'count':self.count,
+				'mean':round(self.total / self.count * 1000, 3),
+				'p50':round(ordered[len(ordered) // 2] * 1000, 3),
+				'p99':round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 3),
+			}
+
+
+class Session:
+	'''A shell belonging to one client or one session name'''
+	def __init__(self, name: str, shell):
+		self.name = name
+		self.shell = shell
+		self.lock = threading.Lock()
+		self.last_used = time.monotonic()
+
+	def close(self):
+		'''Stops the session's shell process'''
+		self.shell.state.coprocess.close()
+
+
+class ClientWriter:
+	'''File-like object which sends what a command prints to the client as output messages'''
+	def __init__(self, conn: socket.socket):
+		self.conn = conn
+		self.closed = False
+
+	def write(self, text: str) -> int:
+		'''Sends text to the client. A client which has gone away doesn't stop the command.'''
+		if text and not self.closed:
+			try:
+				_send(self.conn, { 'type':'output', 'text':text })
+			except OSError:
+				self.closed = True
+		return len(text)
+
+	def flush(self):
+		'''Output is sent as soon as it is written'''
+
+	def isatty(self) -> bool:
+		'''Output goes to a socket, not a terminal'''
+		return False
+
+
+def _send(conn: socket.socket, message: dict):
+	'''Sends one message to a client'''
+	conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _get_peer_uid(conn: socket.socket) -> int:
+	'''Returns the user ID of the process on the other end of a connection or -1 if the platform
+can't tell'''
+	if not hasattr(socket, 'SO_PEERCRED'):
+		return -1
+	creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+	return struct.unpack('3i', creds)[1]
+
+
+class Daemon:
+	'''Accepts connections and runs their commands. make_shell is called with a ShellState, or
+None for a new one, and returns a Shell.'''
+	def __init__(self, make_shell, path: str = '', idle_timeout: float = IDLE_TIMEOUT):
+		self.make_shell = make_shell
+		self.path = path if path else get_socket_path()
+		self.idle_timeout = idle_timeout
+		self.started = time.monotonic()
+		self.latency = LatencyStats()
+
+		# Named sessions, keyed by name. Anonymous sessions belong to their connection's thread.
+		self.sessions = dict()
+		self.lock = threading.Lock()
+
+		# The working directory is per-process, so only one command runs at a time
+		self.exec_lock = threading.Lock()
+
+		self.clients = 0
+		self.last_activity = time.monotonic()
+		self.stopping = threading.Event()
+		self.listener = None
+
+		self.base = make_shell(None)
+		try:
+			self.base.state.profiles.get_names()
+		except Exception:
+			# Profiles are loaded again on first use, which will report the problem
+			pass
+
+	def log(self, message: str):
+		'''Writes a line to the daemon's log, which is its stdout'''
+		print('%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message), flush=True)
+
+	def _bind(self) -> str:
+		'''Creates the listening socket. Returns an error string, which is empty on success.'''
+		if os.path.exists(self.path):
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.path)
+				return 'A daemon is already running at %s' % self.path
+			except OSError:
+				# Left over from a daemon which didn't shut down cleanly
+				os.unlink(self.path)
+			finally:
+				probe.close()
+
+		self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		oldMask = os.umask(0o177)
+		try:
+			self.listener.bind(self.path)
+		finally:
+			os.umask(oldMask)
+		self.listener.listen(16)
+		self.listener.settimeout(1.0)
+		return ''
+
+	def serve(self) -> int:
+		'''Runs until the daemon is idle for too long or is asked to stop. Returns an exit code.'''
+		try:
+			error = self._bind()
+		except OSError as e:
+			error = "Couldn't listen on %s: %s" % (self.path, e)
+		if error:
+			print(error)
+			return 2
+
+		self.log('Listening on %s (pid %s)' % (self.path, os.getpid()))
+		for mismatch in gCommandAccess.check_entries():
+			self.log(mismatch)
+		try:
+			while not self.stopping.is_set():
+				try:
+					conn, _ = self.listener.accept()
+				except socket.timeout:
+					self._expire_sessions()
+					with self.lock:
+						idle = not self.clients and \
+							time.monotonic() - self.last_activity > self.idle_timeout
+					if idle:
+						self.log('Idle for %s seconds, shutting down' % self.idle_timeout)
+						break
+					continue
+
+				with self.lock:
+					self.clients += 1
+					self.last_activity = time.monotonic()
+				threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.shutdown()
+		return 0
+
+	def shutdown(self):
+		'''Closes the socket and all sessions'''
+		self.stopping.set()
+		if self.listener:
+			self.listener.close()
+			self.listener = None
+			try:
+				os.unlink(self.path)
+			except OSError:
+				pass
+		with self.lock:
+			sessions = list(self.sessions.values())
+			self.sessions.clear()
+		for session in sessions:
+			session.close()
+		self.base.state.coprocess.close()
+		self.base.state.connections.close_all()
+
+	def _expire_sessions(self):
+		'''Closes named sessions which haven't been used for the idle timeout'''
+		cutoff = time.monotonic() - self.idle_timeout
+		with self.lock:
+			expired = [ s for s in self.sessions.values() if s.last_used < cutoff ]
+			for session in expired:
+				del self.sessions[session.name]
+		for session in expired:
+			self.log('Session %s expired' % session.name)
+			session.close()
+
+	def _new_session(self, name: str, cwd: str) -> Session:
+		'''Creates a session starting in the client's directory'''
+		if not os.path.isdir(cwd):
+			cwd = self.base.state.pwd
+		return Session(name, self.make_shell(self.base.state.new_session(cwd)))
+
+	def get_session(self, name: str, cwd: str) -> Session:
+		'''Returns the named session, creating it if needed'''
+		with self.lock:
+			session = self.sessions.get(name)
+			if not session:
+				session = self._new_session(name, cwd)
+				self.sessions[name] = session
+			return session
+
+	def handle(self, conn: socket.socket):
+		'''Reads requests from one client until it disconnects'''
+		anonymous = None
+		try:
+			uid = _get_peer_uid(conn)
+			if uid not in (-1, os.getuid()):
+				self.log('Refused a connection from uid %s' % uid)
+				return
+
+			reader = conn.makefile('rb')
+			for line in reader:
+				try:
+					request = json.loads(line)
+				except ValueError:
+					_send(conn, { 'type':'done', 'error':'Bad request', 'ms':0.0 })
+					continue
+
+				requestType = request.get('type')
+				if requestType == 'status':
+					_send(conn, self.get_status())
+				elif requestType == 'stop':
+					self.log('Stop requested')
+					_send(conn, { 'type':'done', 'error':'', 'ms':0.0 })
+					self.stopping.set()
+					break
+				elif requestType == 'run':
+					name = request.get('session', '')
+					cwd = request.get('cwd', '')
+					if name:
+						session = self.get_session(name, cwd)
+					else:
+						if not anonymous:
+							anonymous = self._new_session('', cwd)
+						session = anonymous
+					if not self.run(conn, session, request.get('command', '')):
+						break
+				else:
+					_send(conn, { 'type':'done', 'error':'Unknown request type', 'ms':0.0 })
+		except OSError:
+			pass
+		finally:
+			if anonymous:
+				anonymous.close()
+			conn.close()
+			with self.lock:
+				self.clients -= 1
+				self.last_activity = time.monotonic()
+
+	def run(self, conn: socket.socket, session: Session, command: str) -> bool:
+		'''Runs a command for a client. Returns False if the command exited the session.'''
+		line = command.strip()
+		if line.endswith('&'):
+			_send(conn, { 'type':'done', 'ms':0.0,
+				'error':'Background jobs are not available through the daemon' })
+			return True
+
+		name = _find_prompting_command(line)
+		if name:
+			_send(conn, { 'type':'done', 'ms':0.0,
+				'error':'%s asks for input, which is not available through the daemon' % name })
+			return True
+
+		error = ''
+		keepGoing = True
+		writer = ClientWriter(conn)
+		with session.lock, self.exec_lock:
+			start = time.perf_counter()
+			session.last_used = time.monotonic()
+			try:
+				os.chdir(session.shell.state.pwd)
+				with redirect_output(writer):
+					error = session.shell.execute_line(line)
+			except SystemExit:
+				keepGoing = False
+			except OSError as e:
+				error = "Couldn't change to %s: %s" % (session.shell.state.pwd, e)
+			elapsed = time.perf_counter() - start
+
+		self.latency.add(elapsed)
+		if line:
+			self.log('[%s] %s %.2fms%s' % (session.name or 'anonymous', line.split()[0],
+				elapsed * 1000, ' failed' if error else ''))
+
+		if not keepGoing and session.name:
+			with self.lock:
+				if self.sessions.get(session.name) is session:
+					del self.sessions[session.name]
+			session.close()
+
+		message = { 'type':'done', 'error':error or '', 'ms':round(elapsed * 1000, 3) }
+		if not keepGoing:
+			message['closed'] = True
+		_send(conn, message)
+		return keepGoing
+
+	def get_status(self) -> dict:
+		'''Returns the daemon's statistics as a status message'''
+		with self.lock:
+			sessions = len(self.sessions)
+		latency = self.latency.get_summary()
+		return {
+			'type':'status',
+			'pid':os.getpid(),
+			'uptime':round(time.monotonic() - self.started, 1),
+			'sessions':sessions,
+			'requests':latency['count'],
+			'latency':'mean %sms, p50 %sms, p99 %sms' % (latency['mean'], latency['p50'],
+				latency['p99']),
+		}
+
+
+def _find_prompting_command(line: str) -> str:
+	'''Returns the name of a command in a line which would ask for input or an empty string if
+there is none'''
+	tokens = tokenize(line)
+	if not tokens:
+		return ''
+	stages = [ line ]
+	if not gCommandAccess.get_command(tokens[0].value).reads_whole_line():
+		try:
+			stages = pipeline.split_stages(line, tokens)
+		except ValueError:
+			# The shell reports the problem when it runs the line
+			return ''
+
+	for stage in stages:
+		invocation = Invocation(stage)
+		cmd = gCommandAccess.get_command(invocation.name)
+		if cmd.prompts(invocation):
+			return cmd.get_name()
+	return ''
+
+
+def serve(make_shell, path: str = '', idle_timeout: float = IDLE_TIMEOUT) -> int:
+	'''Runs a daemon until it stops and returns an exit code'''
+	return Daemon(make_shell, path, idle_timeout).serve()
@@ -0,0 +1,164 @@
+'''Thin client for a Smilodon daemon.
+
+Starting Smilodon means importing prompt_toolkit and the Anselus libraries, building the command
+table, and loading profiles. A daemon started with --daemon does that once and then runs commands
+sent to it over a Unix domain socket. This module sends them. It uses only the standard library,
+and smilodon.py hands off to it before importing anything else, so a command run this way costs
+little more than starting the Python interpreter.
+
+Requests and responses are JSON objects, one per line. A run request carries a command, the
+client's working directory, and optionally a session name. The daemon replies with any number
+of output messages followed by a done message holding the command's error string, if any, and
+how long it took.'''
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+def get_socket_path() -> str:
+	'''Returns the path of the daemon's socket, which can be set with SMILODON_SOCKET'''
+	path = os.getenv('SMILODON_SOCKET')
+	if path:
+		return path
+	folder = os.getenv('XDG_RUNTIME_DIR')
+	if folder:
+		return os.path.join(folder, 'smilodon.sock')
+	return '/tmp/smilodon-%s.sock' % os.getuid()
+
+
+class DaemonConnection:
+	'''A connection to a running daemon'''
+	def __init__(self, path: str):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			self.sock.connect(path)
+		except OSError:
+			self.sock.close()
+			raise
+		self.reader = self.sock.makefile('rb')
+
+	def close(self):
+		'''Closes the connection'''
+		self.reader.close()
+		self.sock.close()
+
+	def send(self, request: dict):
+		'''Sends a request to the daemon'''
+		self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+	def receive(self) -> dict:
+		'''Returns the next message from the daemon. ConnectionError is raised if the daemon has
+closed the connection.'''
+		line = self.reader.readline()
+		if not line:
+			raise ConnectionError('The daemon closed the connection')
+		return json.loads(line)
+
+	def run(self, command: str, session: str = '', output=None) -> dict:
+		'''Runs a command, writing its output to a stream as it arrives, and returns the done
+message'''
+		self.send({ 'type':'run', 'command':command, 'session':session, 'cwd':os.getcwd() })
+		if output is None:
+			output = sys.stdout
+		while True:
+			message = self.receive()
+			if message.get('type') == 'output':
+				output.write(message['text'])
+				output.flush()
+			else:
+				return message
+
+
+def _read_commands(handle):
+	'''Generator which yields (line number, command) pairs from a script, skipping blank lines
+and comments'''
+	for lineNumber, line in enumerate(handle, 1):
+		line = line.strip()
+		if line and not line.startswith('#'):
+			yield lineNumber, line
+
+
+def main(argv: list) -> int:
+	'''Runs the thin client with the arguments following --connect'''
+	parser = argparse.ArgumentParser(prog='smilodon.py --connect',
+		description='Runs commands in a Smilodon daemon started with --daemon')
+	parser.add_argument('--socket', default=get_socket_path(), help='path of the daemon socket')
+	parser.add_argument('--session', default='',
+		help='run in a named session, whose directory and settings carry over between clients')
+	parser.add_argument('--batch', metavar='SCRIPT',
+		help='run the commands in SCRIPT. Use - for stdin.')
+	parser.add_argument('--keep-going', action='store_true',
+		help='in batch mode, continue after a command fails')
+	parser.add_argument('--latency', action='store_true',
+		help='print how long the daemon took to run each command to stderr')
+	parser.add_argument('--status', action='store_true', help="show the daemon's statistics")
+	parser.add_argument('--stop', action='store_true', help='stop the daemon')
+	parser.add_argument('command', nargs=argparse.REMAINDER,
+		help='command to run. Like ssh, the words are joined with spaces and read again by the '
+			'daemon, so quotes meant for Smilodon must be protected from your shell.')
+	args = parser.parse_args(argv)
+
+	# The script is opened before connecting so that a missing script isn't reported as a problem
+	# with the daemon
+	script = None
+	if args.batch and not args.command and not (args.status or args.stop):
+		try:
+			script = sys.stdin if args.batch == '-' else open(args.batch, encoding='utf-8')
+		except OSError as e:
+			print("Couldn't read script: %s" % e, file=sys.stderr)
+			return 2
+
+	try:
+		conn = DaemonConnection(args.socket)
+	except OSError:
+		if script not in (None, sys.stdin):
+			script.close()
+		print('No Smilodon daemon is running at %s. Start one with smilodon.py --daemon.' % \
+			args.socket, file=sys.stderr)
+		return 2
+
+	try:
+		if args.status or args.stop:
+			conn.send({ 'type':'status' if args.status else 'stop' })
+			message = conn.receive()
+			if args.status:
+				for key in [ 'pid', 'uptime', 'sessions', 'requests', 'latency' ]:
+					print('%s: %s' % (key, message.get(key, '')))
+			return 0
+
+		if args.command:
+			commands = [ ('<command>', 0, ' '.join(args.command)) ]
+		elif args.batch:
+			source = '<stdin>' if args.batch == '-' else args.batch
+			commands = ( (source, n, line) for n, line in _read_commands(script) )
+		else:
+			parser.print_usage(sys.stderr)
+			return 2
+
+		failed = 0
+		for source, lineNumber, command in commands:
+			message = conn.run(command, args.session)
+			error = message.get('error', '')
+			if args.latency:
+				print('%.2fms: %s' % (message.get('ms', 0.0), command), file=sys.stderr)
+			if error:
+				failed += 1
+				if lineNumber:
+					print('%s:%s: %s: %s' % (source, lineNumber, command, error),
+						file=sys.stderr)
+				else:
+					print(error, file=sys.stderr)
+				if not args.keep_going:
+					break
+			if message.get('closed'):
+				break
+		return 1 if failed else 0
+	except (OSError, ConnectionError, ValueError) as e:
+		print('Lost the connection to the daemon: %s' % e, file=sys.stderr)
+		return 2
+	finally:
+		conn.close()
+		if script not in (None, sys.stdin):
+			script.close()
@@ -0,0 +1,129 @@
+'''Runs a command against many servers at once for the on command. The command is a template
+in which each {server} is replaced with a server's address, and the copies for the servers run
+side by side through the usual command dispatch.'''
+
+import concurrent.futures
+import threading
+import time
+
+from commandaccess import gCommandAccess
+from outputcapture import capture_output
+from shellbase import CommandFailure, Invocation, ShellState
+
+# Placeholder in a command which is replaced with each server's address
+SERVER_PLACEHOLDER = '{server}'
+
+class ServerResult:
+	'''The outcome of running a command for one server. status is 'ok' if the command ran,
+'invalid' if it rejected its arguments, 'failed' if it returned a CommandFailure, 'error' if it
+raised an exception, 'timed out', or 'waiting' or 'running' if it hasn't finished. message is the
+string the command returned.'''
+	def __init__(self, server: str, command_line: str):
+		self.server = server
+		self.command_line = command_line
+		self.status = 'waiting'
+		self.message = ''
+		self.output = ''
+		self.start = 0.0
+		self.seconds = 0.0
+
+
+def expand_servers(spec: str, groups: dict) -> tuple:
+	'''Expands a comma-separated list of servers and @group names into a list of servers,
+dropping duplicates. Returns the list along with an error string, which is empty on success.'''
+	servers = list()
+	for item in spec.split(','):
+		item = item.strip()
+		if not item:
+			continue
+		if item.startswith('@'):
+			if item[1:] not in groups:
+				return list(), 'No server group named %s' % item[1:]
+			members = groups[item[1:]]
+		else:
+			members = [ item ]
+		for server in members:
+			if server not in servers:
+				servers.append(server)
+
+	if not servers:
+		return list(), 'No servers given'
+	return servers, ''
+
+
+def make_command_line(command: str, server: str) -> str:
+	'''Returns the command to run for a server, with the server in place of each {server}'''
+	return command.replace(SERVER_PLACEHOLDER, server)
+
+
+def _run_one(result: ServerResult, pshell_state: ShellState, lock: threading.Lock):
+	'''Runs one server's command through the usual command dispatch, capturing its output'''
+	with lock:
+		result.start = time.perf_counter()
+		result.status = 'running'
+
+	with capture_output() as buffer:
+		try:
+			invocation = Invocation(result.command_line)
+			cmd = gCommandAccess.get_command(invocation.name)
+			message = cmd.is_valid(invocation)
+			if message:
+				status = 'invalid'
+			else:
+				message = cmd.execute(invocation, pshell_state)
+				status = 'failed' if isinstance(message, CommandFailure) else 'ok'
+		except SystemExit:
+			message = 'The command tried to exit the shell'
+			status = 'error'
+		except Exception as e:
+			message = '%s: %s' % (type(e).__name__, e)
+			status = 'error'
+
+	with lock:
+		# A result which timed out has already been reported, so it is left alone
+		if result.status == 'running':
+			result.seconds = time.perf_counter() - result.start
+			result.status = status
+			result.message = message or ''
+			result.output = buffer.getvalue()
+
+
+def run_on_servers(servers: list, command: str, pshell_state: ShellState, jobs: int = 8,
+					timeout: float = 30.0) -> list:
+	'''Runs a command for each server, no more than jobs at a time, and returns a list of
+ServerResults in the same order as the servers. A command which runs for longer than timeout
+seconds is reported as timed out and left to finish in the background, so that one slow server
+doesn't hold up the results for the rest.'''
+	results = [ ServerResult(s, make_command_line(command, s)) for s in servers ]
+	lock = threading.Lock()
+	executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs),
+		thread_name_prefix='fanout')
+	pending = { executor.submit(_run_one, r, pshell_state, lock): r for r in results }
+	executor.shutdown(wait=False)
+
+	while pending:
+		done, _ = concurrent.futures.wait(pending, timeout=0.1,
+			return_when=concurrent.futures.FIRST_COMPLETED)
+		for future in done:
+			del pending[future]
+
+		now = time.perf_counter()
+		with lock:
+			for future, result in list(pending.items()):
+				if result.status == 'running' and now - result.start > timeout:
+					result.status = 'timed out'
+					result.seconds = now - result.start
+					result.message = 'No response after %s seconds' % timeout
+					del pending[future]
+	return results
+
+
+def format_results(results: list) -> str:
+	'''Returns the results as a table with one line per server'''
+	width = max([ len(r.server) for r in results ] + [ 6 ])
+	lines = [ '%-*s  %-9s  %9s  %s' % (width, 'Server', 'Status', 'Time', 'Result') ]
+	for result in results:
+		message = result.message.strip().split('\n')[0] if result.message else ''
+		lines.append('%-*s  %-9s  %7.0fms  %s' % (width, result.server, result.status,
+			result.seconds * 1000, message))
+	return '\n'.join(lines)
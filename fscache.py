@@ -0,0 +1,129 @@
+'''Provides a cache of directory listings used for filename completion. Each listing is stored as
+a sorted list of names along with whether each one is a directory, so prefix matches can be
+found with a binary search instead of rescanning the directory on every keystroke. Listings are
+keyed by the directory's device and inode numbers, so a relative path such as '.' doesn't find
+another directory's listing after cd. They are checked against the directory's modification time
+on each use and evicted in least-recently-used order once the cache holds more entries than its
+budget.'''
+
+from bisect import bisect_left
+import collections
+import os
+import threading
+import time
+
+class DirListing:
+	'''The contents of one directory as of a particular modification time'''
+	def __init__(self, path: str, mtime_ns: int, entries):
+		self.path = path
+		self.mtime_ns = mtime_ns
+		entries = sorted(entries)
+		self.names = [ name for name, _ in entries ]
+		self.isdir = [ isdir for _, isdir in entries ]
+
+	def match(self, prefix: str, dirs_only: bool = False):
+		'''Generator which yields (name, isdir) pairs for the entries starting with the prefix.
+As with glob, hidden entries are only matched if the prefix itself starts with a period.'''
+		hidden = prefix.startswith('.')
+		index = bisect_left(self.names, prefix)
+		while index < len(self.names) and self.names[index].startswith(prefix):
+			name = self.names[index]
+			if (hidden or name[0] != '.') and (self.isdir[index] or not dirs_only):
+				yield name, self.isdir[index]
+			index += 1
+
+
+def scan_directory(path: str):
+	'''Generator which yields (name, isdir) pairs for the contents of a directory'''
+	with os.scandir(path) as entries:
+		for entry in entries:
+			try:
+				isdir = entry.is_dir()
+			except OSError:
+				isdir = False
+			yield entry.name, isdir
+
+
+class DirListingCache:
+	'''Thread-safe LRU cache of DirListing objects keyed by (device, inode)'''
+
+	# Directories modified more recently than this many seconds ago are rescanned on every use,
+	# because a second change within the timestamp resolution of the filesystem would otherwise
+	# go unnoticed.
+	settle_time = 2.0
+
+	def __init__(self, max_entries: int = 500000):
+		self.max_entries = max_entries
+		self.listings = collections.OrderedDict()
+		self.entry_count = 0
+		self.lock = threading.Lock()
+
+	def get(self, path: str) -> DirListing:
+		'''Returns the listing for a directory, scanning it if it is not cached or has changed
+since it was cached. None is returned if the directory can't be read.'''
+		path = path or '.'
+		try:
+			info = os.stat(path)
+		except OSError:
+			return None
+
+		key = (info.st_dev, info.st_ino)
+		with self.lock:
+			listing = self.listings.get(key)
+			if listing and listing.mtime_ns == info.st_mtime_ns:
+				self.listings.move_to_end(key)
+				return listing
+
+		try:
+			entries = list(scan_directory(path))
+		except OSError:
+			return None
+
+		return self.store(path, info, entries)
+
+	def store(self, path: str, info: os.stat_result, entries) -> DirListing:
+		'''Adds a listing gathered elsewhere to the cache and returns it. info is the result of
+os.stat() on the directory, taken before it was read, and entries is an iterable of (name, isdir)
+pairs.'''
+		listing = DirListing(path or '.', info.st_mtime_ns, entries)
+		if time.time() - info.st_mtime_ns / 1e9 < self.settle_time:
+			return listing
+
+		key = (info.st_dev, info.st_ino)
+		with self.lock:
+			old = self.listings.pop(key, None)
+			if old:
+				self.entry_count -= len(old.names)
+
+			self.listings[key] = listing
+			self.entry_count += len(listing.names)
+			while self.entry_count > self.max_entries and len(self.listings) > 1:
+				_, old = self.listings.popitem(last=False)
+				self.entry_count -= len(old.names)
+		return listing
+
+	def clear(self):
+		'''Empties the cache'''
+		with self.lock:
+			self.listings.clear()
+			self.entry_count = 0
+
+	def complete(self, token: str, dirs_only: bool = False):
+		'''Generator which yields (path, isdir) pairs for the entries whose paths start with
+the token, in the same form glob(token + '*') would return them'''
+		split = token.rfind('/')
+		if os.sep != '/':
+			split = max(split, token.rfind(os.sep))
+		folder = token[:split + 1]
+		prefix = token[split + 1:]
+
+		listing = self.get(folder)
+		if not listing:
+			return
+
+		for name, isdir in listing.match(prefix, dirs_only):
+			yield folder + name, isdir
+
+
+gDirCache = DirListingCache()
+'''Directory listing cache shared by the completion code'''
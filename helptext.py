@@ -1,6 +1,106 @@
 '''This module merely stores the extensive help text for different commands to 
 ensure the code remains easy to read.'''
 
+cache_cmd = '''Usage: cache [stats|clear]
+Smilodon keeps the results of profile and workspace lookups for a short time so
+that commands don't read profile storage over and over. stats shows how often
+each kind of lookup was answered from the cache and how much memory the cache
+is using. clear empties the cache and resets the counts.
+'''
+
+count_cmd = '''Usage: <command> | count
+Shows the number of lines written by the command before it in a pipeline.
+'''
+
+connections_cmd = '''Usage: connections [close [server]]
+Lists the server sessions kept open for reuse by preregister, along with how
+long ago each was opened, how long it has been idle, and how many requests it
+has handled. Sessions are closed automatically after being idle for five
+minutes.
+
+close [server] - closes idle sessions, either all of them or only those for
+the specified server.
+'''
+
+filter_cmd = '''Usage: <command> | filter [-i] [-v] [-e] <pattern>
+Passes on only the lines from the command before it in a pipeline which
+contain the pattern. Quote patterns containing spaces.
+
+-e - treat the pattern as a regular expression
+-i - ignore case
+-v - pass on the lines which don't match instead
+
+Aliases: grep
+'''
+
+group_cmd = '''Usage: group [name [servers] | delete name]
+Manages named groups of servers for use with the on command. servers is a
+comma-separated list of server addresses and other groups, such as
+mail1.example.com,mail2.example.com,@backup. Groups last until Smilodon exits.
+
+With no arguments, all groups are listed. With only a name, the servers in
+that group are shown.
+
+delete name - removes a group
+'''
+
+head_cmd = '''Usage: <command> | head [-n count]
+Passes on the first lines from the command before it in a pipeline, 10 unless
+another count is given, and then stops that command.
+'''
+
+history_cmd = '''Usage: history [-n count] [--failed] [--host name] [-e regex | text]
+Shows commands entered at the prompt, oldest first, with when they were run,
+the host they were run on, and the exit status of those which failed. Only the
+most recent matching commands are shown. The history is shared by all shells
+using the same history file, which is ~/.config/smilodon/history unless the
+SMILODON_HISTORY environment variable is set.
+
+While typing a command, Ctrl-R replaces it with the newest command containing
+what has been typed. If there isn't one, the newest command containing the
+typed characters in order is used instead. Press Ctrl-R again to go further
+back.
+
+text - show only commands containing the text
+-e regex - show only commands matching a regular expression
+-n count - show this many commands. Default: 20
+--failed - show only commands which failed
+--host name - show only commands run on the named host
+
+In a pipeline with no other arguments, such as history | filter ssh, the whole
+history is passed on, oldest first.
+'''
+
+jobs_cmd = '''Usage: jobs
+Lists the commands running in the background along with how long they have
+been running. A command is run in the background by ending it with &. Jobs
+which have finished are shown one last time and then removed from the list.
+
+Example:
+register example.com &
+'''
+
+ls_cmd = '''Usage: ls [options] [path...]
+Lists the contents of directories. Paths may contain the wildcards *, ?, and
+[...]. Options may be combined, such as ls -la.
+
+-a, --all            include entries starting with a period
+-A, --almost-all     same as -a, but without . and ..
+-d, --directory      list directories themselves instead of their contents
+-F, --classify       add / to directories, @ to links, * to programs
+-h, --human-readable show sizes such as 1.5K and 23M with -l
+-l                   long format: permissions, owner, size, and date
+-R, --recursive      list subdirectories as well
+-r, --reverse        reverse the sort order
+-S                   sort by size, largest first
+-t                   sort by modification time, newest first
+-U                   don't sort. With -l or -1, entries are printed as they
+                     are read, which is fastest for very large directories.
+-1                   one entry per line
+--color[=when]       color entries by type: always, auto, or never. Colors
+                     may be changed with the LS_COLORS environment variable.
+'''
+
 login_cmd = '''Usage: login <address>
 Log into a server once connected. The address used may be the numeric address
 (e.g. 557207fd-0a0a-45bb-a402-c38461251f8f) or the friendly address (e.g. 
@@ -20,6 +120,44 @@ to a server locally. A user ID may be passed to the command, but this is
 optional. The command returns a workspace ID and a preregistration code. The 
 user will perform the initial login with either the workspace ID or the user 
 ID and the registration code.
+
+Usage: preregister [port_number] --from <users.csv> --out <codes.csv> [options]
+Preprovisions a workspace for each row of a CSV file. The first column of each
+row holds the user ID, which may be left empty. A header row starting with
+"user_id" and blank lines are ignored. If no port is given, 2001 is used. Workspace IDs and
+registration codes are written to the output file as the server returns them,
+one line per input row, along with any error for that row.
+
+Options:
+--jobs <count> - most requests to keep in flight at once. The number actually
+used is adjusted to what the server can handle. Default: 32
+--rate <count> - send no more than this many requests per second during this
+run. A cap set with ratelimit applies again afterward.
+--start <row> - skip the rows before this one. Rows are numbered from 1.
+--resume - append to the output file, skipping rows already preregistered in
+it. Rerunning a failed bulk job with this option retries only the rows which
+failed or were never sent.
+--stop-on-error - stop sending new rows after the first failure.
+'''
+
+on_cmd = '''Usage: on [-j jobs] [-t seconds] <servers> <command>
+Runs a command once for each server in a list, several at a time, and shows
+the results in a table with how long each server took. servers is a
+comma-separated list of server addresses and @group names from the group
+command.
+
+Commands can only be run if they contain {server}, which is replaced with each
+server's address. Commands which ask for input can't be run this way, and
+neither can preregister, which servers only accept from the same machine.
+Output from each server's command is collected and shown before the table.
+
+-j jobs - run the command for up to this many servers at once. Default: 8
+-t seconds - report servers which take longer than this as timed out and
+stop waiting for them. Default: 30
+
+Examples:
+on example.com,example.org shell ssh {server} uptime
+on @mailservers shell ping -c 1 {server}
 '''
 
 profile_cmd = '''Usage: profile <action> <profilename>
@@ -39,22 +177,62 @@ rename <oldname> <newname> - change the name of a profile. Neither name may be
 
 list - prints a list of all available profiles
 
+export <name> <archive> [--since <earlier archive>] - saves the profile's
+files to a tar archive, compressed if the name ends in .gz, .bz2, or .xz,
+along with a manifest of their hashes. With --since, only files which have
+changed since the earlier archive are saved. Keep the earlier archives in the
+same folder, since importing reads them too.
+
+import <name> <archive> - creates a profile from an exported archive after
+checking every file against the manifest.
+
 setdefault <name> - sets the profile to be loaded on startup. If only one
 profile exists, this action has no effect.
 
 set <name> - activates the specified profile and deactivates the current one.'''
 
+ratelimit_cmd = '''Usage: ratelimit [server <rate|off> [burst]]
+Smilodon adjusts how many requests it keeps in flight to each server to match
+what the server can handle. The number grows while requests succeed quickly
+and is halved when a request fails, the server reports an internal error, or
+responses slow down sharply.
+
+With no arguments, the current limit for each server is shown along with its
+request counts and average latency. Giving a server and a rate also caps the
+requests sent to it at that many per second, with bursts of up to burst
+requests. off removes the cap. Caps last until Smilodon exits.
+'''
+
 register_cmd = '''Usage: register <serveraddress>
 Register a new workspace account. This command requires a connection to a
 server. Depending on the registration type set on the server, this command may
 return a status other than success or failure. If a server immediately creates
 a new workspace account, this command will print the new numeric address
-created.'''
+created.
 
-shell_cmd = '''Usage: shell <command>
+Passphrases found in the breached password filter, if one is installed, are
+refused. See breachfilter.py for how to build one.'''
+
+shell_cmd = '''Usage: shell [-i | -t seconds] <command>
 Executes a command directly in the regular user shell. On Windows, this is 
-Command Prompt. On UNIX-like platforms, this is the default shell, usually
-bash.
+Command Prompt. On UNIX-like platforms, this is bash if it is installed and
+sh otherwise.
+
+On UNIX-like platforms, the same shell is used for each command, so changes
+such as setting environment variables carry over from one command to the
+next. The shell's working directory follows cd, and changing directory in
+the shell changes it for Smilodon, too. A command started while another is
+still running in the background gets a separate shell.
+
+Commands run without a terminal: they do not read from the keyboard, and
+their output is passed back through pipes. Use -i for interactive programs,
+such as vim, less, an ssh login, or sudo asking for a password.
+
+-i - runs the command in a new shell attached to the terminal. It gets the
+environment variables set by earlier commands, but changes it makes to the
+directory or environment are not kept.
+-t seconds - stops the command if it runs longer than the time given
+
 Aliases: ` , sh'''
 
 setinfo_cmd = '''Usage: setinfo <infotype> <value>
@@ -84,3 +262,33 @@ Aslan_the_Lion
 大和
 karlweiß-52
 '''
+
+sort_cmd = '''Usage: <command> | sort [-r] [-n] [-u] [-k field]
+Sorts the lines from the command before it in a pipeline.
+
+-r - sort in reverse order
+-n - sort by the number at the start of the line or field
+-u - drop duplicate lines
+-k field - sort by a field, counting from 1. Fields are separated by spaces.
+'''
+
+timing_cmd = '''Usage: timing [on|off|export <file>|completion]
+Measures where the time taken by each command goes. While timing is on, a
+summary is printed after every command listing the wall-clock and CPU time
+spent parsing the command, executing it, and holding server connections.
+
+on - start printing timing summaries and recording timing spans
+off - stop timing commands
+export <file> - write the recorded spans, including those for completion, to
+a file in Chrome trace format. The file can be opened in chrome://tracing or
+https://ui.perfetto.dev. The recorded spans are cleared afterward.
+completion - show how many completion requests finished, were dropped or
+cancelled because more was typed, or were stopped at their time limit.
+'''
+
+wait_cmd = '''Usage: wait [job_id...]
+Waits for background commands to finish. The result of each one is printed
+as it finishes. If no job IDs are given, this waits for all of them. Job IDs
+are listed by the jobs command.
+
+Aliases: fg'''
@@ -0,0 +1,493 @@
+'''Implements persistent command history.
+
+History is kept in two files. The log holds one record per line: a timestamp, the host name, the
+exit status, and the command, separated by tabs. Tabs, newlines, and backslashes in commands are
+escaped so that each record is exactly one line. The index holds the byte offset of each record
+in the log as an array of native 64-bit integers. Both files are only ever appended to, under a
+file lock, so several shells on the same machine can share them.
+
+Nothing is read at startup. The files are memory-mapped on first use, and records are parsed
+only when they are needed. Reverse searches run the search on the mapped log itself, from the end
+backward, and use the index to find the record containing a match, so they take time in
+proportion to how far back the match is rather than the size of the history. Searches skip
+matches which start inside an escape sequence, so a search for t doesn't find an escaped tab.
+
+If the index is missing or doesn't match the log, it is rebuilt by scanning the log, and if it
+only falls behind the end of the log, such as after a crash between writing a record and its
+index entry, just the missing entries at the end are added. A record left partly written by a
+crash in the middle of an append is not repaired.'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from prompt_toolkit.history import History
+
+DEFAULT_HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.config', 'smilodon', 'history')
+
+# Number of records searched at a time by regular expression searches, which doubles from the
+# minimum to the maximum as the search goes further back
+SEARCH_CHUNK_MIN = 64
+SEARCH_CHUNK_MAX = 16384
+
+# Ends a pattern so that it only matches within the command, which is the last field of a record
+# and the only one after which no tab follows
+COMMAND_END = rb'[^\t\n]*$'
+
+# Starts a pattern so that it only matches at the start of a character in the log and never
+# just after the backslash of an escape sequence
+CHAR_START = rb'(?<!\\)(?:\\\\)*'
+
+# Matches any characters of a command, keeping escape sequences whole
+COMMAND_GAP = rb'(?:[^\\\t\n]|\\.)*?'
+
+# Number of matches outside of commands a plain text search checks one at a time before handing
+# the search over to the regular expression engine
+MAX_FALSE_MATCHES = 32
+
+_ESCAPES = { '\\':'\\\\', '\t':'\\t', '\n':'\\n', '\r':'\\r' }
+_UNESCAPES = { 'n':'\n', 't':'\t', 'r':'\r', '\\':'\\' }
+
+def escape_command(command: str) -> bytes:
+	'''Encodes a command in the form it is stored in the log'''
+	if '\\' in command or '\t' in command or '\n' in command or '\r' in command:
+		command = ''.join([ _ESCAPES.get(c, c) for c in command ])
+	return command.encode('utf-8', 'surrogateescape')
+
+
+def unescape_command(data: bytes) -> str:
+	'''Decodes a command stored in the log'''
+	command = data.decode('utf-8', 'replace')
+	if '\\' not in command:
+		return command
+	return re.sub(r'\\(.)', lambda m: _UNESCAPES.get(m.group(1), m.group(1)), command)
+
+
+def get_history_path() -> str:
+	'''Returns the path of the history log, which can be set with SMILODON_HISTORY'''
+	return os.getenv('SMILODON_HISTORY', DEFAULT_HISTORY_PATH)
+
+
+class HistoryRecord:
+	'''One command from the history. index is its position in the history, starting from 0 for
+the oldest command.'''
+	__slots__ = ('index', 'timestamp', 'host', 'status', 'command')
+
+	def __init__(self, index: int, timestamp: int, host: str, status: int, command: str):
+		self.index = index
+		self.timestamp = timestamp
+		self.host = host
+		self.status = status
+		self.command = command
+
+
+class HistoryStore:
+	'''Reads and appends to a history log and its index. Safe to use from multiple threads.'''
+	def __init__(self, path: str):
+		self.path = path
+		self.index_path = path + '.idx'
+		self.host = socket.gethostname()
+		self.lock = threading.RLock()
+		self.log_map = None
+		self.index_map = None
+		self.offsets = None
+		self.count = 0
+		self.mapped_size = 0
+
+	def _unmap(self):
+		self._release_index()
+		if self.log_map is not None:
+			self.log_map.close()
+			self.log_map = None
+		self.mapped_size = 0
+
+	def close(self):
+		'''Unmaps the history files'''
+		with self.lock:
+			self._unmap()
+
+	def _refresh(self):
+		'''Maps the files again if the log has grown since they were mapped, such as from another
+shell appending to it. The lock must be held.'''
+		try:
+			size = os.path.getsize(self.path)
+		except OSError:
+			size = 0
+		if size == self.mapped_size:
+			return
+
+		self._unmap()
+		if not size:
+			return
+
+		with open(self.path, 'rb') as handle:
+			self.log_map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+		self.mapped_size = len(self.log_map)
+
+		indexed = self._get_indexed_end()
+		if indexed < self.mapped_size:
+			self._repair_index(indexed)
+			indexed = self._get_indexed_end()
+
+		# Records which were partly written when the log was mapped are left for next time
+		if indexed != self.mapped_size:
+			self.mapped_size = indexed
+
+	def _release_index(self):
+		if self.offsets is not None:
+			self.offsets.release()
+			self.offsets = None
+		if self.index_map is not None:
+			self.index_map.close()
+			self.index_map = None
+		self.count = 0
+
+	def _map_index(self):
+		self._release_index()
+		try:
+			size = os.path.getsize(self.index_path)
+		except OSError:
+			size = 0
+		size -= size % 8
+		if size:
+			with open(self.index_path, 'rb') as handle:
+				self.index_map = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+			self.offsets = memoryview(self.index_map).cast('Q')
+			self.count = len(self.offsets)
+
+	def _get_indexed_end(self) -> int:
+		'''Maps the index and returns the offset in the log just past the last record it covers.
+An index which doesn't match the log is discarded.'''
+		self._map_index()
+
+		# Another shell may have added records since the log was mapped. Their entries are left
+		# for the next refresh.
+		self.count = bisect_left(self.offsets, self.mapped_size) if self.count else 0
+		if not self.count:
+			return 0
+
+		last = self.offsets[self.count - 1]
+		if last and self.log_map[last - 1] != 0x0a:
+			self._discard_index(self.count - 1, last)
+			return 0
+
+		end = self.log_map.find(b'\n', last)
+		if end < 0:
+			return last
+		return end + 1
+
+	def _discard_index(self, position: int, offset: int):
+		'''Empties an index whose entry at position, offset, doesn't start a record in the log, so
+that it is rebuilt from the log'''
+		self._release_index()
+		with open(self.path, 'ab') as log, open(self.index_path, 'r+b') as handle:
+			if fcntl:
+				fcntl.flock(log, fcntl.LOCK_EX)
+			try:
+				# Another shell may have rebuilt the index while we waited for the lock, so it is
+				# checked again against the log on disk
+				handle.seek(position * 8)
+				entry = handle.read(8)
+				if len(entry) != 8 or array('Q', entry)[0] != offset:
+					return
+				with open(self.path, 'rb') as reader:
+					reader.seek(offset - 1)
+					if reader.read(1) == b'\n':
+						return
+				handle.truncate(0)
+			finally:
+				if fcntl:
+					fcntl.flock(log, fcntl.LOCK_UN)
+
+	def _repair_index(self, start: int):
+		'''Adds index entries for the records in the log from start onward'''
+		count = self.count
+		self._release_index()
+
+		# Appends hold the lock on the log while writing to both files, so holding it here means
+		# no record is half-added
+		with open(self.path, 'ab') as log, open(self.index_path, 'ab') as handle:
+			if fcntl:
+				fcntl.flock(log, fcntl.LOCK_EX)
+			try:
+				# Another shell may have added to the index while we waited for the lock
+				if os.path.getsize(self.index_path) // 8 != count:
+					return
+
+				offsets = array('Q')
+				position = start
+				while position < self.mapped_size:
+					end = self.log_map.find(b'\n', position)
+					if end < 0:
+						break
+					offsets.append(position)
+					position = end + 1
+				handle.write(offsets.tobytes())
+			finally:
+				if fcntl:
+					fcntl.flock(log, fcntl.LOCK_UN)
+
+	def append(self, command: str, status: int = 0, timestamp: int = 0, host: str = ''):
+		'''Adds a command to the end of the history'''
+		record = b'%d\t%s\t%d\t%s\n' % (timestamp or int(time.time()),
+			(host or self.host).encode('utf-8'), status, escape_command(command))
+
+		with self.lock:
+			folder = os.path.dirname(self.path)
+			if folder:
+				os.makedirs(folder, exist_ok=True)
+
+			with open(self.path, 'ab') as log, open(self.index_path, 'ab') as index:
+				if fcntl:
+					fcntl.flock(log, fcntl.LOCK_EX)
+				try:
+					offset = log.seek(0, os.SEEK_END)
+					log.write(record)
+					log.flush()
+					index.write(array('Q', [ offset ]).tobytes())
+					# Other shells check the index against the log once they hold the lock, so the
+					# entry has to be in the file before it is released
+					index.flush()
+				finally:
+					if fcntl:
+						fcntl.flock(log, fcntl.LOCK_UN)
+
+	def __len__(self) -> int:
+		with self.lock:
+			self._refresh()
+			return self.count
+
+	def _get_record_bounds(self, index: int) -> tuple:
+		start = self.offsets[index]
+		if index + 1 < self.count:
+			return start, self.offsets[index + 1] - 1
+		return start, self.mapped_size - 1
+
+	def _parse(self, index: int) -> HistoryRecord:
+		start, end = self._get_record_bounds(index)
+		fields = self.log_map[start:end].split(b'\t', 3)
+		if len(fields) != 4:
+			return HistoryRecord(index, 0, '', 0, unescape_command(fields[-1]))
+		try:
+			timestamp = int(fields[0])
+			status = int(fields[2])
+		except ValueError:
+			timestamp = status = 0
+		return HistoryRecord(index, timestamp, fields[1].decode('utf-8', 'replace'), status,
+							unescape_command(fields[3]))
+
+	def _get_command_start(self, index: int) -> int:
+		'''Returns the offset in the log of a record's command'''
+		start, end = self._get_record_bounds(index)
+		position = start
+		for _ in range(3):
+			tab = self.log_map.find(b'\t', position, end)
+			if tab < 0:
+				return start
+			position = tab + 1
+		return position
+
+	def get(self, index: int) -> HistoryRecord:
+		'''Returns a record by its position in the history'''
+		with self.lock:
+			self._refresh()
+			if index < 0:
+				index += self.count
+			if not 0 <= index < self.count:
+				raise IndexError('history index out of range')
+			return self._parse(index)
+
+	def iter_forward(self, chunk_size: int = 1024):
+		'''Generator which yields records from oldest to newest. Records added while it runs are 
+not included.'''
+		with self.lock:
+			self._refresh()
+			count = self.count
+		for start in range(0, count, chunk_size):
+			with self.lock:
+				records = [ self._parse(i) for i in range(start, min(start + chunk_size, count)) ]
+			yield from records
+
+	def iter_reverse(self, before: int = -1):
+		'''Generator which yields records from newest to oldest, starting with the one before the
+index given or the newest if it is negative'''
+		with self.lock:
+			self._refresh()
+			index = self.count if before < 0 else min(before, self.count)
+		while index > 0:
+			index -= 1
+			with self.lock:
+				record = self._parse(index)
+			yield record
+
+	def _is_escaped(self, position: int, start: int) -> bool:
+		'''Returns True if the byte at position in the log follows the backslash of an escape
+sequence. start is the offset of the command containing it.'''
+		backslashes = 0
+		while position - backslashes > start and self.log_map[position - backslashes - 1] == 0x5c:
+			backslashes += 1
+		return backslashes % 2 == 1
+
+	def search(self, text: str, before: int = -1) -> HistoryRecord:
+		'''Returns the newest record older than before whose command contains the text. None is
+returned if there is no match.'''
+		needle = escape_command(text)
+
+		with self.lock:
+			self._refresh()
+			if not self.count:
+				return None
+			end = self.mapped_size if before < 0 or before >= self.count else self.offsets[before]
+			for _ in range(MAX_FALSE_MATCHES):
+				position = self.log_map.rfind(needle, 0, end)
+				if position < 0:
+					return None
+
+				index = bisect_right(self.offsets, position) - 1
+				commandStart = self._get_command_start(index)
+				if position >= commandStart:
+					if not self._is_escaped(position, commandStart):
+						return self._parse(index)
+
+					# Earlier matches in the same command may still be real ones
+					end = position + len(needle) - 1
+					continue
+
+				# The rightmost match in a record wasn't in its command, so none of the others are
+				end = self.offsets[index]
+				before = index
+
+		# The text is common in the other fields or in escape sequences, so let the regular
+		# expression engine skip over those matches instead
+		return self._search_lines(re.compile(CHAR_START + re.escape(needle) + COMMAND_END,
+			re.MULTILINE), before)
+
+	def search_regex(self, pattern, before: int = -1) -> HistoryRecord:
+		'''Returns the newest record older than before whose command matches a compiled bytes
+regular expression. None is returned if there is no match.'''
+		source = pattern.pattern
+		if source.startswith(b'^'):
+			# The command starts just after the last tab in the record
+			source = b'\t' + source[1:]
+		return self._search_lines(re.compile(CHAR_START + rb'(?:' + source + rb')' + COMMAND_END,
+			pattern.flags | re.MULTILINE), before)
+
+	def _search_lines(self, linePattern, before: int) -> HistoryRecord:
+		'''Returns the newest record older than before containing a match for a pattern. Records
+are searched in chunks, working backward. The chunks start small so that recent matches are found
+quickly and grow to limit the overhead on long searches.'''
+		with self.lock:
+			self._refresh()
+			high = self.count if before < 0 else min(before, self.count)
+			chunk = SEARCH_CHUNK_MIN
+			while high > 0:
+				low = max(0, high - chunk)
+				end = self.offsets[high] if high < self.count else self.mapped_size
+				last = None
+				for match in linePattern.finditer(self.log_map, self.offsets[low], end):
+					last = match
+				if last:
+					return self._parse(bisect_right(self.offsets, last.start()) - 1)
+				high = low
+				chunk = min(chunk * 2, SEARCH_CHUNK_MAX)
+			return None
+
+	def search_fuzzy(self, text: str, before: int = -1) -> HistoryRecord:
+		'''Returns the newest record older than before whose command contains the characters of
+the text in order, ignoring case'''
+		if not text:
+			return self.search('', before)
+		parts = [ re.escape(escape_command(c)) for c in text ]
+		return self.search_regex(re.compile(COMMAND_GAP.join(parts), re.IGNORECASE), before)
+
+	def find(self, text: str = '', pattern=None, failed: bool = False, host: str = ''):
+		'''Generator which yields records from newest to oldest whose commands contain the text
+or match a compiled bytes regular expression, if given. If failed is True, only records for
+commands which failed are included, and if host is given, only those run on that host.'''
+		if pattern is None and not text:
+			records = self.iter_reverse()
+		else:
+			records = self._iter_matches(text, pattern)
+
+		for record in records:
+			if failed and not record.status:
+				continue
+			if host and record.host != host:
+				continue
+			yield record
+
+	def _iter_matches(self, text: str, pattern):
+		before = -1
+		while before != 0:
+			if pattern is not None:
+				record = self.search_regex(pattern, before)
+			else:
+				record = self.search(text, before)
+			if record is None:
+				return
+			before = record.index
+			yield record
+
+
+class PromptHistory(History):
+	'''Provides the most recent commands from a HistoryStore to prompt_toolkit for browsing with
+the arrow keys. Commands are added to the store by the shell along with their exit status, so
+store_string does nothing.'''
+	def __init__(self, store: HistoryStore, limit: int = 1000):
+		super().__init__()
+		self.store = store
+		self.limit = limit
+
+	def load_history_strings(self):
+		seen = set()
+		for record in self.store.iter_reverse():
+			if record.command in seen:
+				continue
+			seen.add(record.command)
+			yield record.command
+			if len(seen) >= self.limit:
+				break
+
+	def store_string(self, string: str):
+		pass
+
+
+def make_search_bindings(store: HistoryStore):
+	'''Returns prompt_toolkit key bindings which make Ctrl-R search the history for the text typed
+so far. The newest command containing the text is used, or if there isn't one, the newest one
+containing its characters in order. Pressing Ctrl-R again finds the next older match.'''
+	from prompt_toolkit.key_binding import KeyBindings
+
+	bindings = KeyBindings()
+	state = { 'query':'', 'result':None, 'index':-1 }
+
+	@bindings.add('c-r')
+	def _(event):
+		buffer = event.current_buffer
+		if buffer.text != state['result']:
+			state['query'] = buffer.text
+			state['index'] = -1
+
+		record = store.search(state['query'], state['index'])
+		if record is None:
+			record = store.search_fuzzy(state['query'], state['index'])
+		if record is None:
+			event.app.output.bell()
+			return
+
+		state['index'] = record.index
+		state['result'] = record.command
+		buffer.text = record.command
+		buffer.cursor_position = len(record.command)
+
+	return bindings
@@ -0,0 +1,92 @@
+'''Implements the table of commands running in the background'''
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import threading
+import time
+
+class Job:
+	'''A command running in the background'''
+	def __init__(self, job_id: int, command_line: str, future):
+		self.id = job_id
+		self.command_line = command_line
+		self.future = future
+		self.started = time.time()
+		self.finished = 0.0
+
+	def get_status(self) -> str:
+		'''Returns Running, Done, or an error message'''
+		if not self.future.done():
+			return 'Running'
+
+		try:
+			error = self.future.result()
+		except SystemExit:
+			return 'Done'
+		except Exception as e:
+			return '%s: %s' % (type(e).__name__, e)
+		if error:
+			return error
+		return 'Done'
+
+	def get_elapsed(self) -> float:
+		'''Returns the number of seconds the job has been running or ran for'''
+		if self.finished:
+			return self.finished - self.started
+		return time.time() - self.started
+
+
+class JobTable:
+	'''Runs commands in worker threads and keeps track of them until their results are
+collected'''
+	def __init__(self, max_workers: int = 8):
+		self.executor = ThreadPoolExecutor(max_workers=max_workers,
+											thread_name_prefix='smilodon-job')
+		self.jobs = collections.OrderedDict()
+		self.next_id = 1
+		self.lock = threading.Lock()
+
+	def submit(self, command_line: str, func, on_done=None) -> Job:
+		'''Runs func in the background. func is expected to return an empty string on success
+or an error message. If given, on_done is called with the Job when it finishes.'''
+		with self.lock:
+			job_id = self.next_id
+			self.next_id += 1
+			future = self.executor.submit(func)
+			job = Job(job_id, command_line, future)
+			self.jobs[job_id] = job
+
+		def finish(_):
+			job.finished = time.time()
+			if on_done:
+				on_done(job)
+		future.add_done_callback(finish)
+		return job
+
+	def run(self, func):
+		'''Runs func in a worker thread without adding it to the table. Returns a
+concurrent.futures.Future.'''
+		return self.executor.submit(func)
+
+	def get_jobs(self) -> list:
+		'''Returns a list of all jobs which have not been collected'''
+		with self.lock:
+			return list(self.jobs.values())
+
+	def get_job(self, job_id: int) -> Job:
+		'''Returns the job with the specified ID or None if there isn't one'''
+		with self.lock:
+			return self.jobs.get(job_id)
+
+	def collect(self, job: Job, timeout=None) -> str:
+		'''Waits for a job to finish, removes it from the table, and returns its status'''
+		job.future.exception(timeout)
+		with self.lock:
+			self.jobs.pop(job.id, None)
+		return job.get_status()
+
+	def remove_finished(self):
+		'''Removes all jobs which have finished from the table'''
+		with self.lock:
+			for job_id in [ k for k,v in self.jobs.items() if v.future.done() ]:
+				del self.jobs[job_id]
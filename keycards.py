@@ -0,0 +1,426 @@
+'''Signs and verifies keycards in batches.
+
+A keycard is a chain of entries, each a block of Field:Value lines between BEGIN ENTRY and END
+ENTRY markers. Every entry carries an Ed25519 Verification-Key and a Signature made with the
+matching signing key. Every entry after the first also carries a Custody-Signature made with the
+previous entry's key, which is what ties the entries into a chain.
+
+This is a simplified test format, not the one Anselus uses. Real keycards carry a
+Primary-Verification-Key and Organization-Signature and User-Signature fields, with their own
+rules for what each signature covers, so they can't be checked with this module yet. Smilodon
+therefore has no command for checking keycards. The module is used by scripts and by the keycards
+benchmark suite, with test keycards generated by running it as a script.
+
+Signing and verifying thousands of keycards is CPU-bound, so the batch functions split the work
+into chunks and run them on a pool of worker processes. Chains which pass are remembered by a hash
+of their entries, so checking an unchanged keycard again costs one hash and checking one which
+has had entries added verifies only the new ones.
+
+Keycards are kept in files ending in .kc in the folder named by the SMILODON_KEYCARDS environment
+variable or, if it is not set, DEFAULT_KEYCARD_FOLDER. Run this module as a script to generate
+signed test keycards.'''
+
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import nacl.signing
+from nacl.exceptions import BadSignatureError
+
+DEFAULT_KEYCARD_FOLDER = os.path.join(os.path.expanduser('~'), '.config', 'smilodon', 'keycards')
+
+ENTRY_BEGIN = '----- BEGIN ENTRY -----'
+ENTRY_END = '----- END ENTRY -----'
+KEY_FIELD = 'Verification-Key'
+CUSTODY_FIELD = 'Custody-Signature'
+SIGNATURE_FIELD = 'Signature'
+KEY_PREFIX = 'ED25519:'
+
+# Signatures are sent to worker processes in chunks of this many, which keeps the cost of passing
+# them between processes small next to the cost of checking them
+CHUNK_SIZE = 256
+
+# Batches smaller than this are done in this process, since starting workers would take longer
+PARALLEL_THRESHOLD = 1024
+
+# Maximum number of verified entry chains remembered
+MAX_CACHED_CHAINS = 100000
+
+def get_keycard_folder() -> str:
+	'''Returns the folder holding keycards, which can be set with SMILODON_KEYCARDS'''
+	return os.getenv('SMILODON_KEYCARDS', DEFAULT_KEYCARD_FOLDER)
+
+
+def encode_key(data: bytes) -> str:
+	'''Returns a key or signature in the text form used in keycards'''
+	return KEY_PREFIX + base64.b85encode(data).decode('ascii')
+
+
+def decode_key(text: str) -> bytes:
+	'''Returns the bytes of a key or signature in keycard form. ValueError is raised if it is not
+an Ed25519 value.'''
+	if not text.startswith(KEY_PREFIX):
+		raise ValueError('Unsupported key type in %s' % text[:16])
+	return base64.b85decode(text[len(KEY_PREFIX):])
+
+
+def generate_signing_key() -> tuple:
+	'''Returns a new signing key and its verification key in keycard form'''
+	key = nacl.signing.SigningKey.generate()
+	return encode_key(bytes(key)), encode_key(bytes(key.verify_key))
+
+
+class Entry:
+	'''One entry in a keycard. fields maps field names to values in the order they appear.'''
+	def __init__(self, fields: dict = None):
+		self.fields = dict(fields) if fields else dict()
+
+	def get_signed_data(self, field: str) -> bytes:
+		'''Returns the bytes covered by a signature field: every field other than the
+signatures and, for Signature, the Custody-Signature as well'''
+		lines = [ '%s:%s\r\n' % (name, value) for name, value in self.fields.items()
+				if name not in (CUSTODY_FIELD, SIGNATURE_FIELD) ]
+		if field == SIGNATURE_FIELD and CUSTODY_FIELD in self.fields:
+			lines.append('%s:%s\r\n' % (CUSTODY_FIELD, self.fields[CUSTODY_FIELD]))
+		return ''.join(lines).encode('utf-8')
+
+	def __str__(self):
+		lines = [ ENTRY_BEGIN ]
+		lines.extend([ '%s:%s' % (name, value) for name, value in self.fields.items() ])
+		lines.append(ENTRY_END)
+		return '\n'.join(lines) + '\n'
+
+
+def parse_keycard(text: str) -> list:
+	'''Returns the entries in a keycard's text. ValueError is raised if it is malformed.'''
+	entries = list()
+	current = None
+	for lineNumber, line in enumerate(text.splitlines(), 1):
+		line = line.strip()
+		if not line:
+			continue
+		if line == ENTRY_BEGIN:
+			if current is not None:
+				raise ValueError('Line %s: entry started before the last one ended' % lineNumber)
+			current = Entry()
+		elif line == ENTRY_END:
+			if current is None:
+				raise ValueError('Line %s: end of an entry which was not started' % lineNumber)
+			entries.append(current)
+			current = None
+		else:
+			if current is None:
+				raise ValueError('Line %s: field outside of an entry' % lineNumber)
+			name, sep, value = line.partition(':')
+			if not sep or not name:
+				raise ValueError('Line %s: not a field' % lineNumber)
+			current.fields[name] = value
+
+	if current is not None:
+		raise ValueError('The last entry was not ended')
+	if not entries:
+		raise ValueError('No entries')
+	return entries
+
+
+def format_keycard(entries: list) -> str:
+	'''Returns the text of a keycard'''
+	return ''.join([ str(e) for e in entries ])
+
+
+def _sign_chunk(chunk: list) -> list:
+	'''Signs a list of (data, signing key) pairs. Runs in worker processes.'''
+	return [ nacl.signing.SigningKey(key).sign(data).signature for data, key in chunk ]
+
+
+def _verify_chunk(chunk: list) -> list:
+	'''Checks a list of (data, signature, verification key) tuples, returning a list of bools.
+Runs in worker processes.'''
+	results = list()
+	for data, signature, key in chunk:
+		try:
+			nacl.signing.VerifyKey(key).verify(data, signature)
+			results.append(True)
+		except (BadSignatureError, ValueError, TypeError):
+			results.append(False)
+	return results
+
+
+_gPool = None
+_gPoolWorkers = 0
+_gPoolLock = threading.Lock()
+
+def _get_pool(workers: int) -> concurrent.futures.ProcessPoolExecutor:
+	'''Returns the shared worker pool, starting it if needed'''
+	global _gPool, _gPoolWorkers
+	with _gPoolLock:
+		if _gPool is not None and _gPoolWorkers != workers:
+			_gPool.shutdown()
+			_gPool = None
+		if _gPool is None:
+			# The shell has threads running, which fork() would copy in an unknown state, so
+			# workers are forked from a clean server process where that is available
+			context = None
+			if 'forkserver' in multiprocessing.get_all_start_methods():
+				context = multiprocessing.get_context('forkserver')
+			_gPool = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+				mp_context=context)
+			_gPoolWorkers = workers
+		return _gPool
+
+
+def shutdown_pool():
+	'''Stops the worker processes. They are started again when needed.'''
+	global _gPool
+	with _gPoolLock:
+		if _gPool is not None:
+			_gPool.shutdown()
+			_gPool = None
+
+
+def _run_batch(func, items: list, jobs: int) -> list:
+	'''Runs a chunk function over a list of items, using up to jobs worker processes, and returns
+the combined results in order. A jobs value of 0 uses one worker per CPU.'''
+	if jobs <= 0:
+		jobs = os.cpu_count() or 1
+	if jobs == 1 or len(items) < PARALLEL_THRESHOLD:
+		return func(items)
+
+	chunks = [ items[i:i + CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE) ]
+	results = list()
+	for chunkResults in _get_pool(jobs).map(func, chunks):
+		results.extend(chunkResults)
+	return results
+
+
+def sign_batch(items: list, jobs: int = 0) -> list:
+	'''Signs a list of (data, signing key) pairs, where keys are raw 32-byte seeds, and returns
+the signatures in the same order'''
+	return _run_batch(_sign_chunk, items, jobs)
+
+
+def verify_batch(items: list, jobs: int = 0) -> list:
+	'''Checks a list of (data, signature, verification key) tuples, all raw bytes, and returns a
+list of bools in the same order'''
+	return _run_batch(_verify_chunk, items, jobs)
+
+
+def sign_entries(requests: list, jobs: int = 0) -> list:
+	'''Signs entries in place. requests is a list of (entry, signing key, custody key) tuples
+with keys in keycard form. The entry's Verification-Key is set from its signing key. The custody
+key, which belongs to the previous entry in the chain, is empty for an entry which starts a
+chain. Returns the entries.'''
+	keys = list()
+	for entry, signingKey, custodyKey in requests:
+		seed = decode_key(signingKey)
+		entry.fields.pop(SIGNATURE_FIELD, None)
+		entry.fields.pop(CUSTODY_FIELD, None)
+		entry.fields[KEY_FIELD] = encode_key(bytes(nacl.signing.SigningKey(seed).verify_key))
+		keys.append((seed, decode_key(custodyKey) if custodyKey else None))
+
+	# The Signature covers the Custody-Signature, so custody signatures are made first
+	custody = [ (i, (requests[i][0].get_signed_data(CUSTODY_FIELD), keys[i][1]))
+				for i in range(len(requests)) if keys[i][1] ]
+	signatures = sign_batch([ item for _, item in custody ], jobs)
+	for (i, _), signature in zip(custody, signatures):
+		requests[i][0].fields[CUSTODY_FIELD] = encode_key(signature)
+
+	signatures = sign_batch([ (entry.get_signed_data(SIGNATURE_FIELD), keys[i][0])
+							for i, (entry, _, _) in enumerate(requests) ], jobs)
+	for (entry, _, _), signature in zip(requests, signatures):
+		entry.fields[SIGNATURE_FIELD] = encode_key(signature)
+	return [ entry for entry, _, _ in requests ]
+
+
+class ChainResult:
+	'''The outcome of verifying one keycard. entries is the number of entries in the chain and
+cached the number which had already been verified. error is empty if the chain is valid.'''
+	def __init__(self, name: str):
+		self.name = name
+		self.entries = 0
+		self.cached = 0
+		self.signatures = 0
+		self.error = ''
+
+
+class KeycardVerifier:
+	'''Verifies keycard chains, remembering those which passed. A chain is remembered by a hash
+of each of its entries in turn, so a chain which has grown is recognized as far as it goes.'''
+	def __init__(self, max_cached: int = MAX_CACHED_CHAINS):
+		self.max_cached = max_cached
+		self.lock = threading.Lock()
+		self.verified = dict()
+
+	def clear(self):
+		'''Forgets every verified chain'''
+		with self.lock:
+			self.verified.clear()
+
+	def _remember(self, digests: list):
+		'''Adds the digests of a verified chain, dropping the oldest ones if the cache is full'''
+		with self.lock:
+			for digest in digests:
+				self.verified[digest] = True
+			while len(self.verified) > self.max_cached:
+				del self.verified[next(iter(self.verified))]
+
+	def verify_chains(self, chains: list, jobs: int = 0) -> list:
+		'''Verifies a list of (name, keycard text) pairs and returns a ChainResult for each. The
+signatures from every chain are checked together in one batch.'''
+		results = list()
+		checks = list()
+		pending = list()
+		for name, text in chains:
+			result = ChainResult(name)
+			results.append(result)
+			try:
+				entries = parse_keycard(text)
+			except ValueError as e:
+				result.error = str(e)
+				continue
+			result.entries = len(entries)
+
+			hasher = hashlib.blake2b(digest_size=20)
+			digests = list()
+			for entry in entries:
+				hasher.update(str(entry).encode('utf-8'))
+				digests.append(hasher.digest())
+
+			with self.lock:
+				for index in range(len(digests) - 1, -1, -1):
+					if digests[index] in self.verified:
+						result.cached = index + 1
+						break
+			if result.cached == len(entries):
+				continue
+
+			try:
+				chainChecks = self._get_checks(entries, result.cached)
+			except ValueError as e:
+				result.error = str(e)
+				continue
+			result.signatures = len(chainChecks)
+			pending.append((result, len(checks), len(checks) + len(chainChecks), digests))
+			checks.extend(chainChecks)
+
+		outcomes = verify_batch([ check for check, _ in checks ], jobs)
+		for result, first, last, digests in pending:
+			for index in range(first, last):
+				if not outcomes[index]:
+					result.error = checks[index][1]
+					break
+			else:
+				self._remember(digests)
+		return results
+
+	@staticmethod
+	def _get_checks(entries: list, start: int) -> list:
+		'''Returns the signature checks needed for the entries of a chain from start onward as
+((data, signature, key), error message) pairs. The entry before start has already been verified.
+ValueError is raised for entries missing a key or signature.'''
+		checks = list()
+		for index in range(start, len(entries)):
+			entry = entries[index]
+			number = index + 1
+			for field in (KEY_FIELD, SIGNATURE_FIELD):
+				if field not in entry.fields:
+					raise ValueError('Entry %s has no %s' % (number, field))
+			key = decode_key(entry.fields[KEY_FIELD])
+			checks.append(((entry.get_signed_data(SIGNATURE_FIELD),
+				decode_key(entry.fields[SIGNATURE_FIELD]), key),
+				'Entry %s has a bad signature' % number))
+
+			if index == 0:
+				continue
+			if CUSTODY_FIELD not in entry.fields:
+				raise ValueError('Entry %s has no %s' % (number, CUSTODY_FIELD))
+			checks.append(((entry.get_signed_data(CUSTODY_FIELD),
+				decode_key(entry.fields[CUSTODY_FIELD]),
+				decode_key(entries[index - 1].fields[KEY_FIELD])),
+				'Entry %s was not signed by the key of entry %s' % (number, index)))
+		return checks
+
+
+def read_keycards(paths: list) -> tuple:
+	'''Reads keycard files, returning a list of (path, text) pairs and a list of (path, error)
+pairs for those which couldn't be read'''
+	chains = list()
+	errors = list()
+	for path in paths:
+		try:
+			with open(path, encoding='utf-8') as handle:
+				chains.append((path, handle.read()))
+		except (OSError, UnicodeDecodeError) as e:
+			errors.append((path, str(e)))
+	return chains, errors
+
+
+def find_keycards(folder: str) -> list:
+	'''Returns the paths of the keycard files in a folder, sorted by name'''
+	with os.scandir(folder) as entries:
+		return sorted([ e.path for e in entries if e.name.endswith('.kc') and e.is_file() ])
+
+
+def generate_keycards(folder: str, count: int, length: int, jobs: int = 0) -> float:
+	'''Writes count keycards with chains of length entries, signed with new keys which are
+thrown away, and returns the number of seconds spent signing'''
+	os.makedirs(folder, exist_ok=True)
+	cards = list()
+	for number in range(count):
+		keys = [ generate_signing_key()[0] for _ in range(length) ]
+		entries = list()
+		for index in range(length):
+			entries.append((Entry({ 'Type':'User', 'Index':str(index + 1),
+				'Workspace-ID':'test-%06d' % number,
+				'Timestamp':time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) }),
+				keys[index], keys[index - 1] if index else ''))
+		cards.append(entries)
+
+	# The chains are signed in one batch, a level at a time, so each entry's custody signature
+	# can be made once the entry before it is final
+	start = time.perf_counter()
+	for index in range(length):
+		sign_entries([ card[index] for card in cards ], jobs)
+	elapsed = time.perf_counter() - start
+
+	for number, card in enumerate(cards):
+		with open(os.path.join(folder, 'test-%06d.kc' % number), 'w', encoding='utf-8') as handle:
+			handle.write(format_keycard([ entry for entry, _, _ in card ]))
+	return elapsed
+
+
+def main() -> int:
+	'''Generates test keycards from the command line'''
+	parser = argparse.ArgumentParser(description='Generates signed keycards for testing')
+	parser.add_argument('folder', help='folder to write the keycards to')
+	parser.add_argument('--count', type=int, default=1000, help='number of keycards')
+	parser.add_argument('--entries', type=int, default=3, help='entries in each keycard')
+	parser.add_argument('--jobs', type=int, default=0,
+		help='worker processes to sign with. Default: one per CPU')
+	args = parser.parse_args()
+
+	if args.count < 1 or args.entries < 1:
+		print('The count and number of entries must be at least 1', file=sys.stderr)
+		return 2
+	try:
+		elapsed = generate_keycards(args.folder, args.count, args.entries, args.jobs)
+	except OSError as e:
+		print("Couldn't write keycards: %s" % e, file=sys.stderr)
+		return 2
+	finally:
+		shutdown_pool()
+
+	signatures = args.count * (args.entries * 2 - 1)
+	print('Wrote %s keycards, %s signatures in %.2fs (%.0f signatures/s)' % (args.count,
+		signatures, elapsed, signatures / max(elapsed, 1e-9)))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
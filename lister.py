@@ -0,0 +1,612 @@
+'''Implements directory listings for the ls command without starting an external process.
+
+Directories are read with os.scandir, which provides each entry's type without a separate stat
+call, so file information is only looked up when the options in use need it. Name-sorted short
+listings come straight from the completion cache in fscache, and every directory scanned here is
+added to that cache so that completing a path right after listing it doesn't read it again.
+Output is written in batches as it is formatted. Unsorted listings (-U) in single-column or long
+format are written while the directory is still being read, so very large directories start
+printing immediately.'''
+
+from bisect import bisect_left
+import fnmatch
+import glob
+import os
+import shutil
+import stat
+import sys
+import time
+
+from prompt_toolkit.utils import get_cwidth
+
+from fscache import gDirCache
+
+try:
+	import grp
+	import pwd
+except ImportError:
+	grp = None
+	pwd = None
+
+# Number of lines formatted before they are written out
+BATCH_SIZE = 1000
+
+# Colors used when LS_COLORS is not set. These match the GNU ls defaults for the types shown.
+DEFAULT_COLORS = {
+	'di':'01;34',
+	'ln':'01;36',
+	'ex':'01;32',
+	'pi':'40;33',
+	'so':'01;35',
+	'bd':'40;33;01',
+	'cd':'40;33;01',
+}
+
+OPTION_LETTERS = {
+	'a':'all',
+	'A':'almost_all',
+	'd':'directory',
+	'F':'classify',
+	'h':'human',
+	'l':'long',
+	'R':'recursive',
+	'r':'reverse',
+	'S':'size_sort',
+	't':'time_sort',
+	'U':'unsorted',
+	'1':'one_column',
+}
+
+LONG_OPTIONS = {
+	'--all':'all',
+	'--almost-all':'almost_all',
+	'--directory':'directory',
+	'--classify':'classify',
+	'--human-readable':'human',
+	'--recursive':'recursive',
+	'--reverse':'reverse',
+}
+
+class ListOptions:
+	'''The options for one listing'''
+	def __init__(self):
+		self.all = False
+		self.almost_all = False
+		self.directory = False
+		self.classify = False
+		self.human = False
+		self.long = False
+		self.recursive = False
+		self.reverse = False
+		self.size_sort = False
+		self.time_sort = False
+		self.unsorted = False
+		self.one_column = False
+		self.color = 'auto'
+		self.width = 80
+
+	def needs_stat(self) -> bool:
+		'''Returns True if the options require file information beyond each entry's type'''
+		return self.long or self.size_sort or self.time_sort
+
+
+def parse_options(args) -> tuple:
+	'''Parses ls arguments into a ListOptions object and a list of paths. Returns the two along
+with an error string, which is empty on success.'''
+	options = ListOptions()
+	paths = list()
+	options_done = False
+	for arg in args:
+		if options_done or arg == '-' or not arg.startswith('-'):
+			paths.append(arg)
+		elif arg == '--':
+			options_done = True
+		elif arg.startswith('--color'):
+			when = arg[8:] if arg.startswith('--color=') else 'always'
+			if when not in [ 'always', 'auto', 'never' ]:
+				return options, paths, "ls: invalid argument '%s' for '--color'" % when
+			options.color = when
+		elif arg.startswith('--'):
+			if arg not in LONG_OPTIONS:
+				return options, paths, "ls: unrecognized option '%s'" % arg
+			setattr(options, LONG_OPTIONS[arg], True)
+		else:
+			for letter in arg[1:]:
+				if letter not in OPTION_LETTERS:
+					return options, paths, "ls: invalid option -- '%s'" % letter
+				setattr(options, OPTION_LETTERS[letter], True)
+
+	# As with GNU ls, the last of -t and -S given wins, but this is close enough
+	if options.unsorted:
+		options.size_sort = options.time_sort = False
+	elif options.size_sort:
+		options.time_sort = False
+	return options, paths, ''
+
+
+class Entry:
+	'''One item in a listing. File information is looked up on first use.'''
+	__slots__ = ('name', 'path', 'isdir', 'islink', 'direntry', 'st')
+
+	def __init__(self, name: str, path: str, isdir: bool, islink: bool = False, direntry=None):
+		self.name = name
+		self.path = path
+		self.isdir = isdir
+		self.islink = islink
+		self.direntry = direntry
+		self.st = None
+
+	@classmethod
+	def from_direntry(cls, direntry):
+		'''Creates an Entry from an os.DirEntry'''
+		try:
+			isdir = direntry.is_dir()
+			islink = direntry.is_symlink()
+		except OSError:
+			isdir = islink = False
+		return cls(direntry.name, direntry.path, isdir, islink, direntry)
+
+	def get_stat(self):
+		'''Returns the lstat information for the entry or None if it can't be read'''
+		if self.st is None:
+			try:
+				if self.direntry is not None:
+					self.st = self.direntry.stat(follow_symlinks=False)
+				else:
+					self.st = os.lstat(self.path)
+			except OSError:
+				return None
+		return self.st
+
+
+class _Output:
+	'''Collects lines and writes them out in batches'''
+	def __init__(self, stream):
+		self.stream = stream
+		self.lines = list()
+		self.written = False
+
+	def add(self, line: str):
+		'''Queues a line for output'''
+		self.lines.append(line)
+		if len(self.lines) >= BATCH_SIZE:
+			self.flush()
+
+	def flush(self):
+		'''Writes out all queued lines'''
+		if self.lines:
+			self.stream.write('\n'.join(self.lines) + '\n')
+			self.stream.flush()
+			self.lines = list()
+			self.written = True
+
+
+class Lister:
+	'''Formats and prints listings with a particular set of options'''
+	def __init__(self, options: ListOptions, stream):
+		self.options = options
+		self.out = _Output(stream)
+		self.errors = list()
+		self.users = dict()
+		self.groups = dict()
+		self.times = dict()
+		self.now = time.time()
+		self.colors = None
+		self.extension_colors = dict()
+
+		use_color = options.color == 'always'
+		if options.color == 'auto':
+			use_color = hasattr(stream, 'isatty') and stream.isatty()
+		if use_color:
+			self._load_colors()
+
+	def _load_colors(self):
+		'''Sets up the colors to use from LS_COLORS or the defaults'''
+		self.colors = dict(DEFAULT_COLORS)
+		for item in os.getenv('LS_COLORS', '').split(':'):
+			key, _, value = item.partition('=')
+			if not value:
+				continue
+			if key.startswith('*.'):
+				self.extension_colors[key[1:].lower()] = value
+			else:
+				self.colors[key] = value
+
+	def _get_color(self, entry: Entry) -> str:
+		if entry.islink:
+			return self.colors.get('ln', '')
+		if entry.isdir:
+			return self.colors.get('di', '')
+
+		st = entry.get_stat()
+		if st is not None:
+			if stat.S_ISFIFO(st.st_mode):
+				return self.colors.get('pi', '')
+			if stat.S_ISSOCK(st.st_mode):
+				return self.colors.get('so', '')
+			if stat.S_ISBLK(st.st_mode):
+				return self.colors.get('bd', '')
+			if stat.S_ISCHR(st.st_mode):
+				return self.colors.get('cd', '')
+			if st.st_mode & 0o111:
+				return self.colors.get('ex', '')
+
+		if self.extension_colors:
+			extension = os.path.splitext(entry.name)[1].lower()
+			if extension in self.extension_colors:
+				return self.extension_colors[extension]
+		return ''
+
+	def _get_indicator(self, entry: Entry) -> str:
+		if entry.islink:
+			return '@'
+		if entry.isdir:
+			return '/'
+
+		st = entry.get_stat()
+		if st is None:
+			return ''
+		if stat.S_ISFIFO(st.st_mode):
+			return '|'
+		if stat.S_ISSOCK(st.st_mode):
+			return '='
+		if stat.S_ISREG(st.st_mode) and st.st_mode & 0o111:
+			return '*'
+		return ''
+
+	def format_name(self, entry: Entry, name: str = '') -> tuple:
+		'''Returns the name of an entry as it is to be printed along with its display width'''
+		name = name or entry.name
+		width = len(name) if name.isascii() else get_cwidth(name)
+		if self.colors:
+			color = self._get_color(entry)
+			if color:
+				name = '\x1b[%sm%s\x1b[0m' % (color, name)
+		if self.options.classify:
+			indicator = self._get_indicator(entry)
+			name += indicator
+			width += len(indicator)
+		return name, width
+
+	def _get_user(self, uid: int) -> str:
+		if uid not in self.users:
+			try:
+				self.users[uid] = pwd.getpwuid(uid).pw_name
+			except (AttributeError, KeyError):
+				self.users[uid] = str(uid)
+		return self.users[uid]
+
+	def _get_group(self, gid: int) -> str:
+		if gid not in self.groups:
+			try:
+				self.groups[gid] = grp.getgrgid(gid).gr_name
+			except (AttributeError, KeyError):
+				self.groups[gid] = str(gid)
+		return self.groups[gid]
+
+	def _format_size(self, size: int) -> str:
+		if not self.options.human or size < 1024:
+			return str(size)
+		value = float(size)
+		for unit in 'KMGTPE':
+			value /= 1024
+			if value < 10:
+				return '%.1f%s' % (value, unit)
+			if value < 1024 or unit == 'E':
+				return '%d%s' % (round(value), unit)
+		return str(size)
+
+	def _format_time(self, mtime: float) -> str:
+		# Files in large directories often share timestamps, so formatted times are reused
+		key = int(mtime)
+		text = self.times.get(key)
+		if text is None:
+			# Like ls, the year is shown instead of the time for files more than six months old
+			if abs(self.now - mtime) > 15778476:
+				text = time.strftime('%b %e  %Y', time.localtime(mtime))
+			else:
+				text = time.strftime('%b %e %H:%M', time.localtime(mtime))
+			self.times[key] = text
+		return text
+
+	def _get_long_fields(self, entry: Entry) -> list:
+		st = entry.get_stat()
+		if st is None:
+			return [ '?' * 10, '?', '?', '?', '?', '?' * 12 ]
+		return [ stat.filemode(st.st_mode), str(st.st_nlink), self._get_user(st.st_uid),
+				self._get_group(st.st_gid), self._format_size(st.st_size),
+				self._format_time(st.st_mtime) ]
+
+	def _format_long_line(self, entry: Entry, fields: list, widths: list) -> str:
+		name, _ = self.format_name(entry)
+		if entry.islink:
+			try:
+				name += ' -> ' + os.readlink(entry.path)
+			except OSError:
+				pass
+		return '%s %s %s %s %s %s %s' % (fields[0], fields[1].rjust(widths[1]),
+			fields[2].ljust(widths[2]), fields[3].ljust(widths[3]), fields[4].rjust(widths[4]),
+			fields[5], name)
+
+	def print_long(self, entries: list, show_total: bool):
+		'''Prints entries in long format'''
+		if show_total:
+			blocks = 0
+			for entry in entries:
+				st = entry.get_stat()
+				if st is not None:
+					blocks += getattr(st, 'st_blocks', (st.st_size + 511) // 512)
+			if self.options.human:
+				self.out.add('total %s' % self._format_size(blocks * 512))
+			else:
+				self.out.add('total %s' % ((blocks + 1) // 2))
+
+		rows = [ self._get_long_fields(entry) for entry in entries ]
+		widths = [ 0 ] * 6
+		for fields in rows:
+			for i in range(1, 5):
+				widths[i] = max(widths[i], len(fields[i]))
+
+		for entry, fields in zip(entries, rows):
+			self.out.add(self._format_long_line(entry, fields, widths))
+
+	def print_columns(self, entries: list):
+		'''Prints entries in as many columns as fit in the terminal, sorted down each column'''
+		if not entries:
+			return
+		names = list()
+		widths = list()
+		for entry in entries:
+			name, width = self.format_name(entry)
+			names.append(name)
+			widths.append(width)
+
+		count = len(names)
+		linewidth = self.options.width
+
+		# Any number of columns up to this many fits, so only larger counts need to be tried
+		fits = max(1, min(count, (linewidth + 2) // (max(widths) + 2)))
+		most = max(fits, min(count, (linewidth + 2) // (min(widths) + 2)))
+		columns = fits
+		colwidths = None
+		for trial in range(most, fits, -1):
+			rows = -(-count // trial)
+			trialwidths = [ max(widths[i:i + rows]) for i in range(0, count, rows) ]
+			if sum(trialwidths) + 2 * (len(trialwidths) - 1) <= linewidth:
+				columns = len(trialwidths)
+				colwidths = trialwidths
+				break
+
+		rows = -(-count // columns)
+		if colwidths is None:
+			colwidths = [ max(widths[i:i + rows]) for i in range(0, count, rows) ]
+
+		for row in range(rows):
+			parts = list()
+			for column in range(len(colwidths)):
+				index = column * rows + row
+				if index >= count:
+					break
+				if index + rows < count:
+					parts.append(names[index] + ' ' * (colwidths[column] - widths[index] + 2))
+				else:
+					parts.append(names[index])
+			self.out.add(''.join(parts).rstrip())
+
+	def print_entries(self, entries: list, show_total: bool):
+		'''Prints a group of entries in the format chosen by the options'''
+		if self.options.long:
+			self.print_long(entries, show_total)
+		elif self.options.one_column:
+			for entry in entries:
+				self.out.add(self.format_name(entry)[0])
+		else:
+			self.print_columns(entries)
+
+	def sort_entries(self, entries: list) -> list:
+		'''Sorts entries according to the options'''
+		if self.options.unsorted:
+			return entries
+
+		entries.sort(key=lambda e: e.name)
+		if self.options.time_sort or self.options.size_sort:
+			field = 'st_mtime' if self.options.time_sort else 'st_size'
+			def get_key(entry):
+				st = entry.get_stat()
+				return getattr(st, field) if st is not None else 0
+			entries.sort(key=get_key, reverse=True)
+
+		if self.options.reverse:
+			entries.reverse()
+		return entries
+
+	def _is_shown(self, name: str) -> bool:
+		return self.options.all or self.options.almost_all or name[0] != '.'
+
+	def read_directory(self, path: str) -> list:
+		'''Returns the entries of a directory which the options call for. The directory's contents
+are added to the completion cache. None is returned if it can't be read.'''
+		options = self.options
+		if not (options.needs_stat() or options.recursive or options.unsorted or self.colors \
+				or options.classify):
+			# Only names and types are needed, which the completion cache already holds
+			listing = gDirCache.get(path)
+			if listing is None:
+				return self._report_unreadable(path, self._get_reason(path))
+			return [ Entry(name, os.path.join(path, name), isdir) \
+				for name, isdir in zip(listing.names, listing.isdir) if self._is_shown(name) ]
+
+		try:
+			info = os.stat(path)
+			with os.scandir(path) as scanner:
+				allEntries = [ Entry.from_direntry(e) for e in scanner ]
+		except OSError as e:
+			return self._report_unreadable(path, e.strerror)
+
+		gDirCache.store(path, info, [ (e.name, e.isdir) for e in allEntries ])
+		return [ e for e in allEntries if self._is_shown(e.name) ]
+
+	def stream_directory(self, path: str) -> list:
+		'''Prints the contents of a directory as they are read, for unsorted single-column and long
+listings. Columns in long format have fixed minimum widths because later entries haven't been
+read yet. Returns the subdirectories found or None if the directory can't be read.'''
+		subdirs = list()
+		allEntries = list()
+		widths = [ 0, 3, 8, 8, 8, 0 ]
+		try:
+			info = os.stat(path)
+			with os.scandir(path) as scanner:
+				for direntry in scanner:
+					entry = Entry.from_direntry(direntry)
+					allEntries.append((entry.name, entry.isdir))
+					if not self._is_shown(entry.name):
+						continue
+					if entry.isdir and not entry.islink:
+						subdirs.append(entry)
+					if self.options.long:
+						self.out.add(self._format_long_line(entry,
+							self._get_long_fields(entry), widths))
+					else:
+						self.out.add(self.format_name(entry)[0])
+		except OSError as e:
+			return self._report_unreadable(path, e.strerror)
+
+		gDirCache.store(path, info, allEntries)
+		return subdirs
+
+	def _report_unreadable(self, path: str, reason: str):
+		self.errors.append("ls: cannot open directory '%s': %s" % (path, reason))
+
+	@staticmethod
+	def _get_reason(path: str) -> str:
+		try:
+			with os.scandir(path):
+				pass
+		except OSError as e:
+			return e.strerror or str(e)
+		return 'Unknown error'
+
+	def _add_dot_entries(self, path: str, entries: list) -> list:
+		dots = list()
+		for name in [ '.', '..' ]:
+			dotpath = os.path.join(path, name)
+			dots.append(Entry(name, dotpath, True))
+		return dots + entries
+
+	def list_directory(self, path: str, header: bool):
+		'''Prints the contents of a directory and, if recursion is on, its subdirectories'''
+		pending = [ path ]
+		first = True
+		while pending:
+			current = pending.pop()
+			if header or not first:
+				if self.out.written or self.out.lines:
+					self.out.add('')
+				self.out.add(current + ':')
+			first = False
+
+			streaming = self.options.unsorted and (self.options.long or self.options.one_column)
+			if streaming:
+				subdirs = self.stream_directory(current)
+			else:
+				entries = self.read_directory(current)
+				if entries is None:
+					continue
+				if self.options.all:
+					entries = self._add_dot_entries(current, entries)
+				entries = self.sort_entries(entries)
+				self.print_entries(entries, True)
+				subdirs = [ e for e in entries if e.isdir and not e.islink \
+					and e.name not in [ '.', '..' ] ]
+
+			if self.options.recursive and subdirs:
+				# Pushed in reverse so that they are listed in order
+				pending.extend(reversed([ e.path for e in subdirs ]))
+
+	def expand_path(self, path: str) -> list:
+		'''Returns the paths matching an argument, expanding wildcards in it, or None if nothing
+matches'''
+		if path.startswith('~'):
+			path = os.path.expanduser(path)
+		if not glob.has_magic(path):
+			return [ path ] if os.path.lexists(path) else None
+
+		folder, pattern = os.path.split(path)
+		if glob.has_magic(folder):
+			matches = sorted(glob.glob(path))
+			return matches or None
+
+		listing = gDirCache.get(folder)
+		if listing is None:
+			return None
+
+		# Entries are sorted, so the matches for a literal prefix are found by bisection
+		literal = pattern
+		for i, char in enumerate(pattern):
+			if char in '*?[':
+				literal = pattern[:i]
+				break
+		start = bisect_left(listing.names, literal)
+		matches = list()
+		for name in listing.names[start:]:
+			if not name.startswith(literal):
+				break
+			if name[0] == '.' and pattern[0] != '.':
+				continue
+			if fnmatch.fnmatchcase(name, pattern):
+				matches.append(os.path.join(folder, name) if folder else name)
+		return matches or None
+
+	def run(self, paths: list) -> str:
+		'''Lists the paths given and returns an error string if any of them couldn't be listed'''
+		if not paths:
+			paths = [ '.' ]
+
+		files = list()
+		dirs = list()
+		for path in paths:
+			matches = self.expand_path(path)
+			if matches is None:
+				self.errors.append("ls: cannot access '%s': No such file or directory" % path)
+				continue
+
+			for match in matches:
+				entry = Entry(match, match, os.path.isdir(match), os.path.islink(match))
+
+				# As with ls, a link to a directory is shown as a link in long format unless
+				# the path ends with a slash
+				if entry.isdir and entry.islink and self.options.long \
+						and not match.endswith(os.sep):
+					files.append(entry)
+				elif entry.isdir and not self.options.directory:
+					dirs.append(entry)
+				else:
+					files.append(entry)
+
+		if files:
+			self.print_entries(self.sort_entries(files), False)
+
+		header = len(files) + len(dirs) > 1 or self.options.recursive
+		for entry in self.sort_entries(dirs):
+			self.list_directory(entry.path, header)
+
+		self.out.flush()
+		return '\n'.join(self.errors)
+
+
+def list_paths(args, stream=None) -> str:
+	'''Lists files and directories using ls-style arguments. Returns an error string, which is
+empty if everything was listed.'''
+	options, paths, error = parse_options(args)
+	if error:
+		return error
+
+	if stream is None:
+		stream = sys.stdout
+	if not options.long and not options.one_column:
+		if hasattr(stream, 'isatty') and stream.isatty():
+			options.width = shutil.get_terminal_size().columns
+		else:
+			options.one_column = True
+
+	return Lister(options, stream).run(paths)
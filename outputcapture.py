@@ -0,0 +1,91 @@
+'''Captures what individual threads print.
+
+Commands print their output directly. When several commands run at once, such as when one
+command is run against many servers, their output would be interleaved. redirect_output() swaps
+sys.stdout and sys.stderr for objects which pass writes through to the original streams except
+on threads which have been redirected, whose writes go to a destination of their own, such as
+a buffer or a client's connection.'''
+
+import contextlib
+import io
+import sys
+import threading
+
+class ThreadRouter:
+	'''File-like object which sends each thread's writes either to that thread's own destination
+or to the stream it replaced'''
+	def __init__(self, target):
+		self.target = target
+		self.local = threading.local()
+
+	def get_buffer(self):
+		'''Returns the calling thread's destination or None if it isn't redirected'''
+		return getattr(self.local, 'buffer', None)
+
+	def write(self, text: str) -> int:
+		'''Writes text to the calling thread's destination'''
+		buffer = self.get_buffer()
+		if buffer is not None:
+			return buffer.write(text)
+		return self.target.write(text)
+
+	def flush(self):
+		'''Flushes the calling thread's destination'''
+		buffer = self.get_buffer()
+		if buffer is not None:
+			buffer.flush()
+		else:
+			self.target.flush()
+
+	def isatty(self) -> bool:
+		'''Redirected output is not written to a terminal'''
+		if self.get_buffer() is not None:
+			return False
+		return self.target.isatty()
+
+	def __getattr__(self, name):
+		return getattr(self.target, name)
+
+
+_gInstallLock = threading.Lock()
+
+def _get_router(name: str) -> ThreadRouter:
+	'''Returns the ThreadRouter for sys.stdout or sys.stderr, installing one if needed. Routers
+are left in place once installed. The prompt replaces sys.stdout while it runs, in which case a
+new router is installed in front of its replacement.'''
+	with _gInstallLock:
+		stream = getattr(sys, name)
+		if not isinstance(stream, ThreadRouter):
+			stream = ThreadRouter(stream)
+			setattr(sys, name, stream)
+		return stream
+
+
+@contextlib.contextmanager
+def redirect_output(stream):
+	'''Context manager which sends everything the calling thread writes to sys.stdout and
+sys.stderr to a file-like object. Other threads are not affected.'''
+	routers = [ _get_router('stdout'), _get_router('stderr') ]
+	previous = [ router.get_buffer() for router in routers ]
+	for router in routers:
+		router.local.buffer = stream
+	try:
+		yield stream
+	finally:
+		for router, buffer in zip(routers, previous):
+			router.local.buffer = buffer
+
+
+def resolve_stream(stream):
+	'''Returns the object which the calling thread's writes to a stream actually reach, so that
+another thread can write there on its behalf'''
+	if isinstance(stream, ThreadRouter):
+		buffer = stream.get_buffer()
+		return buffer if buffer is not None else stream.target
+	return stream
+
+
+def capture_output():
+	'''Context manager which collects everything the calling thread writes to sys.stdout and
+sys.stderr in a StringIO, which it provides'''
+	return redirect_output(io.StringIO())
@@ -0,0 +1,308 @@
+'''Runs commands joined with | so that each reads what the one before it writes.
+
+Records flow between stages as lines of text held in generators, so a pipeline runs in this
+process and only as much of the output as the stages are working on is held in memory at a time.
+A stage which stops early, such as head, closes the stages before it. A command takes part in a
+pipeline through its pipe() method, which returns an iterator over its output lines. Commands
+which only print get BaseCommand's version of it, which runs them in a thread of their own and
+passes on what they print through a small bounded queue, so they too can start a pipeline
+without their whole output being collected first.
+
+The last stage's output is written in batches rather than a line at a time.'''
+
+import queue
+import re
+import sys
+import threading
+import time
+
+from outputcapture import redirect_output, resolve_stream
+
+# Lines written by the last stage are collected into batches of up to this many
+BATCH_SIZE = 1000
+
+# Collected lines wait no longer than this many seconds to be written, so slow output still appears
+BATCH_INTERVAL = 0.1
+
+# Number of writes a printing command may get ahead of the stage reading its output
+QUEUE_SIZE = 64
+
+class PipelineClosed(Exception):
+	'''Raised within a command when the stage reading its output has stopped'''
+
+
+class StageFailed(Exception):
+	'''Raised when a command in a pipeline returns a CommandFailure'''
+
+
+def split_stages(raw_input: str, ptokens: list) -> list:
+	'''Splits a line at each unquoted | token and returns the text of each stage. A line with no
+pipe is returned as a single stage. ValueError is raised if a stage is empty.'''
+	stages = list()
+	start = None
+	end = 0
+	for token in ptokens:
+		if token.text == '|':
+			if start is None:
+				raise ValueError('Missing command before |')
+			stages.append(raw_input[start:end])
+			start = None
+			continue
+		if start is None:
+			start = token.start
+		end = token.end
+
+	if start is None:
+		if stages:
+			raise ValueError('Missing command after |')
+		return list()
+	stages.append(raw_input[start:end])
+	return stages
+
+
+class _QueueWriter:
+	'''File-like object which passes the complete lines written to it to a queue in lists'''
+	def __init__(self, lines: queue.Queue, closed: threading.Event):
+		self.lines = lines
+		self.closed = closed
+		self.partial = ''
+
+	def write(self, text: str) -> int:
+		'''Queues each complete line of text, waiting if the reader is behind'''
+		if self.closed.is_set():
+			raise PipelineClosed()
+		parts = (self.partial + text).split('\n')
+		self.partial = parts.pop()
+		if parts:
+			self._put(parts)
+		return len(text)
+
+	def _put(self, item):
+		'''Puts an item in the queue, giving up if the reader stops'''
+		while True:
+			try:
+				self.lines.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				if self.closed.is_set():
+					raise PipelineClosed()
+
+	def finish(self):
+		'''Queues any unfinished line'''
+		if self.partial:
+			self._put([ self.partial ])
+			self.partial = ''
+
+	def flush(self):
+		'''Lines are queued as soon as they are complete'''
+
+	def isatty(self) -> bool:
+		'''Output goes to another stage, not a terminal'''
+		return False
+
+
+def run_printing_command(cmd, pinvocation, pshell_state):
+	'''Generator which runs a command that prints its output in a thread and yields the lines it
+prints, followed by those of the message it returns. Exceptions raised by the command are
+raised here, as is StageFailed if it returns a CommandFailure.'''
+	# shellbase imports this module, so this can't be imported at the top
+	from shellbase import CommandFailure
+
+	lines = queue.Queue(QUEUE_SIZE)
+	closed = threading.Event()
+	outcome = dict()
+
+	def run():
+		writer = _QueueWriter(lines, closed)
+		try:
+			with redirect_output(writer):
+				message = cmd.execute(pinvocation, pshell_state)
+				if isinstance(message, CommandFailure):
+					outcome['error'] = StageFailed('%s: %s' % (cmd.get_name(), message))
+				elif message:
+					print(message)
+				writer.finish()
+		except PipelineClosed:
+			pass
+		except BaseException as e:
+			outcome['error'] = e
+		finally:
+			lines.put(None)
+
+	thread = threading.Thread(target=run, name='pipe-%s' % cmd.get_name(), daemon=True)
+	thread.start()
+	try:
+		while True:
+			batch = lines.get()
+			if batch is None:
+				break
+			yield from batch
+	finally:
+		closed.set()
+		# Anything the command was waiting to queue is dropped so that it sees the pipe close
+		while thread.is_alive():
+			try:
+				lines.get(timeout=0.1)
+			except queue.Empty:
+				pass
+		thread.join()
+	if 'error' in outcome:
+		raise outcome['error']
+
+
+def _close(records):
+	'''Closes the stage before this one, if it can be closed, so that it stops promptly'''
+	if hasattr(records, 'close'):
+		records.close()
+
+
+def filter_records(records, pattern: str, regex: bool = False, ignore_case: bool = False,
+					invert: bool = False):
+	'''Generator which yields the records containing a piece of text or matching a regular
+expression. re.error is raised for a bad expression.'''
+	if regex or ignore_case:
+		matcher = re.compile(pattern if regex else re.escape(pattern),
+			re.IGNORECASE if ignore_case else 0).search
+	else:
+		matcher = lambda record: pattern in record
+	try:
+		for record in records:
+			if bool(matcher(record)) != invert:
+				yield record
+	finally:
+		_close(records)
+
+
+def _get_sort_key(field: int, numeric: bool):
+	'''Returns a sort key function for sort_records()'''
+	def key(record: str):
+		value = record
+		if field:
+			words = record.split()
+			value = words[field - 1] if len(words) >= field else ''
+		if numeric:
+			match = re.match(r'\s*(-?\d+(?:\.\d*)?)', value)
+			return (0, float(match.group(1)), record) if match else (1, 0.0, record)
+		return value
+	return key
+
+
+def sort_records(records, reverse: bool = False, numeric: bool = False, unique: bool = False,
+				field: int = 0):
+	'''Generator which yields the records sorted as text or, if numeric is True, by the number
+at their start. If field is given, the records are sorted by that whitespace-separated field,
+counting from 1. Sorting has to see every record first, so this is the one stage which holds
+all of them.'''
+	ordered = sorted(set(records) if unique else records,
+		key=_get_sort_key(field, numeric) if field or numeric else None, reverse=reverse)
+	yield from ordered
+
+
+def head_records(records, count: int):
+	'''Generator which yields the first count records and then closes the stage before it'''
+	try:
+		if count <= 0:
+			return
+		for index, record in enumerate(records, 1):
+			yield record
+			if index >= count:
+				break
+	finally:
+		_close(records)
+
+
+def count_records(records):
+	'''Generator which yields the number of records'''
+	total = 0
+	for _ in records:
+		total += 1
+	yield str(total)
+
+
+class _BatchWriter:
+	'''Collects lines and writes them to a stream in batches. A batch is written when it is full
+or, by a thread of its own, once its oldest line has waited BATCH_INTERVAL, so a line is written
+promptly even if the stage producing the output stalls before the next one.'''
+	def __init__(self, stream):
+		self.stream = stream
+		self.condition = threading.Condition()
+		self.batch = list()
+		self.oldest = 0.0
+		self.written = 0
+		self.closed = False
+		self.error = None
+		self.thread = threading.Thread(target=self._run, name='pipe-writer', daemon=True)
+		self.thread.start()
+
+	def add(self, record: str):
+		'''Adds a line to the batch, writing the batch if it is full'''
+		with self.condition:
+			if self.error:
+				raise self.error
+			if not self.batch:
+				self.oldest = time.monotonic()
+				self.condition.notify()
+			self.batch.append(record)
+			if len(self.batch) >= BATCH_SIZE:
+				self._write()
+
+	def _write(self):
+		'''Writes the batch. The lock must be held.'''
+		if self.batch:
+			lines, self.batch = self.batch, list()
+			self.stream.write('\n'.join(lines) + '\n')
+			self.stream.flush()
+			self.written += len(lines)
+
+	def _run(self):
+		'''Writes batches whose oldest line has waited long enough'''
+		with self.condition:
+			while not self.closed:
+				if not self.batch:
+					self.condition.wait()
+					continue
+				remaining = self.oldest + BATCH_INTERVAL - time.monotonic()
+				if remaining > 0:
+					self.condition.wait(remaining)
+					continue
+				try:
+					self._write()
+				except Exception as e:
+					# Reported to the pipeline by the next add() or close()
+					self.error = e
+					return
+
+	def close(self) -> int:
+		'''Writes what is left and returns the number of lines written'''
+		with self.condition:
+			self.closed = True
+			self.condition.notify()
+		self.thread.join()
+		with self.condition:
+			if self.error:
+				raise self.error
+			self._write()
+			return self.written
+
+
+def write_records(records, stream=None) -> int:
+	'''Writes records as lines, in batches, and returns the number written'''
+	writer = _BatchWriter(resolve_stream(stream if stream is not None else sys.stdout))
+	try:
+		for record in records:
+			writer.add(record)
+	finally:
+		written = writer.close()
+	return written
+
+
+def run_pipeline(stages: list, pshell_state) -> int:
+	'''Runs a list of (command, Invocation) pairs as a pipeline and writes the last stage's
+output. Returns the number of lines written.'''
+	records = None
+	try:
+		for cmd, invocation in stages:
+			records = cmd.pipe(invocation, pshell_state, records)
+		return write_records(records)
+	finally:
+		_close(records)
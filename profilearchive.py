@@ -0,0 +1,317 @@
+'''Exports profiles to archives and imports them again.
+
+An archive is a tar file, compressed if its name ends in .gz, .bz2, or .xz, holding the profile's
+files under files/ followed by a manifest, MANIFEST.json, listing the size and hash of every file.
+Archives are written and read as streams, so a profile of any size goes through a small buffer.
+Files are memory-mapped, hashed, and written to the archive from the same mapping, and the next
+file is hashed while the current one is written. Hashes are BLAKE3, using several threads for
+large files, when the blake3 package is installed and BLAKE2b otherwise.
+
+An incremental export is given an earlier archive as its base and stores only the files whose
+hashes have changed. Its manifest still lists every file along with the name of the archive which
+holds it, so importing it also reads the earlier archives, which must be in the same folder. A
+copy of each manifest is written next to its archive so that the next incremental export can
+read it without going through the archive. Imported files are checked against the manifest
+before the profile is replaced.'''
+
+import concurrent.futures
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import tarfile
+import time
+
+try:
+	import blake3
+except ImportError:
+	blake3 = None
+
+MANIFEST_NAME = 'MANIFEST.json'
+MANIFEST_SUFFIX = '.manifest.json'
+FILES_PREFIX = 'files/'
+FORMAT_VERSION = 1
+
+# Size of the pieces files are read and written in when imported
+CHUNK_SIZE = 1024 * 1024
+
+def get_default_algorithm() -> str:
+	'''Returns the name of the hash used for new manifests'''
+	return 'blake3' if blake3 else 'blake2b'
+
+
+def _new_hasher(algorithm: str):
+	'''Returns a hash object for the named algorithm. ValueError is raised if it isn't
+available.'''
+	if algorithm == 'blake3':
+		if not blake3:
+			raise ValueError('The archive was made with BLAKE3, which needs the blake3 package')
+		try:
+			return blake3.blake3(max_threads=blake3.blake3.AUTO)
+		except (AttributeError, TypeError):
+			# Releases before 0.2 took a flag instead of a thread count
+			return blake3.blake3(multithreading=True)
+	if algorithm == 'blake2b':
+		return hashlib.blake2b()
+	raise ValueError('Unsupported hash algorithm %s' % algorithm)
+
+
+class MappedFile:
+	'''A file opened for reading through a memory map. Empty files, which can't be mapped, read
+as empty.'''
+	def __init__(self, path: str):
+		self.handle = open(path, 'rb')
+		self.stat = os.fstat(self.handle.fileno())
+		self.map = None
+		if self.stat.st_size:
+			self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+			if hasattr(mmap, 'MADV_SEQUENTIAL'):
+				self.map.madvise(mmap.MADV_SEQUENTIAL)
+		self.size = len(self.map) if self.map else 0
+
+	def get_hash(self, algorithm: str) -> str:
+		'''Returns the hex digest of the whole file'''
+		hasher = _new_hasher(algorithm)
+		if self.map:
+			hasher.update(memoryview(self.map))
+		return hasher.hexdigest()
+
+	def close(self):
+		'''Unmaps and closes the file'''
+		if self.map:
+			self.map.close()
+		self.handle.close()
+
+
+def _list_files(folder: str) -> list:
+	'''Returns the paths of the regular files under a folder relative to it, using / as the
+separator, sorted'''
+	files = list()
+	for root, dirs, names in os.walk(folder):
+		dirs.sort()
+		for name in names:
+			path = os.path.join(root, name)
+			if os.path.isfile(path) and not os.path.islink(path):
+				files.append(os.path.relpath(path, folder).replace(os.sep, '/'))
+	files.sort()
+	return files
+
+
+def _get_mode(archive: str, reading: bool) -> str:
+	'''Returns the tarfile stream mode for an archive name'''
+	if reading:
+		return 'r|*'
+	for suffix, compression in [ ('.gz', 'gz'), ('.tgz', 'gz'), ('.bz2', 'bz2'), ('.xz', 'xz') ]:
+		if archive.endswith(suffix):
+			return 'w|' + compression
+	return 'w|'
+
+
+def load_manifest(archive: str) -> dict:
+	'''Returns the manifest of an archive, read from the copy next to it if there is one.
+ValueError is raised if the archive has none.'''
+	sidecar = archive + MANIFEST_SUFFIX
+	if os.path.exists(sidecar):
+		with open(sidecar, encoding='utf-8') as handle:
+			return json.load(handle)
+
+	with tarfile.open(archive, _get_mode(archive, True)) as tar:
+		for member in tar:
+			if member.name == MANIFEST_NAME:
+				return json.load(tar.extractfile(member))
+	raise ValueError('%s has no manifest' % archive)
+
+
+def _add_bytes(tar: tarfile.TarFile, name: str, data: bytes):
+	'''Adds a file holding data to an archive'''
+	info = tarfile.TarInfo(name)
+	info.size = len(data)
+	info.mtime = int(time.time())
+	info.mode = 0o600
+	tar.addfile(info, io.BytesIO(data))
+
+
+def export_profile(folder: str, archive: str, profile_name: str = '', base: str = '') -> dict:
+	'''Writes the files in a profile folder to an archive. If base names an earlier archive,
+files whose hashes match its manifest are left out. Returns a dictionary with the number of
+'files', how many were 'stored' in this archive, how many 'bytes' were hashed, and the
+'seconds' taken.'''
+	start = time.perf_counter()
+	algorithm = get_default_algorithm()
+	previous = dict()
+	if base and os.path.basename(base) == os.path.basename(archive):
+		raise ValueError('An incremental export needs a different name from its base')
+	if base:
+		baseManifest = load_manifest(base)
+		if baseManifest.get('algorithm') != algorithm:
+			raise ValueError('%s was hashed with %s, not %s, so a full export is needed' % \
+				(base, baseManifest.get('algorithm'), algorithm))
+		previous = baseManifest.get('files', dict())
+
+	archiveName = os.path.basename(archive)
+	manifest = {
+		'format':FORMAT_VERSION,
+		'profile':profile_name,
+		'algorithm':algorithm,
+		'created':int(time.time()),
+		'base':os.path.basename(base) if base else '',
+		'files':dict(),
+	}
+	summary = { 'files':0, 'stored':0, 'bytes':0, 'seconds':0.0 }
+
+	def open_and_hash(relpath):
+		mapped = MappedFile(os.path.join(folder, relpath))
+		try:
+			return mapped, mapped.get_hash(algorithm)
+		except BaseException:
+			mapped.close()
+			raise
+
+	paths = _list_files(folder)
+	partial = archive + '.partial'
+	try:
+		with open(partial, 'wb') as raw, \
+				tarfile.open(fileobj=raw, mode=_get_mode(archive, False)) as tar, \
+				concurrent.futures.ThreadPoolExecutor(max_workers=1) as hasher:
+			# The next file is hashed while this one is written. blake3 and hashlib release the
+			# interpreter lock while hashing, so the two overlap.
+			upcoming = hasher.submit(open_and_hash, paths[0]) if paths else None
+			for index, relpath in enumerate(paths):
+				mapped, digest = upcoming.result()
+				if index + 1 < len(paths):
+					upcoming = hasher.submit(open_and_hash, paths[index + 1])
+				try:
+					summary['files'] += 1
+					summary['bytes'] += mapped.size
+					if previous.get(relpath, dict()).get('hash') == digest:
+						holder = previous[relpath]['archive']
+					else:
+						info = tarfile.TarInfo(FILES_PREFIX + relpath)
+						info.size = mapped.size
+						info.mtime = int(mapped.stat.st_mtime)
+						info.mode = mapped.stat.st_mode & 0o777
+						tar.addfile(info, mapped.map)
+						holder = archiveName
+						summary['stored'] += 1
+					manifest['files'][relpath] = { 'size':mapped.size, 'hash':digest,
+						'mtime':int(mapped.stat.st_mtime), 'archive':holder }
+				finally:
+					mapped.close()
+
+			manifestData = json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8')
+			_add_bytes(tar, MANIFEST_NAME, manifestData)
+	except BaseException:
+		if os.path.exists(partial):
+			os.remove(partial)
+		raise
+
+	os.replace(partial, archive)
+	with open(archive + MANIFEST_SUFFIX, 'wb') as handle:
+		handle.write(manifestData)
+	summary['seconds'] = time.perf_counter() - start
+	return summary
+
+
+def _check_member_path(relpath: str):
+	'''Raises ValueError for an archive path which would be written outside the profile'''
+	parts = relpath.split('/')
+	if not relpath or relpath.startswith('/') or '..' in parts or '' in parts or \
+			':' in parts[0] or '\\' in relpath:
+		raise ValueError('Unsafe path in archive: %s' % relpath)
+
+
+def _extract(archive: str, folder: str, algorithm: str, wanted=None) -> tuple:
+	'''Writes the files in an archive to a folder, hashing them on the way. If wanted is given,
+only the files in it are written. Returns the archive's manifest, which is None if it has none,
+and a dictionary mapping the files written to their hashes.'''
+	manifest = None
+	hashes = dict()
+	with tarfile.open(archive, _get_mode(archive, True)) as tar:
+		for member in tar:
+			if member.name == MANIFEST_NAME:
+				manifest = json.load(tar.extractfile(member))
+				continue
+			if not member.isfile() or not member.name.startswith(FILES_PREFIX):
+				continue
+			relpath = member.name[len(FILES_PREFIX):]
+			_check_member_path(relpath)
+			if wanted is not None and relpath not in wanted:
+				continue
+
+			path = os.path.join(folder, *relpath.split('/'))
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			hasher = _new_hasher(algorithm)
+			source = tar.extractfile(member)
+			with open(path, 'wb') as handle:
+				while True:
+					chunk = source.read(CHUNK_SIZE)
+					if not chunk:
+						break
+					hasher.update(chunk)
+					handle.write(chunk)
+			os.chmod(path, (member.mode & 0o777) | 0o600)
+			os.utime(path, (member.mtime, member.mtime))
+			hashes[relpath] = hasher.hexdigest()
+	return manifest, hashes
+
+
+def import_profile(archive: str, folder: str) -> dict:
+	'''Replaces the contents of a profile folder with the files in an archive and any earlier
+archives it was based on. The files are written to a new folder and checked against the manifest
+first, so the profile is left alone if anything is wrong. ValueError is raised for a damaged or
+incomplete archive. Returns a dictionary with the number of 'files', the 'bytes' in them, and
+the 'seconds' taken.'''
+	start = time.perf_counter()
+	staging = folder.rstrip(os.sep) + '.importing'
+	if os.path.exists(staging):
+		shutil.rmtree(staging)
+	os.makedirs(staging)
+	try:
+		algorithm = get_default_algorithm()
+		manifest, hashes = _extract(archive, staging, algorithm)
+		if manifest is None:
+			raise ValueError('%s has no manifest' % archive)
+		if manifest.get('format') != FORMAT_VERSION:
+			raise ValueError('%s is in an unsupported format' % archive)
+		files = manifest.get('files', dict())
+
+		# Files which hadn't changed since an earlier export are in that export's archive
+		holders = dict()
+		for relpath, entry in files.items():
+			if relpath not in hashes:
+				holders.setdefault(entry['archive'], set()).add(relpath)
+		source = os.path.dirname(os.path.abspath(archive))
+		for name, wanted in holders.items():
+			path = os.path.join(source, name)
+			if not os.path.exists(path):
+				raise ValueError('%s needs %s, which is not in the same folder' % (archive, name))
+			hashes.update(_extract(path, staging, algorithm, wanted)[1])
+
+		if manifest.get('algorithm') != algorithm:
+			hashes = dict()
+			for relpath in files:
+				mapped = MappedFile(os.path.join(staging, *relpath.split('/')))
+				try:
+					hashes[relpath] = mapped.get_hash(manifest.get('algorithm'))
+				finally:
+					mapped.close()
+
+		bad = sorted([ p for p, e in files.items() if hashes.get(p) != e['hash'] ])
+		if bad:
+			raise ValueError('%s files failed verification, starting with %s' % (len(bad),
+				bad[0]))
+	except BaseException:
+		shutil.rmtree(staging, ignore_errors=True)
+		raise
+
+	if os.path.exists(folder):
+		retired = folder.rstrip(os.sep) + '.replaced'
+		os.rename(folder, retired)
+		os.rename(staging, folder)
+		shutil.rmtree(retired, ignore_errors=True)
+	else:
+		os.rename(staging, folder)
+	return { 'files':len(files), 'bytes':sum([ e['size'] for e in files.values() ]),
+		'seconds':time.perf_counter() - start }
@@ -0,0 +1,97 @@
+'''Caches profile metadata so that completion and listing don't read profile storage each time'''
+
+from bisect import bisect_left
+import os
+import threading
+import time
+
+class ProfileCache:
+	'''Holds the names of all profiles, sorted for prefix queries, along with the names of the
+active and default profiles. The cache is reloaded from the client after invalidate() is called
+and when the files in the profile folder change. The folder is checked at most once every
+check_interval seconds, so completion on slow network home directories stays in memory.'''
+	def __init__(self, client, check_interval: float = 2.0):
+		self.client = client
+		self.check_interval = check_interval
+		self.lock = threading.Lock()
+		self.names = list()
+		self.active = ''
+		self.default = ''
+		self.valid = False
+		self.folder = ''
+		self.signature = None
+		self.last_check = 0.0
+
+	def invalidate(self):
+		'''Marks the cache as needing to be reloaded, such as after a profile is created'''
+		with self.lock:
+			self.valid = False
+
+	def _get_signature(self):
+		'''Returns a value which changes when profiles are added, removed, or renamed or the
+profile configuration files in the folder are modified'''
+		if not self.folder:
+			return None
+		try:
+			with os.scandir(self.folder) as entries:
+				files = [ (e.name, e.stat().st_mtime_ns) for e in entries if e.is_file() ]
+			return (os.stat(self.folder).st_mtime_ns, tuple(sorted(files)))
+		except OSError:
+			return None
+
+	def _load(self):
+		'''Reloads the cache from the client. The lock must be held.'''
+		profiles = self.client.get_profiles()
+		self.names = sorted([ p.name for p in profiles ])
+		self.default = ''
+		for profile in profiles:
+			if profile.isdefault:
+				self.default = profile.name
+			if not self.folder and profile.path:
+				self.folder = os.path.dirname(os.path.normpath(profile.path))
+		self.active = self.client.get_active_profile_name()
+
+		self.signature = self._get_signature()
+		self.last_check = time.monotonic()
+		self.valid = True
+
+	def _ensure_loaded(self):
+		'''Reloads the cache if it has been invalidated or the profile folder has changed. The
+lock must be held.'''
+		if self.valid:
+			now = time.monotonic()
+			if now - self.last_check < self.check_interval:
+				return
+			self.last_check = now
+			if self._get_signature() == self.signature:
+				return
+		self._load()
+
+	def get_names(self) -> list:
+		'''Returns a sorted list of the names of all profiles'''
+		with self.lock:
+			self._ensure_loaded()
+			return list(self.names)
+
+	def get_active(self) -> str:
+		'''Returns the name of the active profile'''
+		with self.lock:
+			self._ensure_loaded()
+			return self.active
+
+	def get_default(self) -> str:
+		'''Returns the name of the default profile'''
+		with self.lock:
+			self._ensure_loaded()
+			return self.default
+
+	def complete(self, prefix: str) -> list:
+		'''Returns the names of the profiles which start with the prefix'''
+		with self.lock:
+			self._ensure_loaded()
+			out = list()
+			index = bisect_left(self.names, prefix)
+			while index < len(self.names) and self.names[index].startswith(prefix):
+				out.append(self.names[index])
+				index += 1
+			return out
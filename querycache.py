@@ -0,0 +1,216 @@
+'''Caches the results of read-only client queries.
+
+Looking up the active profile and its workspaces means reading profile storage, and commands
+such as setuser_id repeat the same lookups each time they run. CachedClient answers those
+queries from a QueryCache, where each result is kept for a time which depends on the query and
+the least recently used results are dropped once the cache outgrows its memory budget.
+Workspaces are indexed by type, domain, and user ID so that finding one doesn't mean scanning the
+whole list. Changes made through CachedClient drop the results they affect. Commands which change
+profiles through the client directly must call invalidate() themselves.'''
+
+import collections
+import sys
+import threading
+import time
+
+# Default limit on the estimated memory used by cached results
+DEFAULT_MEMORY_BUDGET = 4 * 1024 * 1024
+
+# Seconds that results are kept, by query. Profiles change only through this shell or another
+# one, so they are kept long enough to cover a burst of commands but not much longer.
+PROFILE_TTL = 10.0
+WORKSPACE_TTL = 30.0
+
+def estimate_size(value, depth: int = 3) -> int:
+	'''Returns a rough estimate of the memory used by a value and the objects it holds'''
+	size = sys.getsizeof(value)
+	if depth <= 0:
+		return size
+	if isinstance(value, dict):
+		for key, item in value.items():
+			size += estimate_size(key, depth - 1) + estimate_size(item, depth - 1)
+	elif isinstance(value, (list, tuple, set, frozenset)):
+		for item in value:
+			size += estimate_size(item, depth - 1)
+	elif hasattr(value, '__dict__'):
+		size += estimate_size(vars(value), depth - 1)
+	return size
+
+
+class QueryStats:
+	'''Hit and miss counts for one kind of query'''
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.expired = 0
+
+	def get_hit_rate(self) -> float:
+		'''Returns the fraction of lookups answered from the cache'''
+		total = self.hits + self.misses
+		return self.hits / total if total else 0.0
+
+
+class CacheEntry:
+	'''A cached result'''
+	__slots__ = ('value', 'expires', 'size')
+
+	def __init__(self, value, expires: float, size: int):
+		self.value = value
+		self.expires = expires
+		self.size = size
+
+
+class QueryCache:
+	'''Memoizes query results under a memory budget. Results are keyed by the query's name and
+a key for its arguments and expire after the time given when they are looked up.'''
+	def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+		self.memory_budget = memory_budget
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()
+		self.memory = 0
+		self.evictions = 0
+		self.stats = dict()
+
+		# Incremented by each invalidation, so that a result loaded before one isn't stored after it
+		self.generation = 0
+
+	def get(self, name: str, key, loader, ttl: float):
+		'''Returns the cached result of a query, calling loader to get it if there isn't a
+current one. Results which are larger than the whole budget are returned but not kept, as are
+results whose loading overlapped an invalidation.'''
+		fullKey = (name, key)
+		now = time.monotonic()
+		with self.lock:
+			stats = self.stats.setdefault(name, QueryStats())
+			entry = self.entries.get(fullKey)
+			if entry is not None:
+				if entry.expires > now:
+					self.entries.move_to_end(fullKey)
+					stats.hits += 1
+					return entry.value
+				stats.expired += 1
+				self._remove(fullKey)
+			stats.misses += 1
+			generation = self.generation
+
+		# The loader runs without the lock so that a slow query doesn't hold up the others
+		value = loader()
+		size = estimate_size(value)
+		with self.lock:
+			if generation != self.generation:
+				return value
+			if fullKey in self.entries:
+				self._remove(fullKey)
+			if size <= self.memory_budget:
+				self.entries[fullKey] = CacheEntry(value, time.monotonic() + ttl, size)
+				self.memory += size
+				while self.memory > self.memory_budget:
+					self._remove(next(iter(self.entries)))
+					self.evictions += 1
+		return value
+
+	def _remove(self, key):
+		'''Drops a result. The lock must be held.'''
+		entry = self.entries.pop(key)
+		self.memory -= entry.size
+
+	def invalidate(self, name: str = ''):
+		'''Drops the results of the named query or, if no name is given, all results'''
+		with self.lock:
+			self.generation += 1
+			for key in list(self.entries):
+				if not name or key[0] == name:
+					self._remove(key)
+
+	def clear(self):
+		'''Drops all results and resets the statistics'''
+		with self.lock:
+			self.generation += 1
+			self.entries.clear()
+			self.memory = 0
+			self.evictions = 0
+			self.stats.clear()
+
+	def get_stats(self) -> dict:
+		'''Returns a dictionary with a list of (name, hits, misses, hit rate, cached results)
+tuples under 'queries' along with the memory used, the budget, and the number of evictions'''
+		with self.lock:
+			counts = collections.Counter([ key[0] for key in self.entries ])
+			queries = [ (name, s.hits, s.misses, s.get_hit_rate(), counts[name])
+						for name, s in sorted(self.stats.items()) ]
+			return {
+				'queries':queries,
+				'memory':self.memory,
+				'budget':self.memory_budget,
+				'evictions':self.evictions,
+			}
+
+
+class WorkspaceIndex:
+	'''The workspaces of a profile, indexed by type, domain, and user ID. Each index keeps the
+workspaces in the order the profile lists them.'''
+	def __init__(self, workspaces: list):
+		self.workspaces = list(workspaces)
+		self.by_type = dict()
+		self.by_domain = dict()
+		self.by_uid = dict()
+		for workspace in self.workspaces:
+			self.by_type.setdefault(getattr(workspace, 'type', ''), list()).append(workspace)
+			self.by_domain.setdefault(getattr(workspace, 'domain', ''), list()).append(workspace)
+			self.by_uid.setdefault(getattr(workspace, 'uid', ''), list()).append(workspace)
+
+	def find(self, wtype: str = '', domain: str = '', uid: str = '') -> list:
+		'''Returns the workspaces matching all of the given criteria. Empty criteria match
+everything.'''
+		candidates = None
+		for index, value in [ (self.by_uid, uid), (self.by_domain, domain),
+							(self.by_type, wtype) ]:
+			if not value:
+				continue
+			matches = index.get(value, list())
+			if candidates is None:
+				candidates = matches
+			else:
+				matchIDs = set([ id(w) for w in matches ])
+				candidates = [ w for w in candidates if id(w) in matchIDs ]
+			if not candidates:
+				return list()
+		return list(self.workspaces if candidates is None else candidates)
+
+
+class CachedClient:
+	'''Answers read-only queries against an AnselusClient from a QueryCache'''
+	def __init__(self, client, cache: QueryCache = None):
+		self.client = client
+		self.cache = cache if cache else QueryCache()
+
+	def invalidate(self):
+		'''Drops every cached result, such as after profiles are changed through the client'''
+		self.cache.invalidate()
+
+	def get_active_profile_name(self) -> str:
+		'''Returns the name of the active profile'''
+		return self.cache.get('get_active_profile_name', None,
+			self.client.get_active_profile_name, PROFILE_TTL)
+
+	def get_active_profile(self):
+		'''Returns the active profile'''
+		return self.cache.get('get_active_profile', self.get_active_profile_name(),
+			self.client.get_active_profile, PROFILE_TTL)
+
+	def get_workspace_index(self) -> WorkspaceIndex:
+		'''Returns the index of the active profile's workspaces'''
+		return self.cache.get('get_workspaces', self.get_active_profile_name(),
+			lambda: WorkspaceIndex(self.get_active_profile().get_workspaces()), WORKSPACE_TTL)
+
+	def find_workspaces(self, wtype: str = '', domain: str = '', uid: str = '') -> list:
+		'''Returns the active profile's workspaces which match all of the given criteria'''
+		return self.get_workspace_index().find(wtype, domain, uid)
+
+	def set_user_id(self, workspace, uid: str):
+		'''Sets a workspace's user ID, which changes how its workspaces are indexed, and returns
+the status'''
+		try:
+			return workspace.set_user_id(uid)
+		finally:
+			self.cache.invalidate('get_workspaces')
@@ -0,0 +1,183 @@
+'''Controls how hard bulk operations push each server.
+
+Each server gets a ServerLimiter, which limits the requests in flight with additive increase,
+multiplicative decrease (AIMD). The limit starts small and doubles each time a full window of
+requests succeeds, until the first sign of trouble. After that it grows by one request per
+window. A request which fails, returns a status meaning the server is struggling, or takes much
+longer than the fastest recent requests halves the limit, at most once per window, so one slow
+burst doesn't collapse it. The limit therefore settles just under what the server can sustain.
+
+A limiter can also be given a token-bucket cap on requests per second, for servers which
+throttle clients beyond some rate regardless of how well they are coping.'''
+
+import collections
+import contextlib
+import threading
+import time
+
+# Status codes which mean the server is struggling rather than that the request was refused
+OVERLOAD_STATUSES = [ 300 ]
+
+# A request taking longer than this many times the fastest recent request counts as congestion
+LATENCY_TOLERANCE = 3.0
+
+# Number of recent latencies used to find the fastest
+LATENCY_WINDOW = 100
+
+class TokenBucket:
+	'''Allows rate requests per second on average with bursts of up to burst requests'''
+	def __init__(self, rate: float, burst: float = 0.0):
+		self.rate = rate
+		self.burst = burst if burst >= 1 else max(1.0, rate)
+		self.tokens = self.burst
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def take(self):
+		'''Waits until a request may be sent'''
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+class ServerLimiter:
+	'''Adjusts the requests in flight to one server as described for this module'''
+	def __init__(self, server: str, initial: int = 2, minimum: int = 1, maximum: int = 64):
+		self.server = server
+		self.minimum = minimum
+		self.maximum = maximum
+		self.limit = float(min(max(initial, minimum), maximum))
+		self.threshold = float(maximum)
+		self.in_flight = 0
+		self.bucket = None
+		self.condition = threading.Condition()
+		self.recent = collections.deque(maxlen=LATENCY_WINDOW)
+		self.last_decrease = 0.0
+
+		self.requests = 0
+		self.congested = 0
+		self.decreases = 0
+		self.total_latency = 0.0
+
+	def set_rate(self, rate: float, burst: float = 0.0):
+		'''Caps requests per second. A rate of 0 removes the cap.'''
+		with self.condition:
+			self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+
+	@contextlib.contextmanager
+	def rate_cap(self, rate: float, burst: float = 0.0):
+		'''Context manager which caps requests per second while it is active and then restores
+whatever cap was set before'''
+		with self.condition:
+			previous = self.bucket
+			self.bucket = TokenBucket(rate, burst)
+		try:
+			yield self
+		finally:
+			with self.condition:
+				self.bucket = previous
+
+	def get_limit(self) -> int:
+		'''Returns the number of requests currently allowed in flight'''
+		return int(self.limit)
+
+	def acquire(self):
+		'''Waits until another request may be sent'''
+		with self.condition:
+			while self.in_flight >= int(self.limit):
+				self.condition.wait()
+			self.in_flight += 1
+			bucket = self.bucket
+		if bucket:
+			bucket.take()
+
+	def release(self, start: float, latency: float, congested: bool):
+		'''Records the outcome of a request which was sent at start and took latency seconds'''
+		with self.condition:
+			# The limit only grows while it is being used, so that a caller sending fewer
+			# requests than it allows doesn't inflate it
+			saturated = self.in_flight >= int(self.limit)
+			self.in_flight -= 1
+			self.requests += 1
+			self.total_latency += latency
+			if not congested and self.recent and \
+					latency > min(self.recent) * LATENCY_TOLERANCE:
+				congested = True
+			self.recent.append(latency)
+
+			if congested:
+				self.congested += 1
+				# Requests sent before the last decrease were already accounted for by it
+				if start > self.last_decrease:
+					self.limit = max(float(self.minimum), self.limit / 2)
+					self.threshold = self.limit
+					self.last_decrease = time.monotonic()
+					self.decreases += 1
+			elif saturated:
+				if self.limit < self.threshold:
+					self.limit = min(float(self.maximum), self.limit + 1)
+				else:
+					self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+			self.condition.notify_all()
+
+	def call(self, func, is_overloaded=None):
+		'''Calls func within the limits and returns its result. is_overloaded, if given, is
+called with the result and returns True if it shows the server is struggling. Exceptions count
+as congestion and are passed on.'''
+		self.acquire()
+		start = time.monotonic()
+		congested = True
+		try:
+			result = func()
+			congested = bool(is_overloaded and is_overloaded(result))
+			return result
+		finally:
+			self.release(start, time.monotonic() - start, congested)
+
+	def get_stats(self) -> dict:
+		'''Returns the limiter's current state and counters'''
+		with self.condition:
+			return {
+				'server':self.server,
+				'limit':int(self.limit),
+				'in_flight':self.in_flight,
+				'rate':self.bucket.rate if self.bucket else 0.0,
+				'requests':self.requests,
+				'congested':self.congested,
+				'decreases':self.decreases,
+				'latency':self.total_latency / self.requests if self.requests else 0.0,
+			}
+
+
+def is_overload_status(status) -> bool:
+	'''Returns True if a client status shows the server is struggling'''
+	return 'status' in status and status['status'] in OVERLOAD_STATUSES
+
+
+class RateControl:
+	'''Hands out one shared ServerLimiter per server'''
+	def __init__(self, maximum: int = 64):
+		self.maximum = maximum
+		self.lock = threading.Lock()
+		self.limiters = dict()
+
+	def get(self, server: str) -> ServerLimiter:
+		'''Returns the limiter for a server, creating it if needed'''
+		with self.lock:
+			limiter = self.limiters.get(server)
+			if limiter is None:
+				limiter = ServerLimiter(server, maximum=self.maximum)
+				self.limiters[server] = limiter
+			return limiter
+
+	def get_limiters(self) -> list:
+		'''Returns the limiters, sorted by server'''
+		with self.lock:
+			return [ self.limiters[k] for k in sorted(self.limiters) ]
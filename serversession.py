@@ -0,0 +1,120 @@
+'''Implements a session with an Anselus server which the shell holds open itself, so that pooled
+sessions can carry requests instead of the client library opening a connection for each one.
+
+Messages in both directions are JSON objects. The server sends a greeting when a client
+connects. Requests contain Action and Data fields, and responses contain Code, Status, Info, and
+Data fields. Nothing separates one message from the next, so messages are found by decoding JSON
+values from the data as it is read, which copes with a message split across reads or several
+arriving in one.'''
+
+import json
+import socket
+
+# Seconds to wait for the server to connect or respond
+DEFAULT_TIMEOUT = 30.0
+
+class SessionStatus(dict):
+	'''The result of a request, in the same form as the RetVal objects returned by the client
+library: values are read by item, such as status['status'] for the response code, and info()
+returns the server's explanation'''
+	def error(self) -> str:
+		'''Returns an error string, which is empty if the server answered with success'''
+		return self.get('error', '')
+
+	def info(self) -> str:
+		'''Returns additional information about the status'''
+		return self.get('info', '')
+
+
+class ServerSession:
+	'''A connection to an Anselus server. Requests are sent one at a time, so a session must not
+be shared between threads while a request is in progress. OSError is raised if the connection
+fails, after which the session is closed.'''
+	def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+		self.timeout = timeout
+		self.sock = None
+		self.buffer = ''
+		self.decoder = json.JSONDecoder()
+		self.greeting = dict()
+
+	def connect(self, host: str, port: int):
+		'''Connects to a server and reads its greeting'''
+		self.disconnect()
+		self.sock = socket.create_connection((host, port), self.timeout)
+		self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self.greeting = self._read_message()
+		if self.greeting.get('Code', 200) != 200:
+			message = '%s %s' % (self.greeting.get('Code'), self.greeting.get('Status', ''))
+			self.disconnect()
+			raise ConnectionRefusedError(message)
+
+	def is_connected(self) -> bool:
+		'''Returns True if the session hasn't been closed'''
+		return self.sock is not None
+
+	def disconnect(self):
+		'''Tells the server the session is over and closes the connection'''
+		if self.sock is None:
+			return
+		try:
+			self.sock.sendall(json.dumps({ 'Action':'QUIT', 'Data':{} }).encode('utf-8'))
+		except OSError:
+			pass
+		self._close()
+
+	def _close(self):
+		try:
+			self.sock.close()
+		except OSError:
+			pass
+		self.sock = None
+		self.buffer = ''
+
+	def _read_message(self) -> dict:
+		while True:
+			text = self.buffer.lstrip()
+			if text:
+				try:
+					message, end = self.decoder.raw_decode(text)
+				except ValueError:
+					pass
+				else:
+					self.buffer = text[end:]
+					if not isinstance(message, dict):
+						raise ConnectionError('The server sent something other than a message')
+					return message
+
+			data = self.sock.recv(65536)
+			if not data:
+				raise ConnectionResetError('The server closed the connection')
+			self.buffer += data.decode('utf-8', errors='replace')
+
+	def request(self, action: str, data: dict) -> dict:
+		'''Sends a request and returns the server's response'''
+		if self.sock is None:
+			raise ConnectionError('Not connected')
+		try:
+			self.sock.sendall(json.dumps({ 'Action':action, 'Data':data }).encode('utf-8'))
+			return self._read_message()
+		except OSError:
+			self._close()
+			raise
+
+	def preregister(self, uid: str = '') -> SessionStatus:
+		'''Preprovisions a workspace. The status contains the response code in 'status' and, on
+success, the workspace ID in 'wid', the registration code in 'regcode', the user ID, if any, in
+'uid', and the server's domain in 'domain'.'''
+		response = self.request('PREREG', { 'User-ID':uid } if uid else dict())
+		status = SessionStatus(status=response.get('Code', 0),
+			info=response.get('Info') or response.get('Status', ''), uid='', wid='', regcode='',
+			domain='')
+		if status['status'] != 200:
+			status['error'] = '%s %s' % (status['status'], response.get('Status', ''))
+			return status
+
+		data = response.get('Data') or dict()
+		status['uid'] = data.get('User-ID', '')
+		status['wid'] = data.get('Workspace-ID', '')
+		status['regcode'] = data.get('Reg-Code', '')
+		status['domain'] = data.get('Domain', '')
+		return status
@@ -1,16 +1,40 @@
 '''Provides the command processing API'''
 # pylint: disable=unused-argument
 
+import copy
 from glob import glob
 import os
-import re
+import threading
 
 from pyanselus.client import AnselusClient
 
-# This global is needed for meta commands, such as Help. Do not access
-# this list directly unless there is literally no other option.
+from tokenizer import get_values, tokenize
+
+# This global is needed for meta commands, such as Help. It maps command names
+# to commandaccess.CommandEntry records. Do not access this list directly unless
+# there is literally no other option.
 gShellCommands = dict()
 
+# Port used for server addresses which don't give one
+DEFAULT_PORT = 2001
+
+def connect_client(address: str):
+	'''Session factory for the connection pool. Returns a serversession.ServerSession connected 
+to a server address of the form host or host:port. ConnectionError is raised if the server can't 
+be reached.'''
+	from serversession import ServerSession
+
+	host, _, port = address.rpartition(':')
+	if not host or not port.isdigit():
+		host, port = address, DEFAULT_PORT
+	session = ServerSession()
+	try:
+		session.connect(host, int(port))
+	except OSError as e:
+		raise ConnectionError("Couldn't connect to %s: %s" % (address, e)) from e
+	return session
+
+
 # Class for storing the state of the shell
 class ShellState:
 	'''Stores the state of the shell'''
@@ -24,44 +48,167 @@ class ShellState:
 		self.aliases = dict()
 		self.client = AnselusClient()
 
+		# Named lists of servers for the on command, keyed by group name
+		self.server_groups = dict()
+
+		# Subsystems created the first time they are used, keyed by name, so that starting the 
+		# shell doesn't pay for those a session never touches. The copies of the state made by 
+		# new_session() share the first dictionary and so the subsystems in it, but get a new 
+		# second dictionary, for the jobs and shell process which each session has of its own.
+		self._shared = dict()
+		self._session = dict()
+		self._subsystem_lock = threading.Lock()
+
+	@staticmethod
+	def _get_subsystem(subsystems: dict, lock, name: str, factory):
+		'''Returns the subsystem with the specified name, calling factory to create it if it 
+hasn't been created yet'''
+		subsystem = subsystems.get(name)
+		if subsystem is None:
+			with lock:
+				subsystem = subsystems.get(name)
+				if subsystem is None:
+					subsystem = factory()
+					subsystems[name] = subsystem
+		return subsystem
+
+	def _get_shared(self, name: str, factory):
+		return self._get_subsystem(self._shared, self._subsystem_lock, name, factory)
+
+	def _get_session(self, name: str, factory):
+		return self._get_subsystem(self._session, self._subsystem_lock, name, factory)
+
+	@property
+	def profiles(self):
+		'''Cached profile metadata from the client'''
+		def create():
+			from profilecache import ProfileCache
+			return ProfileCache(self.client)
+		return self._get_shared('profiles', create)
+
+	@property
+	def queries(self):
+		'''Cached read-only queries made through the client'''
+		def create():
+			from querycache import CachedClient
+			return CachedClient(self.client)
+		return self._get_shared('queries', create)
+
+	@property
+	def tracer(self):
+		'''Per-command timing, which is off until turned on with the timing command'''
+		def create():
+			from tracing import Tracer
+			return Tracer()
+		return self._get_shared('tracer', create)
+
+	@property
+	def completion_stats(self):
+		'''Counts of how completion requests ended'''
+		def create():
+			from completion import CompletionStats
+			return CompletionStats()
+		return self._get_shared('completion_stats', create)
+
+	@property
+	def history(self):
+		'''Commands entered at the prompt. The files are not read until the history is used.'''
+		def create():
+			from history import get_history_path, HistoryStore
+			return HistoryStore(get_history_path())
+		return self._get_shared('history', create)
+
+	@property
+	def connections(self):
+		'''Sessions for server-bound commands, keyed by server address. The client handles local 
+profile management.'''
+		def create():
+			from connpool import ConnectionPool
+			return ConnectionPool(connect_client, tracer=self.tracer)
+		return self._get_shared('connections', create)
+
+	@property
+	def rate_control(self):
+		'''Limits on how hard requests push each server, shared by every command'''
+		def create():
+			from ratecontrol import RateControl
+			return RateControl()
+		return self._get_shared('rate_control', create)
+
+	@property
+	def jobs(self):
+		'''Commands running in the background in this session'''
+		def create():
+			from jobs import JobTable
+			return JobTable()
+		return self._get_session('jobs', create)
+
+	@property
+	def coprocess(self):
+		'''Shell used by the shell command in this session. It follows the working directory in 
+pwd.'''
+		def create():
+			from coprocess import ShellCoprocess
+			return ShellCoprocess()
+		return self._get_session('coprocess', create)
+
+	def new_session(self, pwd: str):
+		'''Returns a ShellState for a separate session which starts in the specified directory. 
+The new session has its own directory, aliases, jobs, server groups, and shell process, but 
+shares this one's client, profiles, server connections, timing, and history.'''
+		state = copy.copy(self)
+		state.pwd = pwd
+		state.oldpwd = ''
+		state.aliases = dict()
+		state.server_groups = dict()
+		state._session = dict()
+		return state
+
+
+class Invocation:
+	'''Immutable record of a single use of a command: the raw input line, the command name as 
+typed, the arguments with quotes and escapes removed, and the Tokens they came from. A new 
+Invocation is created for each command executed, so command objects themselves hold no 
+per-call state and can be shared between threads.'''
+	__slots__ = ('raw', 'name', 'args', 'tokens')
+
+	def __init__(self, raw_input: str, ptokens=None):
+		if ptokens is None:
+			ptokens = tokenize(raw_input)
+		object.__setattr__(self, 'raw', raw_input)
+		object.__setattr__(self, 'tokens', tuple(ptokens))
+		object.__setattr__(self, 'name', ptokens[0].value if ptokens else '')
+		object.__setattr__(self, 'args', tuple(get_values(ptokens[1:])))
+
+	def __setattr__(self, name, value):
+		raise AttributeError('Invocation objects are immutable')
+
+	def __delattr__(self, name):
+		raise AttributeError('Invocation objects are immutable')
+
+	def __repr__(self):
+		return 'Invocation(%r)' % self.raw
+
+
+class CommandFailure(str):
+	'''The message returned by a command which couldn't do what was asked. It is an ordinary
+string in every other way, so callers which only print the message need not check for it, but
+the shell reports it as a failure, which gives batch mode and the daemon a non-zero status for
+the command. Informational messages are returned as plain strings.'''
+
 
 # The main base Command class. Defines the basic API and all tagsh commands
-# inherit from it
+# inherit from it. Command objects are shared by all callers, so subclasses must 
+# not store anything specific to one use of the command in the object. Everything
+# about a particular use of a command is passed in an Invocation.
 class BaseCommand:
 	'''Provides the base API for interacting with Command objects'''
 	def parse_input(self, raw_input):
 		'''Tokenize the raw input from the user'''
-		if len(raw_input) < 1:
-			return list()
-		
-		rawTokens = re.findall(r'"[^"]+"|\S+', raw_input.strip())
-		tokens = list()
-		for token in rawTokens:
-			tokens.append(token.strip('"'))
-		return tokens
-	
-	def set(self, raw_input=None, ptoken_list=None):
-		'''Sets the input and does some basic parsing'''
-		if not raw_input:
-			self.rawCommand = ''
-			self.tokenList = list()
-		else:
-			self.rawCommand = raw_input
-			rawTokens = list()
-			if ptoken_list is None:
-				rawTokens = self.parse_input(raw_input)
-			else:
-				rawTokens = ptoken_list
-			
-			if len(rawTokens) > 1:
-				self.tokenList = rawTokens[1:]
-			else:
-				self.tokenList = list()
-	
-	def __init__(self, raw_input=None, ptoken_list=None):
-		self.set(raw_input,ptoken_list)
-		if raw_input:
-			self.name = raw_input.split(' ')
+		return get_values(tokenize(raw_input))
+	
+	def __init__(self):
+		self.name = ''
 		self.helpInfo = ''
 		self.description = ''
 	
@@ -81,26 +228,54 @@ class BaseCommand:
 		'''Returns the command's name'''
 		return self.name
 	
-	def is_valid(self):
+	def is_valid(self, pinvocation):
 		'''Subclasses validate their information and return an error string'''
 		return ''
 	
-	def execute(self, pshell_state):
+	def execute(self, pinvocation, pshell_state):
 		'''The base class purposely does nothing. To be implemented by subclasses'''
 		return ''
 	
+	def reads_input(self):
+		'''Returns True if the command can read the output of another through a pipe'''
+		return False
+	
+	def reads_whole_line(self):
+		'''Returns True if the command passes the rest of its line on to be run by something 
+else, in which case a | in it is left for that to handle'''
+		return False
+	
+	def uses_fixed_server(self):
+		'''Returns True if the command sends requests to a server which it can't be pointed at, 
+such as one the client library always connects to itself, so the on command refuses to run it'''
+		return False
+	
+	def prompts(self, pinvocation):
+		'''Returns True if running the command as given asks the user for input'''
+		return False
+	
+	def pipe(self, pinvocation, pshell_state, precords):
+		'''Runs the command as a stage of a pipeline and returns an iterator over its output 
+lines. precords is an iterator over the previous stage's output or None for the first stage. 
+The base class runs execute() in a thread and passes on what it prints. Commands which read 
+input or can produce their output as a generator override this.'''
+		import pipeline
+		return pipeline.run_printing_command(self, pinvocation, pshell_state)
+	
 	def autocomplete(self, ptokens, pshell_state):
 		'''Subclasses implement whatever is needed for their specific case. ptokens 
 contains all tokens from the raw input except the name of the command. All 
 double quotes have been stripped. Subclasses are expected to return a list 
-containing matches.'''
+containing matches or to be a generator yielding them. Completion has a time 
+limit and is abandoned when the user keeps typing, so slow subclasses should 
+yield matches as they are found rather than build a list.'''
 		return list()
 
 
 class FilespecBaseCommand(BaseCommand):
 	'''Many commands operate on a list of file specifiers'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		super().__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		super().__init__()
 		self.name = 'FilespecBaseCommand'
 		
 	def ProcessFileList(self, ptoken_list):
@@ -130,15 +305,17 @@ class FilespecBaseCommand(BaseCommand):
 # This function implements autocompletion for command
 # which take a filespec. This can be a directory, file, or 
 # wildcard. If a wildcard, we return no results.
-def GetFileSpecCompletions(pFileToken):
+def GetFileSpecCompletions(pFileToken, dirs_only=False):
 	'''Implements autocompletion for commands which take a filespec. This 
 be a directory, filename, or wildcard. If a wildcard, this method returns no 
-results.'''
+results. If dirs_only is True, only directories are returned and they are 
+returned without a trailing slash. Matches are yielded one at a time so that 
+completion in large directories can be cut short.'''
 
 	if not pFileToken or '*' in pFileToken:
-		return list()
+		return
 	
-	outData = list()
+	from fscache import gDirCache
 	
 	if pFileToken[0] == '"':
 		quoteMode = True
@@ -146,21 +323,19 @@ results.'''
 		quoteMode = False
 	
 	if quoteMode:
-		items = glob(pFileToken[1:] + '*')
+		items = gDirCache.complete(pFileToken[1:], dirs_only)
 	else:
-		items = glob(pFileToken + '*')
+		items = gDirCache.complete(pFileToken, dirs_only)
 	
-	for item in items:
+	for item, isdir in items:
 		display = item
 		if quoteMode or ' ' in item:
 			data = '"' + item + '"'
 		else:
 			data = item
 		
-		if os.path.isdir(item):
+		if isdir and not dirs_only:
 			data = data + '/'
 			display = display + '/'
 		
-		outData.append([data,display])
-			
-	return outData
+		yield [data,display]
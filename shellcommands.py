@@ -1,43 +1,161 @@
 '''Contains the implementations for shell commands'''
 # pylint: disable=unused-argument,too-many-branches
 import collections
+import contextlib
+import functools
 from getpass import getpass
-from glob import glob
 import os
 import platform
-import subprocess
+import re
 import sys
+import tarfile
+import time
 
 from prompt_toolkit import print_formatted_text, HTML
 
 from pyanselus.encryption import check_password_complexity
+from breachfilter import is_password_breached
+import bulkops
+from commandaccess import gCommandAccess
+from coprocess import run_interactive, ShellCoprocess
+import fanout
 import helptext
-from shellbase import BaseCommand, gShellCommands, ShellState
+import lister
+import pipeline
+import profilearchive
+from ratecontrol import is_overload_status
+from shellbase import BaseCommand, CommandFailure, gShellCommands, GetFileSpecCompletions, \
+	Invocation, ShellState
+
+class CommandConnections(BaseCommand):
+	'''Shows and manages pooled server sessions'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'connections'
+		self.helpInfo = helptext.connections_cmd
+		self.description = 'Show open server sessions'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if pinvocation.args:
+			if pinvocation.args[0].casefold() != 'close' or len(pinvocation.args) > 2:
+				print(self.helpInfo)
+				return ''
+			
+			address = pinvocation.args[1] if len(pinvocation.args) == 2 else ''
+			count = pshell_state.connections.close_all(address)
+			return 'Closed %s sessions' % count
+
+		connlist = pshell_state.connections.get_connections()
+		if not connlist:
+			return 'No open sessions'
+		
+		print("%-32s %-7s %9s %9s %9s" % ('Server', 'State', 'Age', 'Idle', 'Requests'))
+		for conn in connlist:
+			print("%-32s %-7s %8.0fs %8.0fs %9s" % (conn.address,
+					'in use' if conn.in_use else 'idle', conn.get_age(), conn.get_idle_time(),
+					conn.requests))
+		return ''
+
 
 class CommandEmpty(BaseCommand):
 	'''Special command just to handle blanks'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = ''
 
 
+class CommandTiming(BaseCommand):
+	'''Controls per-command timing'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'timing'
+		self.helpInfo = helptext.timing_cmd
+		self.description = 'Measure where command time goes'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if not pinvocation.args:
+			return 'Timing is %s' % ('on' if pshell_state.tracer.enabled else 'off')
+
+		verb = pinvocation.args[0].casefold()
+		if verb == 'on' and len(pinvocation.args) == 1:
+			pshell_state.tracer.enabled = True
+		elif verb == 'off' and len(pinvocation.args) == 1:
+			pshell_state.tracer.enabled = False
+		elif verb == 'completion' and len(pinvocation.args) == 1:
+			counts = pshell_state.completion_stats.get_counts()
+			print('Completion requests: %s' % counts['requested'])
+			print('Finished: %s' % counts['completed'])
+			print('Dropped before starting: %s' % counts['dropped'])
+			print('Cancelled while running: %s' % counts['cancelled'])
+			print('Stopped at time limit: %s' % counts['over_budget'])
+		elif verb == 'export' and len(pinvocation.args) == 2:
+			try:
+				count = pshell_state.tracer.export(pinvocation.args[1])
+			except OSError as e:
+				return CommandFailure("Couldn't export trace: %s" % e)
+			return 'Wrote %s spans to %s' % (count, pinvocation.args[1])
+		else:
+			print(self.helpInfo)
+		return ''
+
+	def autocomplete(self, ptokens: list, pshell_state: ShellState):
+		if len(ptokens) == 1:
+			return [i for i in [ 'on', 'off', 'export', 'completion' ] if i.startswith(ptokens[0])]
+		if len(ptokens) == 2 and ptokens[0] == 'export':
+			return GetFileSpecCompletions(ptokens[1])
+		return list()
+
+
 class CommandUnrecognized(BaseCommand):
 	'''Special class for handling anything the shell doesn't support'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,'unrecognized')
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'unrecognized'
 
-	def is_valid(self) -> str:
+	def is_valid(self, pinvocation: Invocation) -> str:
 		return "Unknown command"
 
-	def execute(self, pshell_state: ShellState) -> str:
-		return "Unknown command"
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		return CommandFailure("Unknown command")
+
+
+class CommandCache(BaseCommand):
+	'''Shows or clears cached lookups'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'cache'
+		self.helpInfo = helptext.cache_cmd
+		self.description = 'Show or clear cached lookups'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		verb = pinvocation.args[0] if pinvocation.args else 'stats'
+		if len(pinvocation.args) > 1 or verb not in [ 'stats', 'clear' ]:
+			print(self.helpInfo)
+			return ''
+
+		cache = pshell_state.queries.cache
+		if verb == 'clear':
+			cache.clear()
+			return 'Cache cleared'
+
+		stats = cache.get_stats()
+		if stats['queries']:
+			print('%-24s %8s %8s %9s %8s' % ('Query', 'Hits', 'Misses', 'Hit rate', 'Cached'))
+			for name, hits, misses, rate, cached in stats['queries']:
+				print('%-24s %8s %8s %8.1f%% %8s' % (name, hits, misses, rate * 100, cached))
+		return 'Using %.1f KiB of %.1f KiB, %s results evicted' % (stats['memory'] / 1024,
+			stats['budget'] / 1024, stats['evictions'])
+
+	def autocomplete(self, ptokens: list, pshell_state: ShellState):
+		if len(ptokens) == 1:
+			return [ c for c in [ 'stats', 'clear' ] if c.startswith(ptokens[0]) ]
+		return list()
 
 
 class CommandChDir(BaseCommand):
 	'''Change directories'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'chdir'
 		self.helpInfo = 'Usage: cd <location>\nChanges to the specified directory\n\n' + \
 						'Aliases: cd'
@@ -46,20 +164,20 @@ class CommandChDir(BaseCommand):
 	def get_aliases(self) -> dict:
 		return { "cd":"chdir" }
 
-	def execute(self, pshell_state: ShellState) -> str:
-		if self.tokenList:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if pinvocation.args:
 			new_dir = ''
-			if '~' in self.tokenList[0]:
+			if '~' in pinvocation.args[0]:
 				if platform.system().casefold() == 'windows':
-					new_dir = self.tokenList[0].replace('~', os.getenv('USERPROFILE'))
+					new_dir = pinvocation.args[0].replace('~', os.getenv('USERPROFILE'))
 				else:
-					new_dir = self.tokenList[0].replace('~', os.getenv('HOME'))
+					new_dir = pinvocation.args[0].replace('~', os.getenv('HOME'))
 			else:
-				new_dir = self.tokenList[0]
+				new_dir = pinvocation.args[0]
 			try:
 				os.chdir(new_dir)
 			except Exception as e:
-				return e.__str__()
+				return CommandFailure(e.__str__())
 
 		pshell_state.oldpwd = pshell_state.pwd
 		pshell_state.pwd = os.getcwd()
@@ -68,33 +186,37 @@ class CommandChDir(BaseCommand):
 
 	def autocomplete(self, ptokens: list, pshell_state: ShellState):
 		if len(ptokens) == 1:
-			out_data = list()
-			
-			quote_mode = bool(ptokens[0][0] == '"')
-			if quote_mode:
-				items = glob(ptokens[0][1:] + '*')
-			else:
-				items = glob(ptokens[0] + '*')
-			
-			for item in items:
-				if not os.path.isdir(item):
-					continue
-
-				display = item
-				if quote_mode or ' ' in item:
-					data = '"' + item + '"'
-				else:
-					data = item
-				out_data.append([data,display])
-					
-			return out_data
+			return GetFileSpecCompletions(ptokens[0], dirs_only=True)
 		return list()
 
 
+class CommandCount(BaseCommand):
+	'''Counts the lines of a pipeline'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'count'
+		self.helpInfo = helptext.count_cmd
+		self.description = 'Count lines from a pipe'
+
+	def is_valid(self, pinvocation: Invocation) -> str:
+		if pinvocation.args:
+			return 'count takes no arguments'
+		return ''
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		return CommandFailure('count reads the output of another command, such as ls | count')
+
+	def reads_input(self) -> bool:
+		return True
+
+	def pipe(self, pinvocation: Invocation, pshell_state: ShellState, precords):
+		return pipeline.count_records(precords)
+
+
 class CommandExit(BaseCommand):
 	'''Exit the program'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,'exit')
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'exit'
 		self.helpInfo = 'Usage: exit\nCloses the connection and exits the shell.'
 		self.description = 'Exits the shell'
@@ -102,14 +224,109 @@ class CommandExit(BaseCommand):
 	def get_aliases(self) -> dict:
 		return { "x":"exit", "q":"exit" }
 
-	def execute(self, pshell_state: ShellState) -> str:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		pshell_state.coprocess.close()
 		sys.exit(0)
 
 
+class CommandFilter(BaseCommand):
+	'''Passes on the lines of a pipeline which match a pattern'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'filter'
+		self.helpInfo = helptext.filter_cmd
+		self.description = 'Keep lines from a pipe which match'
+
+	def get_aliases(self) -> dict:
+		return { "grep":"filter" }
+
+	@staticmethod
+	def parse_args(pinvocation: Invocation) -> tuple:
+		'''Returns the pattern, a dictionary of flags, and an error string'''
+		flags = { '-e':False, '-i':False, '-v':False }
+		pattern = None
+		for arg in pinvocation.args:
+			if arg in flags and pattern is None:
+				flags[arg] = True
+			elif pattern is None:
+				pattern = arg
+			else:
+				return '', flags, 'Only one pattern may be given. Quote patterns with spaces.'
+		if pattern is None:
+			return '', flags, 'filter needs a pattern'
+		if flags['-e']:
+			try:
+				re.compile(pattern)
+			except re.error as e:
+				return '', flags, 'Bad regular expression: %s' % e
+		return pattern, flags, ''
+
+	def is_valid(self, pinvocation: Invocation) -> str:
+		return self.parse_args(pinvocation)[2]
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		return CommandFailure('filter reads the output of another command, such as ls | filter .py')
+
+	def reads_input(self) -> bool:
+		return True
+
+	def pipe(self, pinvocation: Invocation, pshell_state: ShellState, precords):
+		pattern, flags, _ = self.parse_args(pinvocation)
+		return pipeline.filter_records(precords, pattern, regex=flags['-e'],
+			ignore_case=flags['-i'], invert=flags['-v'])
+
+
+class CommandGroup(BaseCommand):
+	'''Manages named groups of servers for the on command'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'group'
+		self.helpInfo = helptext.group_cmd
+		self.description = 'Manage named groups of servers'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		groups = pshell_state.server_groups
+		args = pinvocation.args
+		if not args:
+			if not groups:
+				return 'No server groups defined'
+			for name in sorted(groups):
+				print('%s: %s' % (name, ','.join(groups[name])))
+			return ''
+
+		if args[0] == 'delete' and len(args) == 2:
+			if args[1] not in groups:
+				return CommandFailure('No server group named %s' % args[1])
+			del groups[args[1]]
+			return ''
+
+		if len(args) == 1:
+			if args[0] not in groups:
+				return CommandFailure('No server group named %s' % args[0])
+			print('%s: %s' % (args[0], ','.join(groups[args[0]])))
+			return ''
+
+		if len(args) > 2 or args[0] == 'delete' or args[0].startswith('@'):
+			print(self.helpInfo)
+			return ''
+
+		servers, error = fanout.expand_servers(args[1], groups)
+		if error:
+			return CommandFailure(error)
+		groups[args[0]] = servers
+		return ''
+
+	def autocomplete(self, ptokens: list, pshell_state: ShellState):
+		names = sorted(pshell_state.server_groups) + [ 'delete' ]
+		if len(ptokens) == 1 or (len(ptokens) == 2 and ptokens[0] == 'delete'):
+			return [ i for i in names if i.startswith(ptokens[-1]) and i != ptokens[0] ]
+		return list()
+
+
 class CommandHelp(BaseCommand):
 	'''Implements the help system'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,'help')
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'help'
 		self.helpInfo = 'Usage: help <command>\nProvides information on a command.\n\n' + \
 						'Aliases: ?'
@@ -118,108 +335,303 @@ class CommandHelp(BaseCommand):
 	def get_aliases(self) -> dict:
 		return { "?":"help" }
 
-	def execute(self, pshell_state: ShellState) -> str:
-		if self.tokenList:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if pinvocation.args:
 			# help <keyword>
-			for cmdName in self.tokenList:
+			for cmdName in pinvocation.args:
 				if len(cmdName) < 1:
 					continue
 
 				if cmdName in gShellCommands:
 					print(gShellCommands[cmdName].get_help())
-				else:
+				elif sys.stdout.isatty():
 					print_formatted_text(HTML(
 						"No help on <gray><b>%s</b></gray>" % cmdName))
+				else:
+					print("No help on %s" % cmdName)
 		else:
-			# Bare help command: print available commands
+			# Bare help command: print available commands. Formatted text goes straight to the 
+			# terminal, so plain text is printed when the output is going elsewhere, such as
+			# into a pipe.
 			ordered = collections.OrderedDict(sorted(gShellCommands.items()))
 			for name,item in ordered.items():
-				print_formatted_text(HTML(
-					"<gray><b>%s</b>\t%s</gray>" % (name, item.get_description())
-				))
+				if sys.stdout.isatty():
+					print_formatted_text(HTML(
+						"<gray><b>%s</b>\t%s</gray>" % (name, item.get_description())
+					))
+				else:
+					print("%s\t%s" % (name, item.get_description()))
+		return ''
+
+
+class CommandHead(BaseCommand):
+	'''Passes on the first lines of a pipeline'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'head'
+		self.helpInfo = helptext.head_cmd
+		self.description = 'Keep the first lines from a pipe'
+
+	@staticmethod
+	def parse_args(pinvocation: Invocation) -> tuple:
+		'''Returns the number of lines and an error string'''
+		args = pinvocation.args
+		if not args:
+			return 10, ''
+		if len(args) == 2 and args[0] == '-n':
+			args = args[1:]
+		if len(args) != 1:
+			return 0, 'Usage: head [-n count]'
+		try:
+			count = int(args[0].lstrip('-') if len(pinvocation.args) == 1 else args[0])
+		except ValueError:
+			return 0, 'The number of lines must be a number'
+		if count < 0:
+			return 0, 'The number of lines may not be negative'
+		return count, ''
+
+	def is_valid(self, pinvocation: Invocation) -> str:
+		return self.parse_args(pinvocation)[1]
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		return CommandFailure('head reads the output of another command, such as ls | head')
+
+	def reads_input(self) -> bool:
+		return True
+
+	def pipe(self, pinvocation: Invocation, pshell_state: ShellState, precords):
+		return pipeline.head_records(precords, self.parse_args(pinvocation)[0])
+
+
+class CommandHistory(BaseCommand):
+	'''Shows and searches the command history'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'history'
+		self.helpInfo = helptext.history_cmd
+		self.description = 'Show previously entered commands'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		count = 20
+		failed = False
+		host = ''
+		pattern = None
+		words = list()
+		args = list(pinvocation.args)
+		while args:
+			arg = args.pop(0)
+			if arg in [ '-n', '--host', '-e' ]:
+				if not args:
+					return CommandFailure('%s needs a value' % arg)
+				value = args.pop(0)
+				if arg == '-n':
+					try:
+						count = int(value)
+					except ValueError:
+						return CommandFailure('-n must be followed by a number')
+					if count < 1:
+						return CommandFailure('-n must be followed by a positive number')
+				elif arg == '--host':
+					host = value
+				else:
+					try:
+						pattern = re.compile(value.encode('utf-8'))
+					except re.error as e:
+						return CommandFailure('Bad regular expression: %s' % e)
+			elif arg == '--failed':
+				failed = True
+			else:
+				words.append(arg)
+
+		try:
+			records = self.find_records(pshell_state, words, pattern, failed, host, count)
+		except OSError as e:
+			return CommandFailure("Couldn't read the history: %s" % e)
+
+		for record in records:
+			print(self.format_record(record))
+		return ''
+
+	@staticmethod
+	def find_records(pshell_state: ShellState, words: list, pattern, failed: bool, host: str,
+					count: int) -> list:
+		'''Returns up to count of the most recent matching records, oldest first'''
+		records = list()
+		for record in pshell_state.history.find(' '.join(words), pattern, failed, host):
+			records.append(record)
+			if len(records) >= count:
+				break
+		records.reverse()
+		return records
+
+	@staticmethod
+	@functools.lru_cache(maxsize=1024)
+	def format_minute(minute: int) -> str:
+		'''Returns the time shown for records from a minute, counted from the epoch'''
+		return time.strftime('%Y-%m-%d %H:%M', time.localtime(minute * 60))
+
+	@staticmethod
+	def format_record(record) -> str:
+		'''Returns the line shown for a history record'''
+		status = '  ' if not record.status else '%2s' % record.status
+		return '%7s  %s  %s %s  %s' % (record.index + 1,
+			CommandHistory.format_minute(record.timestamp // 60), record.host, status,
+			record.command)
+
+	def pipe(self, pinvocation: Invocation, pshell_state: ShellState, precords):
+		# With no options, the whole history is read as the pipeline asks for it
+		if pinvocation.args:
+			return BaseCommand.pipe(self, pinvocation, pshell_state, precords)
+		return (self.format_record(r) for r in pshell_state.history.iter_forward())
+
+
+class CommandJobs(BaseCommand):
+	'''Lists background commands'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'jobs'
+		self.helpInfo = helptext.jobs_cmd
+		self.description = 'List commands running in the background'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		for job in pshell_state.jobs.get_jobs():
+			print("[%s] %-10s %8.1fs  %s" % (job.id, job.get_status(), job.get_elapsed(),
+					job.command_line))
+		pshell_state.jobs.remove_finished()
 		return ''
 
 
 class CommandListDir(BaseCommand):
-	'''Performs a directory listing by calling the shell'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	'''Performs a directory listing'''
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'ls'
-		self.helpInfo = 'Usage: as per bash ls command or Windows dir command'
+		self.helpInfo = helptext.ls_cmd
 		self.description = 'list directory contents'
 
 	def get_aliases(self) -> dict:
 		return { "dir":"ls" }
 
-	def execute(self, pshell_state: ShellState) -> str:
-		if sys.platform == 'win32':
-			tokens = ['dir','/w']
-			tokens.extend(self.tokenList)
-			subprocess.call(tokens, shell=True)
-		else:
-			tokens = ['ls','--color=auto']
-			tokens.extend(self.tokenList)
-			subprocess.call(tokens)
-		return ''
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		error = lister.list_paths(pinvocation.args)
+		return CommandFailure(error) if error else ''
 
 	def autocomplete(self, ptokens: list, pshell_state: ShellState):
 		if len(ptokens) == 1:
-			out_data = list()
-			
-			if ptokens[0][0] == '"':
-				quote_mode = True
-			else:
-				quote_mode = False
-			
-			if quote_mode:
-				items = glob(ptokens[0][1:] + '*')
-			else:
-				items = glob(ptokens[0] + '*')
-			
-			for item in items:
-				if not os.path.isdir(item):
-					continue
+			return GetFileSpecCompletions(ptokens[0], dirs_only=True)
+		return list()
 
-				display = item
-				if quote_mode or ' ' in item:
-					data = '"' + item + '"'
-				else:
-					data = item
-				out_data.append([data,display])
-					
-			return out_data
+
+class CommandOn(BaseCommand):
+	'''Runs a command for each of a list of servers'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'on'
+		self.helpInfo = helptext.on_cmd
+		self.description = 'Run a command against several servers'
+
+	def reads_whole_line(self) -> bool:
+		# A pipe applies to the command run for each server
+		return True
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		options = { '-j':8, '-t':30.0 }
+		index = 0
+		args = pinvocation.args
+		while index + 1 < len(args) and args[index] in options:
+			try:
+				options[args[index]] = type(options[args[index]])(args[index + 1])
+			except ValueError:
+				return CommandFailure('%s must be followed by a number' % args[index])
+			index += 2
+
+		if len(args) < index + 2 or options['-j'] < 1 or options['-t'] <= 0:
+			print(self.helpInfo)
+			return ''
+
+		servers, error = fanout.expand_servers(args[index], pshell_state.server_groups)
+		if error:
+			return CommandFailure(error)
+
+		# The command is passed on as typed so that its own quoting is kept
+		command = pinvocation.raw[pinvocation.tokens[index + 2].start:]
+		cmd = gCommandAccess.get_command(pinvocation.tokens[index + 2].value)
+		if cmd.get_name() == self.name:
+			return CommandFailure('The on command cannot run itself')
+		if cmd.get_name() == 'unrecognized':
+			return CommandFailure('Unknown command %s' % pinvocation.tokens[index + 2].value)
+		if cmd.uses_fixed_server():
+			return CommandFailure("%s can't send its requests to another server, so it can't " \
+				"be run for several servers" % cmd.get_name())
+		if cmd.prompts(Invocation(command)):
+			return CommandFailure("%s asks for input, so it can't be run for several servers at " \
+				"once" % cmd.get_name())
+		if fanout.SERVER_PLACEHOLDER not in command:
+			return CommandFailure("Put {server} where the command should use each server's " \
+				"address.")
+
+		results = fanout.run_on_servers(servers, command, pshell_state, options['-j'],
+										options['-t'])
+		for result in results:
+			if result.output.strip():
+				print('--- %s ---' % result.server)
+				print(result.output.rstrip('\n'))
+		print(fanout.format_results(results))
+
+		failed = [ r for r in results if r.status != 'ok' ]
+		if failed:
+			return CommandFailure('%s of %s servers failed' % (len(failed), len(results)))
+		return ''
+
+	def autocomplete(self, ptokens: list, pshell_state: ShellState):
+		if len(ptokens) == 1 and ptokens[0].startswith('@'):
+			return [ '@' + i for i in sorted(pshell_state.server_groups) \
+				if i.startswith(ptokens[0][1:]) ]
 		return list()
 
 
 class CommandPreregister(BaseCommand):
 	'''Preregister an account for someone'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self, raw_input, ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'preregister'
 		self.helpInfo = helptext.preregister_cmd
 		self.description = 'Preregister a new account for someone.'
-		
-	def execute(self, pshell_state: ShellState) -> str:
-		if len(self.tokenList) > 2 or len(self.tokenList) == 0:
+	
+	def uses_fixed_server(self) -> bool:
+		# Servers only accept preregistration from a client on the same machine
+		return True
+	
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if '--from' in pinvocation.args:
+			return self.execute_bulk(pinvocation, pshell_state)
+
+		if len(pinvocation.args) > 2 or len(pinvocation.args) == 0:
 			print(self.helpInfo)
 			return ''
 		
 		try:
-			port = int(self.tokenList[0])
+			port = int(pinvocation.args[0])
 		except:
-			return 'Bad port number'
+			return CommandFailure('Bad port number')
 		
 		user_id = ''
-		if len(self.tokenList) == 2:
-			user_id = self.tokenList[1]
+		if len(pinvocation.args) == 2:
+			user_id = pinvocation.args[1]
 		
 		if user_id and ('"' in user_id or '/' in user_id):
-			return 'User ID may not contain " or /.'
+			return CommandFailure('User ID may not contain " or /.')
 		
-		status = pshell_state.client.preregister_account(port, user_id)
+		address = 'localhost:%s' % port
+		try:
+			with pshell_state.connections.borrow(address) as session:
+				status = pshell_state.rate_control.get(address).call(
+					lambda: session.preregister(user_id), is_overload_status)
+		except OSError as e:
+			return CommandFailure('Preregistration error: %s' % e)
 		
 		if status['status'] != 200:
-			return 'Preregistration error: %s' % (status.info())
+			return CommandFailure('Preregistration error: %s' % (status.info()))
 		
 		outparts = [ 'Preregistration success:\n' ]
 		if status['uid']:
@@ -228,91 +640,280 @@ class CommandPreregister(BaseCommand):
 						'Registration Code: ', status['regcode']])
 		return ''.join(outparts)
 
+	def execute_bulk(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		'''Handles preregistering workspaces for each row in a CSV file'''
+		options = { '--from':'', '--out':'', '--jobs':'32', '--start':'1', '--rate':'0' }
+		flags = { '--resume':False, '--stop-on-error':False }
+		port = 2001
+		index = 0
+		while index < len(pinvocation.args):
+			token = pinvocation.args[index]
+			if token in options:
+				if index + 1 >= len(pinvocation.args):
+					return CommandFailure('Missing value for %s' % token)
+				options[token] = pinvocation.args[index + 1]
+				index += 2
+				continue
+			
+			if token in flags:
+				flags[token] = True
+			else:
+				try:
+					port = int(token)
+				except:
+					return CommandFailure('Bad port number')
+			index += 1
+		
+		if not options['--from'] or not options['--out']:
+			print(self.helpInfo)
+			return ''
+		
+		try:
+			jobs = int(options['--jobs'])
+			start_row = int(options['--start'])
+			rate = float(options['--rate'])
+		except:
+			return CommandFailure('The number of jobs, the starting row, and the rate must be ' \
+				'numbers')
+		
+		if jobs < 1 or start_row < 1:
+			return CommandFailure('The number of jobs and the starting row must be at least 1')
+		if rate < 0:
+			return CommandFailure('The rate may not be negative')
+		
+		address = 'localhost:%s' % port
+		# A --rate cap applies to this run only. Caps set with ratelimit are restored afterward.
+		limiter = pshell_state.rate_control.get(address)
+		try:
+			with limiter.rate_cap(rate) if rate else contextlib.nullcontext():
+				summary = bulkops.preregister_from_csv(pshell_state.connections, port,
+							options['--from'], options['--out'], jobs=jobs, start_row=start_row,
+							resume=flags['--resume'], stop_on_error=flags['--stop-on-error'],
+							limiter=limiter)
+		except OSError as e:
+			return CommandFailure('Bulk preregistration error: %s' % e)
+		
+		outparts = [ 'Preregistered %s of %s workspaces' % (summary['succeeded'],
+					summary['sent']) ]
+		if summary['failed']:
+			outparts.extend(['\n%s rows failed, starting with row %s. Run the same command ' \
+				'with --resume to retry them.' % (summary['failed'], summary['failed_rows'][0])])
+			return CommandFailure(''.join(outparts))
+		return ''.join(outparts)
+
 
 class CommandProfile(BaseCommand):
 	'''User profile management command'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self, raw_input, ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'profile'
 		self.helpInfo = helptext.profile_cmd
 		self.description = 'Manage profiles.'
 	
-	def execute(self, pshell_state: ShellState) -> str:
-		if not self.tokenList:
-			print('Active profile: %s' % pshell_state.client.get_active_profile_name())
+	def prompts(self, pinvocation: Invocation) -> bool:
+		# Deleting a profile asks for confirmation
+		return bool(pinvocation.args) and pinvocation.args[0].casefold() == 'delete'
+	
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if not pinvocation.args:
+			print('Active profile: %s' % pshell_state.profiles.get_active())
 			return ''
 
-		verb = self.tokenList[0].casefold()
-		if len(self.tokenList) == 1:
+		verb = pinvocation.args[0].casefold()
+		if verb == 'export':
+			return self.export_profile(pinvocation, pshell_state)
+		if verb == 'import':
+			return self.import_profile(pinvocation, pshell_state)
+		if len(pinvocation.args) == 1:
 			if verb == 'list':
 				print("Profiles:")
-				profiles = pshell_state.client.get_profiles()
-				for profile in profiles:
-					print(profile.name)
+				for name in pshell_state.profiles.get_names():
+					print(name)
 			else:
 				print(self.get_help())
 			return ''
 
+		# Each of the remaining verbs changes the profile list, the active profile, or the default.
+		# The caches are cleared afterward so that a reload made while the change was under way,
+		# such as by completion, isn't kept.
+		try:
+			return self.change_profiles(verb, pinvocation, pshell_state)
+		finally:
+			pshell_state.profiles.invalidate()
+			pshell_state.queries.invalidate()
+
+	def change_profiles(self, verb: str, pinvocation: Invocation,
+						pshell_state: ShellState) -> str:
+		'''Handles the verbs which create, delete, rename, or activate profiles'''
 		if verb == 'create':
-			status = pshell_state.client.create_profile(self.tokenList[1])
+			status = pshell_state.client.create_profile(pinvocation.args[1])
 			if status.error():
-				print("Couldn't create profile: %s" % status.info())
+				return CommandFailure("Couldn't create profile: %s" % status.info())
 		elif verb == 'delete':
-			print("This will delete the profile and all of its files. It can't be undone.")
-			choice = input("Really delete profile '%s'? [y/N] " % self.tokenList[1]).casefold()
+			print("This will delete the profile and all of its files. It can't be undone. Use " \
+				"profile export to keep a copy.")
+			choice = input("Really delete profile '%s'? [y/N] " % pinvocation.args[1]).casefold()
 			if choice in [ 'y', 'yes' ]:
-				status = pshell_state.client.delete_profile(self.tokenList[1])
+				status = pshell_state.client.delete_profile(pinvocation.args[1])
 				if status.error():
-					print("Couldn't delete profile: %s" % status.info())
-				else:
-					print("Profile '%s' has been deleted" % self.tokenList[1])
+					return CommandFailure("Couldn't delete profile: %s" % status.info())
+				print("Profile '%s' has been deleted" % pinvocation.args[1])
 		elif verb == 'set':
-			status = pshell_state.client.activate_profile(self.tokenList[1])
+			status = pshell_state.client.activate_profile(pinvocation.args[1])
 			if status.error():
-				print("Couldn't activate profile: %s" % status.info())
+				return CommandFailure("Couldn't activate profile: %s" % status.info())
 		elif verb == 'setdefault':
-			status = pshell_state.client.set_default_profile(self.tokenList[1])
+			status = pshell_state.client.set_default_profile(pinvocation.args[1])
 			if status.error():
-				print("Couldn't set profile as default: %s" % status.info())
+				return CommandFailure("Couldn't set profile as default: %s" % status.info())
 		elif verb == 'rename':
-			if len(self.tokenList) != 3:
+			if len(pinvocation.args) != 3:
 				print(self.get_help())
 				return ''
-			status = pshell_state.client.rename_profile(self.tokenList[1], self.tokenList[2])
+			status = pshell_state.client.rename_profile(pinvocation.args[1], pinvocation.args[2])
 			if status.error():
-				print("Couldn't rename profile: %s" % status.info())
+				return CommandFailure("Couldn't rename profile: %s" % status.info())
 		else:
 			print(self.get_help())
 		return ''
 	
+	@staticmethod
+	def get_profile_path(pshell_state: ShellState, name: str) -> str:
+		'''Returns the folder of the named profile or an empty string if there is no such
+profile'''
+		for profile in pshell_state.client.get_profiles():
+			if profile.name == name:
+				return profile.path
+		return ''
+
+	def export_profile(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		'''Handles profile export'''
+		args = list(pinvocation.args[1:])
+		base = ''
+		if '--since' in args:
+			index = args.index('--since')
+			if index + 1 >= len(args):
+				return CommandFailure('--since must be followed by an earlier archive')
+			base = args[index + 1]
+			del args[index:index + 2]
+		if len(args) != 2:
+			print(self.get_help())
+			return ''
+
+		path = self.get_profile_path(pshell_state, args[0])
+		if not path or not os.path.isdir(path):
+			return CommandFailure("Couldn't find the files for profile %s" % args[0])
+		try:
+			summary = profilearchive.export_profile(path, args[1], args[0], base)
+		except (OSError, ValueError, tarfile.TarError) as e:
+			return CommandFailure('Export failed: %s' % e)
+
+		return 'Exported %s files (%s changed) from %.1f MiB in %.2fs' % (summary['files'],
+			summary['stored'], summary['bytes'] / 1048576, summary['seconds'])
+
+	def import_profile(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		'''Handles profile import'''
+		if len(pinvocation.args) != 3:
+			print(self.get_help())
+			return ''
+		name, archive = pinvocation.args[1:]
+		if not os.path.isfile(archive):
+			return CommandFailure("Couldn't find %s" % archive)
+		if name in pshell_state.profiles.get_names():
+			return CommandFailure('A profile named %s already exists' % name)
+
+		try:
+			status = pshell_state.client.create_profile(name)
+			if status.error():
+				return CommandFailure("Couldn't create profile: %s" % status.info())
+			try:
+				summary = profilearchive.import_profile(archive,
+					self.get_profile_path(pshell_state, name))
+			except (OSError, ValueError, tarfile.TarError) as e:
+				pshell_state.client.delete_profile(name)
+				return CommandFailure('Import failed: %s' % e)
+		finally:
+			pshell_state.profiles.invalidate()
+			pshell_state.queries.invalidate()
+
+		return "Imported %s files (%.1f MiB) into profile '%s' in %.2fs" % (summary['files'],
+			summary['bytes'] / 1048576, name, summary['seconds'])
+
 	def autocomplete(self, ptokens: list, pshell_state: ShellState):
 		if len(ptokens) < 1:
 			return list()
 
-		verbs = [ 'create', 'delete', 'list', 'rename' ]
+		verbs = [ 'create', 'delete', 'export', 'import', 'list', 'rename', 'set', 'setdefault' ]
 		if len(ptokens) == 1 and ptokens[0] not in verbs:
 			out_data = [i for i in verbs if i.startswith(ptokens[0])]
 			return out_data
 		
-		groups = pshell_state.client.get_profiles()
-		if len(ptokens) == 2 and ptokens[1] not in groups:
-			out_data = [i for i in groups if i.startswith(ptokens[1])]
+		if len(ptokens) == 2 and ptokens[0] in [ 'delete', 'export', 'rename', 'set',
+				'setdefault' ]:
+			out_data = pshell_state.profiles.complete(ptokens[1])
+			if ptokens[1] in out_data:
+				return list()
 			return out_data
 
+		if len(ptokens) >= 3 and ptokens[0] in [ 'export', 'import' ]:
+			return GetFileSpecCompletions(ptokens[-1])
+
 		return list()
 
 
+class CommandRateLimit(BaseCommand):
+	'''Shows and sets per-server request limits'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'ratelimit'
+		self.helpInfo = helptext.ratelimit_cmd
+		self.description = 'Show or cap request rates to servers'
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		args = pinvocation.args
+		if len(args) in [ 2, 3 ]:
+			try:
+				rate = float(args[1]) if args[1] != 'off' else 0.0
+				burst = float(args[2]) if len(args) == 3 else 0.0
+			except ValueError:
+				return CommandFailure('The rate and burst must be numbers')
+			if rate < 0 or burst < 0:
+				return CommandFailure('The rate and burst may not be negative')
+			pshell_state.rate_control.get(args[0]).set_rate(rate, burst)
+			return ''
+		if args:
+			print(self.helpInfo)
+			return ''
+
+		limiters = pshell_state.rate_control.get_limiters()
+		if not limiters:
+			return 'No requests have been sent'
+		width = max([ len(l.server) for l in limiters ] + [ 6 ])
+		print('%-*s  %5s  %9s  %8s  %8s  %9s  %9s' % (width, 'Server', 'Limit', 'In flight',
+			'Rate cap', 'Requests', 'Congested', 'Latency'))
+		for limiter in limiters:
+			stats = limiter.get_stats()
+			print('%-*s  %5s  %9s  %8s  %8s  %9s  %7.1fms' % (width, stats['server'],
+				stats['limit'], stats['in_flight'],
+				'%g/s' % stats['rate'] if stats['rate'] else 'none', stats['requests'],
+				stats['congested'], stats['latency'] * 1000))
+		return ''
+
+
 class CommandRegister(BaseCommand):
 	'''Register an account on a server'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self, raw_input, ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'register'
 		self.helpInfo = helptext.register_cmd
 		self.description = 'Register a new account on the connected server.'
-		
+	
+	def prompts(self, pinvocation: Invocation) -> bool:
+		# The passphrase is read with getpass
+		return True
 
-	def execute(self, pshell_state: ShellState) -> str:
-		if len(self.tokenList) != 1:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if len(pinvocation.args) != 1:
 			print(self.helpInfo)
 			return ''
 		
@@ -330,9 +931,17 @@ class CommandRegister(BaseCommand):
 					print("Unfortunately, the password you entered was too weak. Please " \
 							"use another.")
 					continue
+				if is_password_breached(password):
+					print("The password you entered has appeared in a data breach and is " \
+							"not safe to use. Please use another.")
+					continue
 				password_needed = False
 		
-		status = pshell_state.client.register_account(self.tokenList[0], password)
+		# The client library makes the connection itself, since it keeps the new workspace in
+		# the active profile
+		status = pshell_state.rate_control.get(pinvocation.args[0]).call(
+			lambda: pshell_state.client.register_account(pinvocation.args[0], password),
+			is_overload_status)
 		
 		returncodes = {
 			304:"This server does not allow self-registration.",
@@ -344,7 +953,7 @@ class CommandRegister(BaseCommand):
 		}
 		
 		if status.error():
-			return 'Registration error %s: %s' % (status.error(), status.info())
+			return CommandFailure('Registration error %s: %s' % (status.error(), status.info()))
 
 		if status['status'] == 201:
 			# 201 - Registered
@@ -354,29 +963,31 @@ class CommandRegister(BaseCommand):
 			# 2) Upload keycard and receive signed keycard - SIGNCARD
 			# 3) Save signed keycard to database
 			pass
+		elif status['status'] == 101:
+			return returncodes[101]
 		elif status['status'] in returncodes.keys():
-			return returncodes[status['status']]
+			return CommandFailure(returncodes[status['status']])
 		
 		return 'Registration success'
 
 
 class CommandSetInfo(BaseCommand):
 	'''Set workspace information'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'setinfo'
 		self.helpInfo = helptext.setinfo_cmd
 		self.description = 'Set workspace information'
 
-	def execute(self, pshell_state: ShellState) -> str:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
 		# TODO: Implement SETINFO
 		return ''
 
 
 class CommandShell(BaseCommand):
 	'''Perform shell commands'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'shell'
 		self.helpInfo = helptext.shell_cmd
 		self.description = 'Run a shell command'
@@ -385,42 +996,210 @@ class CommandShell(BaseCommand):
 		'''Return aliases for the command'''
 		return { "sh":"shell", "`":"shell" }
 
-	def execute(self, pshell_state: ShellState) -> str:
+	def reads_whole_line(self) -> bool:
+		# Pipes in the command are for the system shell
+		return True
+
+	@staticmethod
+	def parse_options(pinvocation: Invocation) -> tuple:
+		'''Returns the options given before the command: whether -i was given, the -t value or
+an empty string, the index in args where the command starts, and an error string'''
+		args = pinvocation.args
+		interactive = False
+		timeout = ''
+		index = 0
+		while index < len(args) and args[index] in [ '-i', '-t' ]:
+			if args[index] == '-i':
+				interactive = True
+				index += 1
+				continue
+			if len(args) < index + 3:
+				return interactive, timeout, index, \
+					'-t must be followed by a number of seconds and a command'
+			timeout = args[index + 1]
+			index += 2
+		return interactive, timeout, index, ''
+
+	def prompts(self, pinvocation: Invocation) -> bool:
+		# With -i the command reads from the keyboard
+		return self.parse_options(pinvocation)[0]
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		interactive, timeoutText, index, error = self.parse_options(pinvocation)
+		if error:
+			return CommandFailure(error)
+		timeout = 0
+		if timeoutText:
+			try:
+				timeout = float(timeoutText)
+			except ValueError:
+				return CommandFailure('The timeout must be a number of seconds')
+
+		tokens = pinvocation.tokens[1 + index:]
+		if not tokens:
+			print(self.helpInfo)
+			return ''
+
+		# The command is passed on as typed so that the shell handles its quoting
+		command = pinvocation.raw[tokens[0].start:]
+
+		if interactive:
+			return self.execute_interactive(command, timeout, pshell_state)
+
+		# A command run while the shell is busy with another, such as a background job, gets a
+		# shell of its own so that it doesn't have to wait
+		coprocess = pshell_state.coprocess
+		if coprocess.busy():
+			coprocess = ShellCoprocess()
+
+		try:
+			result = coprocess.run(command, pshell_state.pwd, timeout, sys.stdout.write,
+									sys.stderr.write)
+		except OSError as e:
+			return CommandFailure("Error running command: %s" % e)
+		finally:
+			if coprocess is not pshell_state.coprocess:
+				coprocess.close()
+
+		# Keep the shell's working directory and ours the same when the command changes it
+		if coprocess is pshell_state.coprocess and result.cwd and result.cwd != pshell_state.pwd:
+			try:
+				os.chdir(result.cwd)
+				pshell_state.oldpwd = pshell_state.pwd
+				pshell_state.pwd = result.cwd
+			except OSError:
+				pass
+
+		if result.timed_out:
+			return CommandFailure('Command timed out after %s seconds' % timeoutText)
+		if result.exit_code:
+			return CommandFailure('Command exited with status %s' % result.exit_code)
+		return ''
+
+	@staticmethod
+	def execute_interactive(command: str, timeout: float, pshell_state: ShellState) -> str:
+		'''Runs a command with the terminal attached, for programs such as editors, pagers, and
+password prompts'''
+		if timeout:
+			return CommandFailure('-i and -t cannot be used together')
+		if not (sys.stdin.isatty() and sys.stdout.isatty()):
+			return CommandFailure('shell -i needs a terminal')
+
+		# Variables set by earlier commands are passed on, unless the shell is busy
+		coprocess = pshell_state.coprocess
+		environment = None
+		if not coprocess.busy():
+			try:
+				environment = coprocess.get_environment()
+			except OSError:
+				pass
+
 		try:
-			os.system(' '.join(self.tokenList))
-		except Exception as e:
-			print("Error running command: %s" % e)
+			result = run_interactive(command, pshell_state.pwd, environment)
+		except OSError as e:
+			return CommandFailure("Error running command: %s" % e)
+		if result.exit_code:
+			return CommandFailure('Command exited with status %s' % result.exit_code)
 		return ''
 
+
+class CommandSort(BaseCommand):
+	'''Sorts the lines of a pipeline'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'sort'
+		self.helpInfo = helptext.sort_cmd
+		self.description = 'Sort lines from a pipe'
+
+	@staticmethod
+	def parse_args(pinvocation: Invocation) -> tuple:
+		'''Returns a dictionary of options and an error string'''
+		options = { '-r':False, '-n':False, '-u':False, '-k':0 }
+		args = list(pinvocation.args)
+		while args:
+			arg = args.pop(0)
+			if arg == '-k':
+				try:
+					options['-k'] = int(args.pop(0))
+				except (IndexError, ValueError):
+					return options, '-k must be followed by a field number'
+				if options['-k'] < 1:
+					return options, 'Fields are numbered from 1'
+			elif arg in options:
+				options[arg] = True
+			else:
+				return options, 'Unknown option %s' % arg
+		return options, ''
+
+	def is_valid(self, pinvocation: Invocation) -> str:
+		return self.parse_args(pinvocation)[1]
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		return CommandFailure('sort reads the output of another command, such as ls | sort')
+
+	def reads_input(self) -> bool:
+		return True
+
+	def pipe(self, pinvocation: Invocation, pshell_state: ShellState, precords):
+		options = self.parse_args(pinvocation)[0]
+		return pipeline.sort_records(precords, reverse=options['-r'], numeric=options['-n'],
+			unique=options['-u'], field=options['-k'])
+
+
+class CommandWait(BaseCommand):
+	'''Waits for background commands to finish'''
+	def __init__(self):
+		BaseCommand.__init__(self)
+		self.name = 'wait'
+		self.helpInfo = helptext.wait_cmd
+		self.description = 'Wait for background commands to finish'
+
+	def get_aliases(self) -> dict:
+		return { "fg":"wait" }
+
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if pinvocation.args:
+			joblist = list()
+			for item in pinvocation.args:
+				try:
+					job = pshell_state.jobs.get_job(int(item.lstrip('%')))
+				except ValueError:
+					job = None
+				if not job:
+					return CommandFailure('No such job %s' % item)
+				joblist.append(job)
+		else:
+			joblist = pshell_state.jobs.get_jobs()
+
+		# The result of each job is printed by the shell when it finishes
+		for job in joblist:
+			pshell_state.jobs.collect(job)
+		return ''
+
+
 class CommandSetUserID(BaseCommand):
 	'''Sets the workspace's user ID'''
-	def __init__(self, raw_input=None, ptoken_list=None):
-		BaseCommand.__init__(self,raw_input,ptoken_list)
+	def __init__(self):
+		BaseCommand.__init__(self)
 		self.name = 'setuser_id'
 		self.helpInfo = helptext.setuserid_cmd
 		self.description = 'Set user id for workspace'
 
-	def execute(self, pshell_state: ShellState) -> str:
-		if len(self.tokenList) != 1:
+	def execute(self, pinvocation: Invocation, pshell_state: ShellState) -> str:
+		if len(pinvocation.args) != 1:
 			print(self.helpInfo)
 			return ''
 		
-		if '"' in self.tokenList[0] or "/" in self.tokenList[0]:
-			return 'A user id may not contain " or /.'
-		
-		p = pshell_state.client.get_active_profile()
-		worklist = p.get_workspaces()
-		user_wksp = None
-		for w in worklist:
-			if w.type == 'single':
-				user_wksp = w
-				break
+		if '"' in pinvocation.args[0] or "/" in pinvocation.args[0]:
+			return CommandFailure('A user id may not contain " or /.')
 		
-		if not user_wksp:
-			return "Couldn't find the identity workspace for the profile."
+		worklist = pshell_state.queries.find_workspaces(wtype='single')
+		if not worklist:
+			return CommandFailure("Couldn't find the identity workspace for the profile.")
 		
-		status = user_wksp.set_user_id(self.tokenList[0])
+		user_wksp = worklist[0]
+		status = pshell_state.queries.set_user_id(user_wksp, pinvocation.args[0])
 		if status.error():
-			return "Error setting user ID %s : %s" % (status.error(), status.info())
+			return CommandFailure("Error setting user ID %s : %s" % (status.error(), status.info()))
 		
 		return 'Anselus address is now %s/%s' % (user_wksp.uid, user_wksp.domain)
@@ -1,79 +1,312 @@
 #!/usr/bin/env python3
 '''This is the main module'''
 
-import re
+import sys
+
+# This must come before the other imports so that they are included in the profile
+if '--startup-profile' in sys.argv:
+	import startupprofile
+	startupprofile.install()
+
+# The thin client for daemon mode needs none of the imports below, which are most of the time it
+# takes to start
+if len(sys.argv) > 1 and sys.argv[1] == '--connect':
+	import daemonclient
+	sys.exit(daemonclient.main(sys.argv[2:]))
+
+import argparse
+import asyncio
+import functools
 
 from prompt_toolkit import HTML
 from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import Completer, Completion, ThreadedCompleter
+from prompt_toolkit.completion import Completer, Completion
+from prompt_toolkit.patch_stdout import patch_stdout
 
 from commandaccess import gCommandAccess
-from shellbase import ShellState
+from completion import CompletionScheduler
+from history import make_search_bindings, PromptHistory
+import pipeline
+from shellbase import CommandFailure, Invocation, ShellState
+from tokenizer import IncrementalTokenizer
 
 class ShellCompleter(Completer):
 	'''Class for handling command autocomplete'''
-	def __init__(self, pshell_state):
+	def __init__(self, pshell_state, ptokenizer=None):
 		Completer.__init__(self)
-		self.lexer = re.compile(r'"[^"]+"|"[^"]+$|[\S\[\]]+')
+		self.tokenizer = ptokenizer if ptokenizer else IncrementalTokenizer()
 		self.shell = pshell_state
 
 	def get_completions(self, document, complete_event):
-		tokens = self.lexer.findall(document.current_line_before_cursor.strip())
+		# Commands' autocomplete methods receive the tokens as typed, including any quotes
+		tokens = [ t.text for t in self.tokenizer.tokenize(document.current_line_before_cursor) ]
+		
+		# Only the command after the last pipe is being typed
+		if '|' in tokens:
+			tokens = tokens[len(tokens) - tokens[::-1].index('|'):]
 		
 		if len(tokens) == 1:
 			commandToken = tokens[0]
 
 			# We have only one token, which is the command name
-			names = gCommandAccess.get_command_names()
+			names = gCommandAccess.get_command_names(commandToken)
 			for name in names:
-				if name.startswith(commandToken):
-					yield Completion(name[len(commandToken):],display=name)
+				yield Completion(name[len(commandToken):],display=name)
 		elif tokens:
 			cmd = gCommandAccess.get_command(tokens[0])
 			if cmd.get_name() != 'unrecognized' and tokens:
-				outTokens = cmd.autocomplete(tokens[1:], self.shell)
-				for out in outTokens:
-					yield Completion(out,display=out,
-							start_position=-len(tokens[-1]))
+				# autocomplete may be a generator, so the span covers reading its results
+				with self.shell.tracer.span('autocomplete', cmd.get_name()):
+					for out in cmd.autocomplete(tokens[1:], self.shell):
+						# Completions are either a string or a [data, display] pair
+						if isinstance(out, str):
+							data, display = out, out
+						else:
+							data, display = out
+						yield Completion(data,display=display,
+								start_position=-len(tokens[-1]))
 		
 
 class Shell:
 	'''The main shell class for the application.'''
-	def __init__(self):
-		self.state = ShellState()
+	def __init__(self, pstate=None):
+		self.state = pstate if pstate else ShellState()
+		
+		# Shared with the completer so that a line tokenized while it was being typed is not
+		# tokenized again when it is executed
+		self.tokenizer = IncrementalTokenizer()
+
+	def execute_line(self, raw_input: str) -> str:
+		'''Runs one line of input through the lexer and command dispatch. Output from the command 
+is printed. An empty string is returned on success and an error message if the command was not 
+valid, returned a CommandFailure, or failed with an exception. This may be called from several 
+threads at once. If timing is on, a summary of where the time went is printed afterward.'''
+		tracer = self.state.tracer
+		tracer.begin()
+		try:
+			with tracer.span('command', raw_input):
+				return self.dispatch_line(raw_input)
+		finally:
+			phases = tracer.end()
+			if phases and tracer.enabled:
+				print(tracer.format_summary(phases))
+
+	def dispatch_line(self, raw_input: str) -> str:
+		'''Does the work for execute_line()'''
+		tracer = self.state.tracer
+		with tracer.span('parse'):
+			tokens = self.tokenizer.tokenize(raw_input)
+			invocation = Invocation(raw_input, tokens)
+			if not invocation.name:
+				return ''
+			
+			cmd = gCommandAccess.get_command(invocation.name)
+			stages = list()
+			if not cmd.reads_whole_line():
+				try:
+					stages = pipeline.split_stages(raw_input, tokens)
+				except ValueError as e:
+					return str(e)
+
+		if len(stages) > 1:
+			return self.dispatch_pipeline(stages)
+
+		error = cmd.is_valid(invocation)
+		if error:
+			return error
+
+		try:
+			with tracer.span('execute', cmd.get_name()):
+				returnCode = cmd.execute(invocation, self.state)
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except Exception as e:
+			return '%s: %s' % (type(e).__name__, e)
+		
+		if isinstance(returnCode, CommandFailure):
+			return returnCode
+		if returnCode:
+			print(returnCode + '\n')
+		return ''
+
+	def dispatch_pipeline(self, pstages: list) -> str:
+		'''Runs the stages of a line containing pipes. Returns an error string like 
+dispatch_line().'''
+		commands = list()
+		for text in pstages:
+			invocation = Invocation(text)
+			cmd = gCommandAccess.get_command(invocation.name)
+			error = cmd.is_valid(invocation)
+			if error:
+				return '%s: %s' % (invocation.name, error)
+			if commands and not cmd.reads_input():
+				return '%s cannot read from a pipe' % invocation.name
+			if not commands and cmd.reads_input():
+				return '%s must come after a |' % invocation.name
+			commands.append((cmd, invocation))
+
+		try:
+			with self.state.tracer.span('execute', 'pipeline'):
+				pipeline.run_pipeline(commands, self.state)
+		except (KeyboardInterrupt, SystemExit):
+			raise
+		except pipeline.StageFailed as e:
+			return str(e)
+		except Exception as e:
+			return '%s: %s' % (type(e).__name__, e)
+		return ''
+
+	def record_history(self, raw_input: str, status: int):
+		'''Adds a command entered at the prompt to the history'''
+		try:
+			self.state.history.append(raw_input, status)
+		except OSError:
+			# History is a convenience, so a read-only home directory shouldn't stop the shell
+			pass
+
+	def start_job(self, raw_input: str, on_done=None):
+		'''Runs a line of input in the background. A notice is printed when it finishes and, if 
+given, on_done is then called with the job.'''
+		def finish(job):
+			print("[%s] %s  %s" % (job.id, job.get_status(), job.command_line))
+			if on_done:
+				on_done(job)
 		
-		self.lexer = re.compile(r'"[^"]+"|\S+')
+		job = self.state.jobs.submit(raw_input,
+				functools.partial(self.execute_line, raw_input), finish)
+		print("[%s] %s" % (job.id, raw_input))
+		return job
 
 	def Prompt(self):
 		'''Begins the prompt loop.'''
-		session = PromptSession()
-		commandCompleter = ThreadedCompleter(ShellCompleter(self.state))
-		while True:
-			try:
-				rawInput = session.prompt(HTML(
-					'🐈<yellow><b> > </b></yellow>' ),
-					completer=commandCompleter)
-			except KeyboardInterrupt:
-				break
-			except EOFError:
-				break
-			else:
-				rawTokens = self.lexer.findall(rawInput.strip())
-				
-				tokens = list()
-				for token in rawTokens:
-					tokens.append(token.strip('"'))
+		asyncio.run(self.PromptAsync())
 
-				if not tokens:
+	async def PromptAsync(self):
+		'''The prompt loop. Commands run in worker threads so that the event loop, which is 
+shared with prompt_toolkit, keeps printing output from background commands above the prompt.'''
+		session = PromptSession(history=PromptHistory(self.state.history),
+			key_bindings=make_search_bindings(self.state.history))
+		commandCompleter = CompletionScheduler(ShellCompleter(self.state, self.tokenizer),
+			self.state.completion_stats)
+		loop = asyncio.get_running_loop()
+		# Raw mode passes color codes, such as those from ls, through to the terminal
+		with patch_stdout(raw=True):
+			while True:
+				try:
+					rawInput = await session.prompt_async(HTML(
+						'🐈<yellow><b> > </b></yellow>' ),
+						completer=commandCompleter)
+				except KeyboardInterrupt:
+					break
+				except EOFError:
+					break
+				
+				line = rawInput.strip()
+				if line.endswith('&'):
+					if line[:-1].strip():
+						self.start_job(line[:-1].strip(), lambda job: self.record_history(line,
+							0 if job.get_status() == 'Done' else 1))
 					continue
 				
-				cmd = gCommandAccess.get_command(tokens[0])
-				cmd.set(rawInput)
+				try:
+					error = await loop.run_in_executor(None, self.execute_line, rawInput)
+				except SystemExit:
+					self.record_history(line, 0)
+					break
+				if line:
+					self.record_history(line, 1 if error else 0)
+				if error:
+					print(error + '\n')
+
+	def Batch(self, stream, source: str, keep_going: bool = False) -> int:
+		'''Runs commands read from a stream without starting the interactive prompt. Blank lines 
+and lines starting with # are skipped. A status line is written to stderr for each failed command 
+and a summary is written when the stream is finished. Unless keep_going is True, processing stops 
+at the first failure. Returns 0 if every command succeeded and 1 otherwise.'''
+		run = 0
+		failed = 0
+		backgroundJobs = list()
+		for lineNumber, rawInput in enumerate(stream, 1):
+			line = rawInput.strip()
+			if not line or line.startswith('#'):
+				continue
+			
+			run += 1
+			if line.endswith('&'):
+				backgroundJobs.append((lineNumber, line, self.start_job(line[:-1].strip())))
+				continue
+			
+			try:
+				error = self.execute_line(line)
+			except SystemExit:
+				break
+			
+			if error:
+				failed += 1
+				print('%s:%s: %s: %s' % (source, lineNumber, line, error), file=sys.stderr)
+				if not keep_going:
+					break
+		
+		# Background commands which were not waited for are collected before finishing
+		for lineNumber, line, job in backgroundJobs:
+			status = self.state.jobs.collect(job)
+			if status != 'Done':
+				failed += 1
+				print('%s:%s: %s: %s' % (source, lineNumber, line, status), file=sys.stderr)
+		
+		print('%s: %s commands run, %s failed' % (source, run, failed), file=sys.stderr)
+		return 1 if failed else 0
+
+
+def main() -> int:
+	'''Parses command line arguments and starts either the interactive shell or batch mode'''
+	parser = argparse.ArgumentParser(description='A text-based client for the Anselus platform')
+	parser.add_argument('--batch', metavar='SCRIPT',
+		help='run the commands in SCRIPT without the interactive prompt. Use - for stdin.')
+	parser.add_argument('--keep-going', action='store_true',
+		help='in batch mode, continue after a command fails')
+	parser.add_argument('--startup-profile', action='store_true',
+		help='print a breakdown of startup time before running')
+	parser.add_argument('--daemon', action='store_true',
+		help='stay running and take commands from clients started with --connect')
+	parser.add_argument('--socket', metavar='PATH', default='',
+		help='socket for --daemon to listen on')
+	parser.add_argument('--idle-timeout', metavar='SECONDS', type=float, default=1800.0,
+		help='stop the daemon after this long without clients')
+	parser.add_argument('--connect', action='store_true',
+		help='run a command in the daemon. Must be the first argument. Use --connect -h for '
+			'its options.')
+	args = parser.parse_args()
+
+	# A leading --connect is handled before the imports, so one here came after other arguments
+	if args.connect:
+		parser.error('--connect must be the first argument')
+
+	if args.daemon:
+		import daemon
+		return daemon.serve(Shell, args.socket, args.idle_timeout)
+
+	if args.startup_profile:
+		startupprofile.mark('imports')
+	shell = Shell()
+	if args.startup_profile:
+		startupprofile.mark('shell state')
+		startupprofile.report()
 
-				returnCode = cmd.execute(self.state)
-				if returnCode:
-					print(returnCode + '\n')
+	if not args.batch:
+		shell.Prompt()
+		return 0
+	
+	if args.batch == '-':
+		return shell.Batch(sys.stdin, '<stdin>', args.keep_going)
+	
+	try:
+		with open(args.batch, encoding='utf-8') as handle:
+			return shell.Batch(handle, args.batch, args.keep_going)
+	except OSError as e:
+		print("Couldn't read script: %s" % e, file=sys.stderr)
+		return 2
 
 
 if __name__ == '__main__':
-	Shell().Prompt()
+	sys.exit(main())
@@ -0,0 +1,72 @@
+'''Measures where startup time goes. When installed, every first-time import is timed and
+startup phases can be marked, after which report() prints a breakdown to stderr.'''
+
+import builtins
+import sys
+import time
+
+_original_import = builtins.__import__
+_start_time = time.perf_counter()
+
+# Each element is the time spent in imports nested inside the import currently running at
+# that depth, so that self time can be separated from the time spent in child imports.
+_child_times = list()
+
+# (module name, self time, total time, depth) in the order imports finished
+_imports = list()
+
+# (label, elapsed time since the previous mark)
+_phases = list()
+_last_mark = _start_time
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+	'''Replacement for __import__ which records the time taken by first-time imports'''
+	if level or name in sys.modules:
+		return _original_import(name, globals, locals, fromlist, level)
+
+	depth = len(_child_times)
+	_child_times.append(0.0)
+	start = time.perf_counter()
+	try:
+		return _original_import(name, globals, locals, fromlist, level)
+	finally:
+		elapsed = time.perf_counter() - start
+		child_time = _child_times.pop()
+		if _child_times:
+			_child_times[-1] += elapsed
+		_imports.append((name, elapsed - child_time, elapsed, depth))
+
+
+def install():
+	'''Starts timing imports'''
+	builtins.__import__ = _timed_import
+
+
+def mark(label: str):
+	'''Records the time elapsed since the previous mark as a startup phase'''
+	global _last_mark
+	now = time.perf_counter()
+	_phases.append((label, now - _last_mark))
+	_last_mark = now
+
+
+def report(limit: int = 15):
+	'''Stops timing imports and prints the startup breakdown to stderr'''
+	builtins.__import__ = _original_import
+
+	out = sys.stderr
+	print('Startup profile (ms)', file=out)
+	print('  Phases:', file=out)
+	for label, elapsed in _phases:
+		print('    %8.2f  %s' % (elapsed * 1000, label), file=out)
+	print('    %8.2f  total' % ((_last_mark - _start_time) * 1000), file=out)
+
+	print('  Top-level imports (cumulative):', file=out)
+	for name, _, total, depth in _imports:
+		if depth == 0:
+			print('    %8.2f  %s' % (total * 1000, name), file=out)
+
+	print('  Slowest imports (self):', file=out)
+	slowest = sorted(_imports, key=lambda x: x[1], reverse=True)[:limit]
+	for name, self_time, _, _ in slowest:
+		print('    %8.2f  %s' % (self_time * 1000, name), file=out)
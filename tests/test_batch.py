@@ -0,0 +1,35 @@
+'''Tests for batch mode'''
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('pyanselus')
+
+SMILODON = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+						'smilodon.py')
+
+
+def _run_batch(tmp_path, script: str) -> subprocess.CompletedProcess:
+	path = tmp_path / 'script'
+	path.write_text(script, encoding='utf-8')
+	env = dict(os.environ, SMILODON_HISTORY=str(tmp_path / 'history'))
+	return subprocess.run([ sys.executable, SMILODON, '--batch', str(path), '--keep-going' ],
+		capture_output=True, text=True, cwd=str(tmp_path), env=env, timeout=60)
+
+
+def test_failures_are_counted(tmp_path):
+	'''Commands which fail must be counted as failures and give a non-zero exit status'''
+	missing = str(tmp_path / 'nonexistent')
+	result = _run_batch(tmp_path, 'ls %s\ncd %s\nls %s\n' % (missing, missing, tmp_path))
+	assert result.returncode == 1
+	assert '3 commands run, 2 failed' in result.stderr
+
+
+def test_success(tmp_path):
+	'''A script whose commands all succeed must exit with status 0'''
+	result = _run_batch(tmp_path, '# comment\n\nls %s\ncd %s\n' % (tmp_path, tmp_path))
+	assert result.returncode == 0
+	assert '2 commands run, 0 failed' in result.stderr
@@ -0,0 +1,69 @@
+'''Tests for the shared command history'''
+
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from history import HistoryStore
+
+WRITERS = 4
+RECORDS_PER_WRITER = 500
+
+
+def _write(path: str, writer: int):
+	store = HistoryStore(path)
+	for i in range(RECORDS_PER_WRITER):
+		store.append('writer %d command %d' % (writer, i))
+
+
+def _read(path: str, done):
+	store = HistoryStore(path)
+	while not done.is_set():
+		len(store)
+		store.search('command')
+		store.close()
+
+
+def test_concurrent_appends(tmp_path):
+	'''Shells appending while others repair the index must leave one entry per record'''
+	path = str(tmp_path / 'history')
+	context = multiprocessing.get_context('fork')
+	done = context.Event()
+	readers = [ context.Process(target=_read, args=(path, done)) for _ in range(2) ]
+	writers = [ context.Process(target=_write, args=(path, i)) for i in range(WRITERS) ]
+	for process in readers + writers:
+		process.start()
+	for process in writers:
+		process.join()
+	done.set()
+	for process in readers:
+		process.join()
+
+	with open(path, 'rb') as handle:
+		lines = handle.read().splitlines()
+	assert len(lines) == WRITERS * RECORDS_PER_WRITER
+	assert os.path.getsize(path + '.idx') == len(lines) * 8
+
+	store = HistoryStore(path)
+	commands = [ record.command for record in store.iter_forward() ]
+	assert sorted(commands) == sorted([ 'writer %d command %d' % (w, i)
+		for w in range(WRITERS) for i in range(RECORDS_PER_WRITER) ])
+
+
+def test_search_skips_escapes(tmp_path):
+	'''Searches must not match the letter of an escaped tab or newline'''
+	store = HistoryStore(str(tmp_path / 'history'))
+	store.append('echo a\tb')
+	store.append('cat\nls')
+	store.append('echo \\t')
+	for _ in range(40):
+		store.append('echo a\tb')
+
+	record = store.search('t')
+	assert record.command == 'echo \\t'
+	assert store.search('n') is None
+	assert store.search_fuzzy('an') is None
+	assert [ r.command for r in store.find('t') ] == [ 'echo \\t', 'cat\nls' ]
@@ -0,0 +1,111 @@
+'''The tokenizer shared by the prompt, the completer, and commands.
+
+Tokens are separated by whitespace. Double quotes group text containing whitespace into one
+token and may appear anywhere within a token. A backslash escapes a double quote, a space, or
+another backslash. Any other backslash is kept as is so that Windows paths need no escaping.
+An unterminated quote runs to the end of the line, which is what happens while the user is still
+typing a quoted argument.'''
+
+import re
+import threading
+
+ESCAPABLE = '"\\ '
+
+class Token:
+	'''A token along with where it came from. text is the token exactly as it appears in the
+line and value is the token with quotes and escapes removed. start and end are the offsets of
+text in the line. quoted is True if any part of the token was quoted and closed is False if the
+token ends inside an unterminated quote.'''
+	__slots__ = ('text', 'value', 'start', 'end', 'quoted', 'closed')
+
+	def __init__(self, text: str, value: str, start: int, end: int, quoted: bool, closed: bool):
+		self.text = text
+		self.value = value
+		self.start = start
+		self.end = end
+		self.quoted = quoted
+		self.closed = closed
+
+	def __repr__(self):
+		return 'Token(%r, %s-%s)' % (self.text, self.start, self.end)
+
+
+# Matches one whole token: runs of ordinary characters, backslash escapes, and quoted sections,
+# the last of which may be unterminated
+TOKEN_PATTERN = re.compile(r'(?:[^\s"\\]+|\\["\\ ]?|"(?:[^"\\]+|\\["\\ ]?)*"?)+')
+
+def _unquote(text: str) -> tuple:
+	'''Returns the value of a token containing quotes or backslashes, whether it contains a 
+quote, and whether all of its quotes are closed'''
+	if '\\' not in text:
+		return text.replace('"', ''), True, text.count('"') % 2 == 0
+
+	value = list()
+	quoted = False
+	in_quote = False
+	index = 0
+	while index < len(text):
+		char = text[index]
+		if char == '\\' and index + 1 < len(text) and text[index + 1] in ESCAPABLE:
+			value.append(text[index + 1])
+			index += 2
+			continue
+
+		if char == '"':
+			quoted = True
+			in_quote = not in_quote
+		else:
+			value.append(char)
+		index += 1
+	return ''.join(value), quoted, not in_quote
+
+
+def tokenize(line: str, start: int = 0) -> list:
+	'''Returns a list of Tokens for the line, beginning at the offset given. The offset must be
+at the beginning of the line or at whitespace outside of quotes.'''
+	tokens = list()
+	for match in TOKEN_PATTERN.finditer(line, start):
+		text = match.group()
+		if '"' in text or '\\' in text:
+			value, quoted, closed = _unquote(text)
+		else:
+			value, quoted, closed = text, False, True
+		tokens.append(Token(text, value, match.start(), match.end(), quoted, closed))
+	return tokens
+
+
+def get_values(tokens: list) -> list:
+	'''Returns the values of a list of Tokens'''
+	return [ t.value for t in tokens ]
+
+
+class IncrementalTokenizer:
+	'''Tokenizes successive versions of a line, such as the line being edited at the prompt,
+reusing the tokens which lie entirely before the first edited position. The completer and the
+shell share one instance, so a line which was tokenized while completing is not tokenized again
+when it is executed. Safe to use from multiple threads.'''
+	def __init__(self):
+		self.line = ''
+		self.tokens = list()
+		self.lock = threading.Lock()
+
+	def tokenize(self, line: str) -> list:
+		'''Returns a list of Tokens for the line'''
+		with self.lock:
+			if line == self.line:
+				return list(self.tokens)
+
+			limit = min(len(line), len(self.line))
+			changed = 0
+			while changed < limit and line[changed] == self.line[changed]:
+				changed += 1
+
+			# A token can be kept if the whitespace which ended it is also unchanged
+			keep = 0
+			while keep < len(self.tokens) and self.tokens[keep].end < changed:
+				keep += 1
+
+			resume = self.tokens[keep - 1].end if keep else 0
+			self.tokens = self.tokens[:keep] + tokenize(line, resume)
+			self.line = line
+			return list(self.tokens)
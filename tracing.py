@@ -0,0 +1,90 @@
+'''Implements timing instrumentation for commands. Spans of work such as parsing, execution,
+completion, and time spent holding a server session are measured in wall and CPU time. When
+timing is on, the totals for each phase are summarized after every command and the individual
+spans are kept so they can be exported in Chrome trace format for offline analysis.'''
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Tracer:
+	'''Records timing spans. All methods are safe to call from multiple threads. Per-command
+totals are kept per thread, so commands running in the background are measured separately.'''
+	def __init__(self, max_spans: int = 100000):
+		self.enabled = False
+		# (name, detail, start, wall seconds, CPU seconds, thread ID)
+		self.spans = collections.deque(maxlen=max_spans)
+		self.local = threading.local()
+		self.origin = time.perf_counter()
+
+	@contextlib.contextmanager
+	def span(self, name: str, detail: str = ''):
+		'''Context manager which measures the code it wraps when timing is on'''
+		if not self.enabled:
+			yield
+			return
+
+		wall_start = time.perf_counter()
+		cpu_start = time.thread_time()
+		try:
+			yield
+		finally:
+			wall = time.perf_counter() - wall_start
+			cpu = time.thread_time() - cpu_start
+			self.spans.append((name, detail, wall_start, wall, cpu, threading.get_ident()))
+
+			phases = getattr(self.local, 'phases', None)
+			if phases is not None:
+				totals = phases.setdefault(name, [0.0, 0.0, 0])
+				totals[0] += wall
+				totals[1] += cpu
+				totals[2] += 1
+
+	def begin(self):
+		'''Starts collecting phase totals for a command on the calling thread'''
+		self.local.phases = dict()
+
+	def end(self) -> dict:
+		'''Stops collecting phase totals on the calling thread and returns them as a dictionary
+mapping phase names to [wall seconds, CPU seconds, call count] lists'''
+		phases = getattr(self.local, 'phases', None)
+		self.local.phases = None
+		return phases if phases else dict()
+
+	@staticmethod
+	def format_summary(phases: dict) -> str:
+		'''Returns a one-line summary of the phase totals from end()'''
+		parts = list()
+		for name, (wall, cpu, calls) in phases.items():
+			part = '%s %.2fms (cpu %.2fms)' % (name, wall * 1000, cpu * 1000)
+			if calls > 1:
+				part += ' x%s' % calls
+			parts.append(part)
+		return 'Timing: ' + ' | '.join(parts)
+
+	def export(self, path: str) -> int:
+		'''Writes the recorded spans to a file in Chrome trace event format, which can be loaded
+by chrome://tracing or Perfetto, and clears them. Returns the number of spans written.'''
+		spans = list(self.spans)
+		self.spans.clear()
+
+		pid = os.getpid()
+		events = list()
+		for name, detail, start, wall, cpu, thread_id in spans:
+			events.append({
+				'name': name,
+				'cat': 'smilodon',
+				'ph': 'X',
+				'ts': (start - self.origin) * 1e6,
+				'dur': wall * 1e6,
+				'pid': pid,
+				'tid': thread_id,
+				'args': { 'detail':detail, 'cpu_ms':cpu * 1000 },
+			})
+
+		with open(path, 'w', encoding='utf-8') as handle:
+			json.dump({ 'traceEvents':events, 'displayTimeUnit':'ms' }, handle)
+		return len(events)